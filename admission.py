@@ -0,0 +1,181 @@
+import contextvars
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import config
+import deadline
+import metrics
+from circuit_breaker import CircuitOpen
+
+
+class Overloaded(CircuitOpen):
+    """
+    Too many calls are already waiting for the service; the call was not queued.
+
+    Handled like an open circuit: the bots answer from what they have locally.
+    """
+
+
+# Chat whose message the running work answers (set by the bot's update
+# handlers); calls of other chats are served in turn with it. Prefetches keep
+# the chat that submitted them; other background work (batch jobs) shares
+# the None queue.
+current_user = contextvars.ContextVar('admission_user', default=None)
+
+
+def estimate_tokens(texts, max_tokens=0):
+    """Rough token count of texts plus the completion tokens allowed"""
+    return sum(len(text or '') // 3 + 1 for text in texts) + max_tokens
+
+
+def retry_after(error):
+    """Seconds asked for by the Retry-After header of a rate-limit error, or None"""
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class Ticket:
+    """One admitted call; set used to the tokens it actually took when known"""
+
+    __slots__ = ('tokens', 'granted', 'used')
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.granted = False
+        self.used = None
+
+
+class Governor:
+    """
+    Admission control of the calls to one service.
+
+    At most max_concurrent calls run at once, and their tokens stay under
+    tokens_per_minute (a token bucket holding config.ADMISSION_BURST_SECONDS
+    of tokens). Waiting calls are queued per chat and served round robin,
+    so a chat sending many messages waits for its own calls, not the others.
+    With max_queue calls already waiting a new one is rejected at once
+    (Overloaded), and a waiting call gives up at its stage's deadline.
+    After a rate-limit error (throttle) no call starts for a moment, so the
+    retries do not all hit the limit again.
+    """
+
+    def __init__(self, name, max_concurrent, tokens_per_minute, max_queue):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.rate = tokens_per_minute / 60
+        self.capacity = self.rate * config.ADMISSION_BURST_SECONDS
+        self.max_queue = max_queue
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._running = 0
+        self._waiting = 0
+        self._queues = OrderedDict()  # chat -> deque of tickets, first chat served next
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def admit(self, stage, tokens):
+        """Wait for a turn to send a call of stage estimated at tokens"""
+        ticket = self._acquire(stage, tokens)
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    def throttle(self, seconds=None):
+        """Hold back new calls after a rate-limit error (429)"""
+        seconds = seconds or config.RATE_LIMIT_PAUSE
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 0.0)
+        metrics.increment(f"{self.name}.throttled")
+        print(f"🚦 {self.name}: rate limited, new calls held for {seconds:.1f}s")
+
+    def _acquire(self, stage, tokens):
+        ticket = Ticket(tokens)
+        user = current_user.get()
+        started = time.monotonic()
+        expires_at = started + deadline.timeout_for(stage)
+        with self._cond:
+            if self._waiting >= self.max_queue:
+                metrics.increment(f"{self.name}.admission_rejected")
+                print(f"🚦 {self.name}: {self._waiting} calls waiting, '{stage}' rejected")
+                raise Overloaded(stage)
+            self._queues.setdefault(user, deque()).append(ticket)
+            self._waiting += 1
+            self._dispatch()
+            while not ticket.granted:
+                now = time.monotonic()
+                if now >= expires_at:
+                    self._withdraw(user, ticket)
+                    metrics.increment(f"{stage}.deadline_exceeded")
+                    raise deadline.DeadlineExceeded(stage)
+                self._cond.wait(min(expires_at, self._next_refill(now)) - now)
+                self._dispatch()
+        waited = time.monotonic() - started
+        metrics.observe(f"{self.name}.admission_wait", waited)
+        if waited > 1:
+            print(f"🚦 {stage}: waited {waited:.1f}s for {self.name}")
+        return ticket
+
+    def _release(self, ticket):
+        with self._cond:
+            self._running -= 1
+            if ticket.used is not None:
+                # The estimate is corrected with the tokens the API reported
+                self._tokens = min(self.capacity, self._tokens + ticket.tokens - ticket.used)
+            self._dispatch()
+
+    def _withdraw(self, user, ticket):
+        # Called with the lock held: a waiting call gives up its place
+        tickets = self._queues[user]
+        tickets.remove(ticket)
+        if not tickets:
+            del self._queues[user]
+        self._waiting -= 1
+        self._dispatch()
+
+    def _next_refill(self, now):
+        # Called with the lock held: when the first waiting call could start
+        # without a release happening (checked again at least every second)
+        if now < self._paused_until:
+            return self._paused_until
+        if self._queues:
+            needed = min(next(iter(self._queues.values()))[0].tokens, self.capacity) - self._tokens
+            if needed > 0:
+                return now + needed / self.rate
+        return now + 1.0
+
+    def _dispatch(self):
+        # Called with the lock held: starts the waiting calls that fit now
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        granted = False
+        while self._queues and self._running < self.max_concurrent and now >= self._paused_until:
+            user, tickets = next(iter(self._queues.items()))
+            ticket = tickets[0]
+            # A call larger than the bucket goes when the bucket is full
+            if self._tokens < min(ticket.tokens, self.capacity):
+                break
+            tickets.popleft()
+            if tickets:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            self._tokens -= ticket.tokens
+            self._running += 1
+            self._waiting -= 1
+            ticket.granted = True
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+
+# Shared by every bot and background job of the process
+chat = Governor("chat", config.CHAT_MAX_CONCURRENT, config.CHAT_TOKENS_PER_MINUTE, config.ADMISSION_QUEUE_LIMIT)
+embedding = Governor("embedding", config.EMBEDDING_MAX_CONCURRENT, config.EMBEDDING_TOKENS_PER_MINUTE, config.ADMISSION_QUEUE_LIMIT)
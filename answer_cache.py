@@ -0,0 +1,116 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+import config
+import metrics
+
+
+def normalize_query(text):
+    """Normalize a user query so trivially different spellings share a cache key"""
+    text = str(text or "")
+    for arabic, persian in {'ي': 'ی', 'ك': 'ک', 'ة': 'ه', 'ۀ': 'ه', 'أ': 'ا', 'إ': 'ا'}.items():
+        text = text.replace(arabic, persian)
+    text = text.replace('\u200c', ' ').lower()
+    text = re.sub(r'[؟?!.,،؛:«»"\'()\[\]]', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def prompt_version(*prompt_parts):
+    """Short fingerprint of the prompts an answer was generated with"""
+    digest = hashlib.sha1("\n".join(prompt_parts).encode('utf-8')).hexdigest()
+    return digest[:12]
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class AnswerCache:
+    """
+    Cache of final answers for new searches.
+
+    Keys combine the normalized query, the retrieved row-id set, the
+    prompt version and the conversation sent with the question (history
+    window and summary), so a changed index or prompt never serves a stale
+    answer and one chat's answer is never served to another conversation.
+    """
+
+    def __init__(self, name, max_size=None, ttl=None):
+        self.name = name
+        self._cache = TTLCache(
+            max_size or config.ANSWER_CACHE_SIZE,
+            ttl or config.ANSWER_CACHE_TTL
+        )
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(query, row_ids, version, conversation=()):
+        """conversation: the messages between the system prompt and the question"""
+        return (
+            normalize_query(query),
+            tuple(sorted(row_ids)),
+            version,
+            prompt_version(*(f"{m['role']}: {m['content']}" for m in conversation))
+        )
+
+    def get(self, key):
+        answer = self._cache.get(key)
+        if answer is None:
+            self.misses += 1
+            metrics.increment(f"{self.name}.answer_cache.miss")
+        else:
+            self.hits += 1
+            metrics.increment(f"{self.name}.answer_cache.hit")
+            print(f"⚡ Answer cache hit ({self.name}) - hit rate: {self.hit_rate:.0%}")
+        return answer
+
+    def put(self, key, answer):
+        self._cache.put(key, answer)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            'size': len(self._cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+        }
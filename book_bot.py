@@ -1,27 +1,37 @@
 
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from openai import OpenAI
 import config
 from book_embedder import BookEmbedder
 from book_details import BookDetailsLoader
-from collections import defaultdict
+from llm_client import create_chat_completion, get_openai_client
+from context_builder import ContextBuilder, RollingSummary
+from answer_cache import AnswerCache, normalize_query, prompt_version
+from single_flight import SingleFlight
+from deadline import DeadlineExceeded, bounded
+from circuit_breaker import CircuitOpen
+from modules.book_handler import BookHandler
+from stream_reply import StreamingReply
+from session_store import ChatSession, SessionManager, row_ids, schedule_expiry
+from intent_router import IntentRouter, ordinal_of, pick
+from fast_answers import FastAnswers
+from prefetch import Prefetcher
+from explanation_store import get_explanation_store
 from datetime import datetime, timedelta
+import asyncio
 import re
 
 
-last_shown_results = defaultdict(list)  # ✅ Separate for tracking display
-openai_client = OpenAI(api_key=config.OPENAI_API_KEY)
+openai_client = get_openai_client()
 embedder = None
 book_details_loader = None
-conversation_memory = defaultdict(list)
-search_results_memory = defaultdict(list)
-last_message_time = defaultdict(lambda: datetime.now())
-last_query_memory = defaultdict(str)
+handler = None  # formatting and word search while the OpenAI services are down
+answer_cache = AnswerCache("book")
+searches = SingleFlight("book.search")  # the same query searched at once runs once
 
 ORIGINAL_EXCEL_PATH = "output/final_normalize.xlsx"
 
-config.SYSTEM_PROMPT = """
+SYSTEM_PROMPT = """
 شما یک دستیار هوشمند کتابخانه دانشگاه خوارزمی هستید.
 **قوانین مهم:**
 1. **فقط از کتاب‌های ارائه شده استفاده کنید**
@@ -41,6 +51,30 @@ config.SYSTEM_PROMPT = """
    - کتاب تکراری معرفی نکن
 """
 
+ANSWER_TEMPLATE = "کتاب‌ها:\n{context}\n\nسوال: {query}"
+ANSWER_PROMPT_VERSION = prompt_version(SYSTEM_PROMPT, ANSWER_TEMPLATE)
+
+EXPLAIN_TEMPLATE = (
+    "کتاب:\n{context}\n\n"
+    "سوال: {query}\n\n"
+    "**دستور:** فقط درباره این کتاب توضیح بده. "
+    "یک پاراگراف کوتاه و مفید بنویس که این کتاب چیه و برای چه کسانی مناسبه."
+)
+
+FILTER_INSTRUCTIONS = """
+از لیست کتاب‌ها فقط موارد مرتبط با سوال را انتخاب کن.
+خروجی: شماره‌ها با کاما (مثل '1,3') یا 'هیچکدام'.
+"""
+
+# Question used for the explanation prefetched after a search
+PREFETCH_EXPLAIN_QUESTION = "این کتاب چیه و برای چه کسانی مناسبه؟"
+
+# Reply when a message runs past config.REQUEST_DEADLINE before results are found
+TIMEOUT_REPLY = "⏳ پاسخ‌گویی بیش از حد طول کشید. لطفاً چند لحظه دیگر دوباره بپرسید."
+
+prefetcher = Prefetcher("book")
+explanations = get_explanation_store()
+
 def format_cutter(cutter_raw):
     if not cutter_raw or str(cutter_raw).lower() in ['nan', 'none', '']:
         return "نامشخص"
@@ -68,64 +102,200 @@ def enrich_search_result(result):
     return result
 
 
-def clean_old_conversations():
-    current_time = datetime.now()
-    expired_chats = []
-    for chat_id, last_time in last_message_time.items():
-        if current_time - last_time > timedelta(days=7):
-            expired_chats.append(chat_id)
-    for chat_id in expired_chats:
-        conversation_memory.pop(chat_id, None)
-        search_results_memory.pop(chat_id, None)
-        last_message_time.pop(chat_id, None)
-        last_query_memory.pop(chat_id, None)
-        last_shown_results.pop(chat_id, None)
-    if expired_chats:
-        print(f"🗑️ Cleaned: {len(expired_chats)} old conversations")
+def load_results(ids):
+    """Search results for stored row ids (index metadata plus book details)"""
+    results = []
+    for row_id in ids:
+        metadata = embedder.metadata_map.get(row_id) if embedder is not None else None
+        results.append(enrich_search_result(dict(metadata) if metadata else {'رديف': row_id}))
+    return results
+
+
+def new_session():
+    return ChatSession(history_size=config.SESSION_HISTORY_SIZE)
+
+
+# Per-chat state, kept in the session store so it survives restarts
+# (idle sessions are expired by session_store.expire_idle_sessions)
+sessions = SessionManager("book", new_session)
+history_summary = RollingSummary("book", openai_client, sessions)
+context_builder = ContextBuilder("book", SYSTEM_PROMPT, summary=history_summary, history_limit=10)
+
+
+def reset_conversation(chat_id):
+    sessions.reset(chat_id)
+    prefetcher.cancel(chat_id)
+
+
+def drop_expired_messages(history):
+    # Messages are kept in time order, so expired ones are at the front
+    three_days_ago = datetime.now() - timedelta(days=3)
+    while history and history[0]["timestamp"] <= three_days_ago:
+        history.popleft()
 
 
 def add_to_conversation(chat_id, role, content):
-    conversation_memory[chat_id].append({
+    history = sessions.get(chat_id).history
+    history.append({
         "role": role,
         "content": content,
         "timestamp": datetime.now()
     })
-    current_time = datetime.now()
-    three_days_ago = current_time - timedelta(days=3)
-    conversation_memory[chat_id] = [
-        msg for msg in conversation_memory[chat_id]
-        if msg["timestamp"] > three_days_ago
-    ]
-    if len(conversation_memory[chat_id]) > 100:
-        conversation_memory[chat_id] = conversation_memory[chat_id][-100:]
-    last_message_time[chat_id] = datetime.now()
+    drop_expired_messages(history)
 
 
 def get_conversation_history(chat_id, limit=20):
-    if chat_id not in conversation_memory:
-        return []
-    current_time = datetime.now()
-    three_days_ago = current_time - timedelta(days=3)
-    recent_messages = [
-        msg for msg in conversation_memory[chat_id]
-        if msg["timestamp"] > three_days_ago
-    ]
-    return recent_messages[-limit:]
+    history = sessions.peek(chat_id).history
+    drop_expired_messages(history)
+    recent_messages = list(history)
+    return recent_messages[-limit:] if limit else recent_messages
 
 
 def save_search_results(chat_id, results, query=""):
-    search_results_memory[chat_id] = results
+    session = sessions.get(chat_id)
+    session.result_ids = row_ids(results)
     if query:
-        last_query_memory[chat_id] = query
-    last_message_time[chat_id] = datetime.now()
+        session.query = query
 
 
 def get_last_search_results(chat_id):
-    return search_results_memory.get(chat_id, [])
+    return load_results(sessions.peek(chat_id).result_ids)
 
 
 def get_last_query(chat_id):
-    return last_query_memory.get(chat_id, "")
+    return sessions.peek(chat_id).query
+
+
+def get_shown_results(chat_id):
+    return load_results(sessions.peek(chat_id).shown_ids)
+
+
+def set_shown_results(chat_id, results):
+    sessions.get(chat_id).shown_ids = row_ids(results)
+
+
+def save_cursor(chat_id, candidates, depth=None, offered=0):
+    """
+    Keep the ranked candidates of a search, best first, for "more" requests;
+    the first `offered` were already considered for the answer.
+    """
+    ranked = sorted(candidates, key=lambda r: r.get('distance', 0.0))
+    session = sessions.get(chat_id)
+    session.set_cursor(ranked, depth or config.SEARCH_DEPTH)
+    session.cursor_pos = min(offered, len(session.cursor))
+
+
+def next_depth(session):
+    # Searches go twice as deep each time the cursor runs out, up to a bound
+    return min(session.cursor_depth * 2 or config.SEARCH_DEPTH, config.SEARCH_DEPTH * 16)
+
+
+def search_deeper(query, depth, exclude_rows):
+    """Candidates among the first depth neighbours of query, best first (not filtered yet)"""
+    candidates = search_books(query, k=depth, distance_threshold=1.0, exclude_rows=exclude_rows)
+    return query, depth, sorted(candidates, key=lambda r: r.get('distance', 0.0))
+
+
+def extend_cursor(chat_id, session):
+    # Search the last query deeper; candidates already in the cursor are skipped
+    depth = next_depth(session)
+    if depth <= session.cursor_depth:
+        return
+    prefetched = prefetcher.take(chat_id, 'extension')
+    if prefetched and prefetched[:2] == (session.query, depth):
+        found = prefetched[2]
+    else:
+        _, _, found = search_deeper(session.query, depth, set(session.cursor))
+    session.extend_cursor(found, depth)
+    print(f"🔎 Cursor extended to {depth} neighbours (+{len(found)})")
+
+
+def next_results(chat_id):
+    """
+    Next page of the last search for a "more" request.
+
+    Pages come from the ranked candidates in the session cursor, without
+    embedding or index calls, and only the page is filtered with GPT; the
+    query is only searched again when the cursor runs out.
+    """
+    session = sessions.get(chat_id)
+    skip = set(session.shown_ids)
+    page = session.next_page(config.MORE_PAGE_SIZE, skip)
+    if len(page) < config.MORE_PAGE_SIZE and session.query:
+        extend_cursor(chat_id, session)
+        page += session.next_page(config.MORE_PAGE_SIZE - len(page), skip)
+
+    results = load_results([row_id for row_id, _ in page])
+    for result, (_, distance) in zip(results, page):
+        result['distance'] = distance
+    return filter_results_with_gpt(session.query, results, session.query) if results else []
+
+
+def similar_results(row_id, exclude_rows=()):
+    """Books nearest to a book in the precomputed graph (no embedding or search)"""
+    pairs = [(i, d) for i, d in embedder.similar.neighbours_of(int(row_id)) if i not in exclude_rows]
+    results = load_results([i for i, _ in pairs])
+    for result, (_, distance) in zip(results, pairs):
+        result['distance'] = distance
+    return results
+
+
+def explain_book(chat_id, book, question, on_delta=None):
+    """Short explanation of one book for a question about it"""
+    single_context = (
+        f"عنوان: «{book['عنوان']}»\n"
+        f"نویسنده: {book.get('پديدآورنده', 'نامشخص')}\n"
+        f"ناشر: {book.get('ناشر', 'نامشخص')}\n"
+        f"سال: {book.get('تاريخ نشر', 'نامشخص')}\n"
+        f"موضوع: {book.get('موضوع', '')}"
+    )
+
+    messages = context_builder.build(
+        chat_id,
+        get_conversation_history(chat_id, limit=None),
+        EXPLAIN_TEMPLATE,
+        [single_context],
+        query=question
+    )
+
+    return create_chat_completion(
+        openai_client,
+        messages,
+        max_tokens=500,
+        temperature=0.7,
+        on_delta=on_delta,
+        stage="book.explain"
+    )
+
+
+def prefetch_next_turn(chat_id):
+    """
+    Start what the next message will probably need, after results are shown.
+
+    Details of the shown and upcoming books are loaded into the caches, the
+    cursor is searched deeper if the next "more" would run out of it, and
+    the first shown book is explained if config.PREFETCH_EXPLANATION is set.
+    """
+    session = sessions.peek(chat_id)
+    shown_ids = list(session.shown_ids)
+    upcoming = list(session.cursor[session.cursor_pos:session.cursor_pos + 2 * config.MORE_PAGE_SIZE])
+    prefetcher.warm(load_results, shown_ids + upcoming)
+
+    if session.query and session.remaining(set(shown_ids)) < config.MORE_PAGE_SIZE:
+        depth = next_depth(session)
+        if depth > session.cursor_depth:
+            prefetcher.submit(chat_id, 'extension', search_deeper, session.query, depth, set(session.cursor))
+
+    if config.PREFETCH_EXPLANATION and shown_ids and stored_explanation(shown_ids[0]) is None:
+        prefetcher.submit(chat_id, 'explanation', prefetch_explanation, chat_id, load_results(shown_ids[:1])[0])
+
+
+def stored_explanation(row_id):
+    return explanations.get("book", row_id) if explanations else None
+
+
+def prefetch_explanation(chat_id, book):
+    return book['رديف'], explain_book(chat_id, book, PREFETCH_EXPLAIN_QUESTION)
 
 
 def format_book_output(gpt_response, search_results):
@@ -192,9 +362,18 @@ def format_book_output(gpt_response, search_results):
     return final_output
 
 
+def results_only_reply(search_results, reason):
+    """The found books without the model's answer (deadline reached or chat API down)"""
+    if isinstance(reason, CircuitOpen):
+        header = "⚠️ دستیار هوشمند موقتاً در دسترس نیست؛ کتاب‌های پیدا شده:"
+    else:
+        header = "⏳ پاسخ کامل آماده نشد؛ این کتاب‌ها پیدا شد:"
+    return header + "\n\n" + "\n\n".join(handler.format_result(r) for r in search_results[:6])
+
+
 # RAG helper functions
 def initialize_embedder():
-    global embedder, book_details_loader
+    global embedder, book_details_loader, handler
     print("🔄 Loading FAISS index...")
     try:
         embedder = BookEmbedder(api_key=config.OPENAI_API_KEY)
@@ -210,32 +389,75 @@ def initialize_embedder():
     except Exception as e:
         print(f"❌ Error loading details: {e}")
         return False
+    handler = BookHandler(embedder, book_details_loader)
     return True
 
 
-def is_followup_question(query, chat_id):
-    followup_keywords = [
-        'بله', 'آره', 'اوکی', 'باشه', 'بیشتر', 'جدیدتر', 'قدیمی‌تر',
-        'مبتدی', 'پیشرفته', 'ساده', 'سخت', 'بهترین', 'کدوم', 'کدام',
-        'اولی', 'دومی', 'اون', 'این', 'همون', 'همین', 'باز', 'دوباره',
-        'چند تا دیگه', 'چندتا دیگه', 'تا دیگه', 'معرفی کن', 'نشون بده',
-        'بگو', 'توضیح بده', 'چطوره', 'راجع', 'درباره اون', 'درباره این',
-        'دوست دارم', 'دوس دارم', 'عالی بود', 'بهترین', 'ازش', 'از اون',
-        'بیشتر از', 'جزئیات', 'خلاصه', 'توضیح', 'چرا', 'چطور', 'مثال',
-        'شبیه', 'مشابه', 'کتاب دوم', 'کتاب آخر', 'شرح بده', 'درباره کتاب',
-        'بیشتر شرح', 'نویسنده آخر', 'نویسنده کتاب آخر', 'این نویسنده کیه'
-    ]
-    query_lower = query.lower()
-    has_followup_keyword = any(keyword in query_lower for keyword in followup_keywords)
-    has_previous_results = len(get_last_search_results(chat_id)) > 0
-    if has_followup_keyword and has_previous_results and len(query.split()) <= 10:
+# Follow-ups answered from the metadata of the shown books
+FAST_ANSWERS = FastAnswers(
+    "book", "کتاب",
+    fields={
+        'year': ('سال انتشار', ['تاريخ نشر'], ['سال انتشار', 'سال نشر', 'تاریخ نشر', 'تاريخ نشر', 'چه سالی', 'سالش']),
+        'publisher': ('ناشر', ['ناشر'], ['ناشر', 'انتشارات']),
+        'call_number': ('شماره بازیابی', ['شماره_بازیابی'], ['شماره بازیابی', 'کد بازیابی', 'شماره رده']),
+        'location': ('محل نگهداری', ['محل_نگهداری'], ['محل نگهداری', 'کجا نگهداری', 'کجاست', 'کدوم بخش']),
+        'pages': ('تعداد صفحات', ['تعداد صفحات'], ['تعداد صفحات', 'چند صفحه', 'صفحاتش']),
+        'isbn': ('شابک', ['شابك'], ['شابک', 'شابك', 'isbn']),
+        'subject': ('موضوع', ['موضوع'], ['موضوع']),
+    },
+    year_keys=['تاريخ نشر']
+)
+
+# Message classification, compiled once (see intent_router)
+ROUTER = IntentRouter(
+    keywords={
+        **FAST_ANSWERS.keywords,
+        'greeting': ['سلام', 'درود', 'صبح بخیر', 'عصر بخیر', 'شب بخیر', 'خوبی', 'چطوری', 'حالت', 'hello', 'hi'],
+        'followup': [
+            'بله', 'آره', 'اوکی', 'باشه', 'بیشتر', 'جدیدتر', 'قدیمی‌تر',
+            'مبتدی', 'پیشرفته', 'ساده', 'سخت', 'بهترین', 'کدوم', 'کدام',
+            'اولی', 'دومی', 'اون', 'این', 'همون', 'همین', 'باز', 'دوباره',
+            'چند تا دیگه', 'چندتا دیگه', 'تا دیگه', 'معرفی کن', 'نشون بده',
+            'بگو', 'توضیح بده', 'چطوره', 'راجع', 'درباره اون', 'درباره این',
+            'دوست دارم', 'دوس دارم', 'عالی بود', 'ازش', 'از اون',
+            'بیشتر از', 'جزئیات', 'خلاصه', 'توضیح', 'چرا', 'چطور', 'مثال',
+            'شبیه', 'مشابه', 'کتاب دوم', 'کتاب آخر', 'شرح بده', 'درباره کتاب',
+            'بیشتر شرح', 'نویسنده آخر', 'نویسنده کتاب آخر', 'این نویسنده کیه'
+        ],
+        'new_search': ['کتاب', 'نویسنده', 'شعر', 'داستان', 'رمان'],
+        'author_search': [
+            'از این نویسنده', 'از نویسنده', 'نویسنده این', 'کتاب های این نویسنده',
+            'کتاب دیگه از', 'کتاب اون نویسنده', 'نویسنده کتاب اول', 'نویسنده کتاب دوم',
+            'کتاب همون نویسنده', 'ازش کتاب', 'از اون نویسنده', 'نویسنده کتاب آخر',
+            'از نویسنده آخر', 'از نویسنده دوم', 'دوست دارم از نویسنده', 'دوس دارم از نویسنده',
+            'از نویسنده کتاب دوم', 'از نویسنده کتاب آخر', 'چندتا کتاب از نویسنده',
+            'کتاب دیگه ای داریم', 'این نویسنده کیه'
+        ],
+        'explain': ['شرح', 'توضیح', 'درباره', 'جزئیات', 'خلاصه', 'بیشتر بگو', 'معرفی کن'],
+        'introduce': ['معرفی'],
+        'more': ['بیشتر'],
+        'again': ['باز'],
+        'repeat': ['دوباره', 'چند تا دیگه', 'چندتا دیگه'],
+        'other': ['دیگه', 'دیگر'],
+        'similar': ['شبیه', 'مشابه', 'مثل این', 'مثل اون'],
+    },
+    patterns={
+        **FAST_ANSWERS.patterns,
+        # ✅ FIX 2: Detect author (the book asked about is the 'position' entity)
+        'ask_author': [
+            r'نویسنده\s+(کتاب\s+)?(?P<position>اول|دوم|سوم|چهارم|پنجم|آخر|اخر|۱|۲|۳|۴|۵|1|2|3|4|5)ی?\s*(کیه|چیه|است|هست)?',
+            r'(?P<position>اول|دوم|سوم|چهارم|پنجم|آخر|اخر|۱|۲|۳|۴|۵|1|2|3|4|5)ی?\s+نویسنده\s*اش?\s*(کیه|چیه)?',
+        ],
+    }
+)
+
+def is_followup_question(route, chat_id):
+    has_followup_keyword = route.has('followup', 'reference')
+    has_previous_results = len(sessions.peek(chat_id).result_ids) > 0
+    if has_followup_keyword and has_previous_results and route.word_count <= 10:
         return True
-    new_search_indicators = ['کتاب', 'نویسنده', 'شعر', 'داستان', 'رمان']
-    if any(indicator in query_lower for indicator in new_search_indicators):
-        if has_followup_keyword and ('دیگه' in query_lower or 'دیگر' in query_lower or 'باز' in query_lower):
-            return True
-        else:
-            return False
+    if route.has('new_search'):
+        return has_followup_keyword and route.has('other', 'again')
     return has_followup_keyword and has_previous_results
 
 
@@ -252,18 +474,19 @@ def filter_results_with_gpt(user_query, search_results, original_query=""):
 
 لیست کتاب‌ها:
 {books_text}
-
-فقط مرتبط‌ها را انتخاب کن.
-خروجی: شماره‌ها با کاما (مثل '1,3') یا 'هیچکدام'.
 """
     try:
-        response = openai_client.chat.completions.create(
+        answer = create_chat_completion(
+            openai_client,
+            [
+                {"role": "system", "content": FILTER_INSTRUCTIONS},
+                {"role": "user", "content": filter_prompt}
+            ],
             model="gpt-4o-mini",
-            messages=[{"role": "user", "content": filter_prompt}],
             max_tokens=100,
-            temperature=0.1
-        )
-        answer = response.choices[0].message.content.strip()
+            temperature=0.1,
+            stage="book.filter"
+        ).strip()
         if "هیچکدام" in answer.lower():
             return []
         numbers = re.findall(r'\b\d+\b', answer)
@@ -278,54 +501,59 @@ def filter_results_with_gpt(user_query, search_results, original_query=""):
         return search_results[:5]
 
 
+def find_candidates(query, depth):
+    """Ranked index rows for a query, found by words when it cannot be embedded"""
+    try:
+        query_vector = embedder.embed_query(query)
+    except CircuitOpen:
+        query_vector = None
+    if query_vector is None:
+        # Circuit open, or this embedding call failed before the breaker tripped
+        print("🔤 Embeddings unavailable, searching by words")
+        return handler.lexical_search(query, depth)
+    return embedder.search_vector(query_vector, depth)
+
+
 def search_books(query, k=None, distance_threshold=0.8, exclude_rows=None):
     if embedder is None:
         return []
     try:
-        results = embedder.search(query, k=k or 30)
+        depth = k or config.SEARCH_DEPTH
+        results = searches.do((normalize_query(query), depth), find_candidates, query, depth)
         enriched_results = []
         for r in results:
-            enriched = enrich_search_result(r)
+            enriched = enrich_search_result(dict(r))
             if enriched['distance'] < distance_threshold:
                 if exclude_rows is None or enriched['رديف'] not in exclude_rows:
                     enriched_results.append(enriched)
         print(f"📊 Search: '{query[:50]}...' → Result: {len(enriched_results)} ")
         return enriched_results[:k] if k else enriched_results[:10]
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         print(f"❌ Error in search: {e}")
         return []
 
 
-def generate_rag_response(user_query, chat_id):
-    clean_old_conversations()
+@bounded(config.REQUEST_DEADLINE, lambda: TIMEOUT_REPLY)
+def generate_rag_response(user_query, chat_id, on_delta=None):
+    route = ROUTER.route(user_query)
 
     # Greeting
-    greetings = ['سلام', 'درود', 'صبح بخیر', 'عصر بخیر', 'شب بخیر', 'خوبی', 'چطوری', 'حالت', 'hello', 'hi']
-    if any(greet in user_query.lower() for greet in greetings) and len(user_query.split()) <= 3:
+    if route.has('greeting') and route.word_count <= 3:
         return "سلام! 👋\n\nچطور می‌تونم کمکتون کنم؟\nمثال: کتاب‌های نیما یوشیج"
 
-    is_followup = is_followup_question(user_query, chat_id)
-    query_lower = user_query.lower()
-
-    # ✅ FIX 2: Detect author
-    asking_author_patterns = [
-        r'نویسنده\s+(کتاب\s+)?(اول|دوم|سوم|چهارم|پنجم|آخر|اخر|۱|۲|۳|۴|۵|1|2|3|4|5)ی?\s*(کیه|چیه|است|هست)?',
-        r'(اول|دوم|سوم|چهارم|پنجم|آخر|اخر|۱|۲|۳|۴|۵|1|2|3|4|5)ی?\s+نویسنده\s*اش?\s*(کیه|چیه)?',
-    ]
-
-    only_asking_author_name = (
-        any(re.search(pattern, query_lower) for pattern in asking_author_patterns) and
-        'معرفی' not in query_lower and
-        'بیشتر' not in query_lower and
-        'دیگه' not in query_lower and
-        'دیگر' not in query_lower
-    )
+    is_followup = is_followup_question(route, chat_id)
+    # Only fresh searches are cached; follow-ups depend on the conversation
+    cache_ids = None
+
+    only_asking_author_name = route.has('ask_author') and not route.has('introduce', 'more', 'other')
 
     if only_asking_author_name:
         print("\n" + "="*60)
         print("📝 Author's question")
 
-        shown_results = last_shown_results.get(chat_id, [])
+        shown_results = get_shown_results(chat_id)
 
         print(f"📋 Counts: {len(shown_results)}")
         for i, book in enumerate(shown_results, 1):
@@ -336,17 +564,7 @@ def generate_rag_response(user_query, chat_id):
             return "متأسفم، هنوز کتابی معرفی نکردم."
 
         # ✅ FIX 2: Correct diagnosis index
-        position = -1
-        if 'اول' in query_lower or '۱' in query_lower or '1' in query_lower:
-            position = 0
-        elif 'دوم' in query_lower or '۲' in query_lower or '2' in query_lower:
-            position = 1
-        elif 'سوم' in query_lower or '۳' in query_lower or '3' in query_lower:
-            position = 2
-        elif 'چهارم' in query_lower or '۴' in query_lower or '4' in query_lower:
-            position = 3
-        elif 'پنجم' in query_lower or '۵' in query_lower or '5' in query_lower:
-            position = 4
+        position = ordinal_of(route.entities['position'])
 
         print(f"🎯 Index: {position}")
 
@@ -371,38 +589,27 @@ def generate_rag_response(user_query, chat_id):
 
         return f"نویسنده کتاب «{title}»، «{author}» است."
 
+    # Publisher, year, call number... of a shown book: no search, no model call
+    if is_followup and not route.has('author_search', 'explain', 'introduce', 'more', 'again', 'repeat'):
+        fast_answer = FAST_ANSWERS.answer(route, get_shown_results(chat_id))
+        if fast_answer:
+            add_to_conversation(chat_id, "user", user_query)
+            add_to_conversation(chat_id, "assistant", fast_answer)
+            return fast_answer
 
     # Search for books by author
-    author_search_keywords = [
-        'از این نویسنده', 'از نویسنده', 'نویسنده این', 'کتاب های این نویسنده',
-        'کتاب دیگه از', 'کتاب اون نویسنده', 'نویسنده کتاب اول', 'نویسنده کتاب دوم',
-        'کتاب همون نویسنده', 'ازش کتاب', 'از اون نویسنده', 'نویسنده کتاب آخر',
-        'از نویسنده آخر', 'از نویسنده دوم', 'دوست دارم از نویسنده', 'دوس دارم از نویسنده',
-        'از نویسنده کتاب دوم', 'از نویسنده کتاب آخر', 'چندتا کتاب از نویسنده',
-        'کتاب دیگه ای داریم', 'این نویسنده کیه'
-    ]
-
     author_search_done = False
 
-    if is_followup and any(kw in query_lower for kw in author_search_keywords):
+    if is_followup and route.has('author_search'):
         print("📚 Author search request")
 
-        prev_results = last_shown_results.get(chat_id, get_last_search_results(chat_id))
+        prev_results = get_shown_results(chat_id) or get_last_search_results(chat_id)
 
         if prev_results and len(prev_results) > 0:
             print(f"   📋 Count: {len(prev_results)}")
 
             # book selection
-            if 'اول' in query_lower or '1' in query_lower or '۱' in query_lower:
-                target_book = prev_results[0]
-            elif 'دوم' in query_lower or '2' in query_lower or '۲' in query_lower:
-                target_book = prev_results[1] if len(prev_results) > 1 else prev_results[0]
-            elif 'سوم' in query_lower or '3' in query_lower or '۳' in query_lower:
-                target_book = prev_results[2] if len(prev_results) > 2 else prev_results[0]
-            elif 'آخر' in query_lower or 'اخر' in query_lower or 'آخرین' in query_lower:
-                target_book = prev_results[-1]
-            else:
-                target_book = prev_results[-1]
+            target_book = pick(prev_results, route.ordinal) or prev_results[0]
 
             print(f"   📖 Book: {target_book['عنوان'][:40]}...")
 
@@ -416,8 +623,8 @@ def generate_rag_response(user_query, chat_id):
 
             print(f"   👤 Author: {author_name}")
 
-            shown_results = last_shown_results.get(chat_id, [])
-            previous_row_ids = [r['رديف'] for r in shown_results]
+            # Books offered earlier in the conversation are not "other books" of the author
+            previous_row_ids = sessions.peek(chat_id).offered()
 
             search_results_raw = search_books(
                 f"نویسنده دقیق: {author_name}",
@@ -434,7 +641,9 @@ def generate_rag_response(user_query, chat_id):
 
             if search_results and len(search_results) > 0:
                 print(f"   ✅ {len(search_results)} کتاب از «{author_name}»")
+                prefetcher.cancel(chat_id)
                 save_search_results(chat_id, search_results, author_name)
+                save_cursor(chat_id, search_results)
                 author_search_done = True
                 is_followup = False
             else:
@@ -450,107 +659,71 @@ def generate_rag_response(user_query, chat_id):
         if not prev_results:
             return "متأسفم، نتایج قبلی پیدا نشد."
 
-        explain_keywords = ['شرح', 'توضیح', 'درباره', 'جزئیات', 'خلاصه', 'بیشتر بگو', 'معرفی کن']
-        is_explain_question = any(kw in query_lower for kw in explain_keywords)
-
-        if is_explain_question:
+        if route.has('explain') and not route.has('similar'):
             print("📖 Explanation question identified")
 
-            shown_results = last_shown_results.get(chat_id, [])
+            shown_results = get_shown_results(chat_id)
 
             if not shown_results:
                 return "متأسفم، هنوز کتابی معرفی نکردم."
 
-            selected_book = None
-            if 'اول' in query_lower or '۱' in query_lower or '1' in query_lower:
-                selected_book = shown_results[0] if len(shown_results) > 0 else None
-            elif 'دوم' in query_lower or '۲' in query_lower or '2' in query_lower:
-                selected_book = shown_results[1] if len(shown_results) > 1 else None
-            elif 'سوم' in query_lower or '۳' in query_lower or '3' in query_lower:
-                selected_book = shown_results[2] if len(shown_results) > 2 else None
-            elif 'آخر' in query_lower or 'اخر' in query_lower or 'این' in query_lower:
-                selected_book = shown_results[-1]
-            else:
-                selected_book = shown_results[-1]
+            selected_book = pick(shown_results, route.ordinal)
 
             if selected_book:
                 title = selected_book['عنوان']
-                author = selected_book.get('پديدآورنده', 'نامشخص')
-                publisher = selected_book.get('ناشر', 'نامشخص')
-                year = selected_book.get('تاريخ نشر', 'نامشخص')
-                subject = selected_book.get('موضوع', '')
 
                 print(f"   📖 کتاب: «{title[:40]}...»")
 
-                single_context = (
-                    f"عنوان: «{title}»\n"
-                    f"نویسنده: {author}\n"
-                    f"ناشر: {publisher}\n"
-                    f"سال: {year}\n"
-                    f"موضوع: {subject}"
-                )
-
-                history = get_conversation_history(chat_id, limit=5)
-                messages = [{"role": "system", "content": config.SYSTEM_PROMPT}]
-                for h in history:
-                    messages.append({"role": h["role"], "content": h["content"][:300]})
-
-                user_message = (
-                    f"کتاب:\n{single_context}\n\n"
-                    f"سوال: {user_query}\n\n"
-                    f"**دستور:** فقط درباره این کتاب توضیح بده. "
-                    f"یک پاراگراف کوتاه و مفید بنویس که این کتاب چیه و برای چه کسانی مناسبه."
-                )
-                messages.append({"role": "user", "content": user_message})
+                # Short, generic questions use the precomputed or prefetched explanation
+                explanation = None
+                if route.word_count <= 6:
+                    explanation = stored_explanation(selected_book['رديف'])
+                    prefetched = prefetcher.take(chat_id, 'explanation') if explanation is None else None
+                    if prefetched and prefetched[0] == selected_book['رديف']:
+                        explanation = prefetched[1]
 
                 try:
-                    response = openai_client.chat.completions.create(
-                        model=config.GPT_MODEL,
-                        messages=messages,
-                        max_tokens=500,
-                        temperature=0.7
-                    )
-                    explanation = response.choices[0].message.content
+                    explanation = explanation or explain_book(chat_id, selected_book, user_query, on_delta)
 
                     add_to_conversation(chat_id, "user", user_query)
                     add_to_conversation(chat_id, "assistant", explanation)
                     return explanation
 
+                except CircuitOpen:
+                    return handler.format_result(selected_book)
+
                 except Exception as e:
                     print(f"❌ Error in explanation: {e}")
                     return f"متأسفم، نتوانستم درباره «{title}» توضیح دهم."
 
-        if any(word in query_lower for word in ['بیشتر', 'باز', 'دوباره', 'چند تا دیگه', 'چندتا دیگه']):
-            # ✅ FIX 1: exclude from last_shown_results (not search_results_memory)
-            shown_results = last_shown_results.get(chat_id, [])
-            previous_row_ids = [r['رديف'] for r in shown_results]
-
-            print(f"📝 Count exclude: {len(previous_row_ids)}")
-            print(f"🚫 IDs: {previous_row_ids[:5]}...")
-
-            effective_query = last_query if last_query else query_lower
-            effective_query = re.sub(r'\b(باز|بیشتر|دوباره|چند تا دیگه|چندتا دیگه)\b', '', effective_query, flags=re.IGNORECASE).strip()
-
-            if not effective_query:
-                effective_query = last_query if last_query else "کتاب‌های مرتبط"
-
-            search_results_raw = search_books(
-                effective_query,
-                k=None,
-                distance_threshold=1.0,
-                exclude_rows=previous_row_ids  # ✅ exclude
-            )
-
-            search_results = filter_results_with_gpt(user_query, search_results_raw, last_query)
+        if route.has('more', 'again', 'repeat'):
+            # ✅ FIX 1: page through the last search, never repeating a book
+            shown_count = len(sessions.peek(chat_id).shown_ids)
+            search_results = next_results(chat_id)
 
-            # ✅ double-check for exclude
-            search_results = [r for r in search_results if r['رديف'] not in previous_row_ids]
+            print(f"📄 More: {len(search_results)} books from the cursor")
 
             if not search_results:
-                return f"متأسفم، کتاب جدیدی پیدا نکردم. 😔\n\n✅ قبلاً {len(shown_results)} کتاب معرفی کردم."
+                return f"متأسفم، کتاب جدیدی پیدا نکردم. 😔\n\n✅ قبلاً {shown_count} کتاب معرفی کردم."
 
             save_search_results(chat_id, search_results, last_query)
             is_followup = False
+        elif route.has('similar') and embedder.similar is not None:
+            # Neighbours from the similar-items graph; "more" pages through the rest
+            shown_results = get_shown_results(chat_id) or prev_results
+            target_book = pick(shown_results, route.ordinal) or shown_results[-1]
+            print(f"🕸️ Similar to: «{target_book['عنوان'][:40]}...»")
+
+            similar = similar_results(target_book['رديف'], {r['رديف'] for r in shown_results})
+            if not similar:
+                return f"متأسفم، کتاب مشابهی برای «{target_book['عنوان']}» پیدا نکردم."
+
+            prefetcher.cancel(chat_id)
+            save_cursor(chat_id, similar)
+            search_results = similar[:config.MORE_PAGE_SIZE]
+            save_search_results(chat_id, search_results, target_book['عنوان'])
+            set_shown_results(chat_id, search_results)
+            is_followup = False
         else:
             search_results = filter_results_with_gpt(user_query, prev_results, last_query)
             if not search_results:
@@ -560,23 +733,27 @@ def generate_rag_response(user_query, chat_id):
         # New search
         print(f"🔍 Search: {user_query}")
 
-        search_results_raw = search_books(user_query, k=None, distance_threshold=0.8)
+        # All ranked candidates go to the cursor; the best 10 are filtered for this answer
+        search_results_raw = search_books(user_query, k=config.SEARCH_DEPTH, distance_threshold=0.8)
 
         if not search_results_raw:
-            search_results_raw = search_books(user_query, k=None, distance_threshold=1.4)
+            search_results_raw = search_books(user_query, k=config.SEARCH_DEPTH, distance_threshold=1.4)
 
         if not search_results_raw:
             return "متأسفم، کتاب مرتبطی پیدا نکردم. 😔"
 
-        search_results = filter_results_with_gpt(user_query, search_results_raw, user_query)
+        search_results = filter_results_with_gpt(user_query, search_results_raw[:10], user_query)
 
         if not search_results:
             search_results = search_results_raw[:6]
 
+        prefetcher.cancel(chat_id)
+        save_cursor(chat_id, search_results_raw, offered=10)
         search_results = search_results[:10]
         save_search_results(chat_id, search_results, user_query)
+        cache_ids = [r['رديف'] for r in search_results]
 
-        last_shown_results[chat_id] = search_results[:6]
+        set_shown_results(chat_id, search_results[:6])
 
         print(f"💾 Save {len(search_results[:6])} Book:")
         for i, book in enumerate(search_results[:6], 1):
@@ -584,30 +761,37 @@ def generate_rag_response(user_query, chat_id):
 
     # Create context and send to GPT (no changes)
 
-    # Create context for GPT
+    # Create context for GPT (as many results as fit in the token budget)
     context_parts = []
     for r in search_results:
         context_parts.append(f"«{r['عنوان']}» — {r['پديدآورنده']}, {r['ناشر']}")
-    context = "\n".join(context_parts)
-
-    history = get_conversation_history(chat_id, limit=10)
-    messages = [{"role": "system", "content": config.SYSTEM_PROMPT}]
-    for h in history:
-        messages.append({"role": h["role"], "content": h["content"][:500]})
 
-    user_message = f"کتاب‌ها:\n{context}\n\nسوال: {user_query}"
-    messages.append({"role": "user", "content": user_message})
+    messages = context_builder.build(
+        chat_id,
+        get_conversation_history(chat_id, limit=None),
+        ANSWER_TEMPLATE,
+        context_parts,
+        query=user_query
+    )
+    # The history window and summary sent with the question are part of the key
+    cache_key = AnswerCache.make_key(user_query, cache_ids, ANSWER_PROMPT_VERSION, messages[1:-1]) if cache_ids else None
 
     try:
-        response = openai_client.chat.completions.create(
-            model=config.GPT_MODEL,
-            messages=messages,
-            max_tokens=1500,
-            temperature=0.1
-        )
-        assistant_response_raw = response.choices[0].message.content
+        assistant_response = answer_cache.get(cache_key) if cache_key else None
+
+        if assistant_response is None:
+            assistant_response_raw = create_chat_completion(
+                openai_client,
+                messages,
+                max_tokens=1500,
+                temperature=0.1,
+                on_delta=on_delta,
+                stage="book.answer"
+            )
 
-        assistant_response = format_book_output(assistant_response_raw, search_results)
+            assistant_response = format_book_output(assistant_response_raw, search_results)
+            if cache_key:
+                answer_cache.put(cache_key, assistant_response)
 
         mentioned_titles = re.findall(r'🔹 «([^»]+)»', assistant_response)
 
@@ -630,12 +814,20 @@ def generate_rag_response(user_query, chat_id):
                         break
 
             if shown_books:
-                last_shown_results[chat_id] = shown_books
+                set_shown_results(chat_id, shown_books)
 
                 print(f"\n💾 Update shown: {len(shown_books)} Book")
                 for i, book in enumerate(shown_books, 1):
                     print(f"   {i}. «{book['عنوان'][:40]}...»")
 
+        add_to_conversation(chat_id, "user", user_query)
+        add_to_conversation(chat_id, "assistant", assistant_response)
+        prefetch_next_turn(chat_id)
+        return assistant_response
+
+    except (DeadlineExceeded, CircuitOpen) as e:
+        # The books are found; only the model's answer is missing
+        assistant_response = results_only_reply(search_results, e)
         add_to_conversation(chat_id, "user", user_query)
         add_to_conversation(chat_id, "assistant", assistant_response)
         return assistant_response
@@ -670,10 +862,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def new_conversation_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    conversation_memory.pop(chat_id, None)
-    search_results_memory.pop(chat_id, None)
-    last_query_memory.pop(chat_id, None)
-    last_shown_results.pop(chat_id, None)
+    reset_conversation(chat_id)
     await update.message.reply_text(
         "✅ مکالمه جدید شروع شد!\n\n"
         "حالا می‌توانید سوال جدیدی بپرسید. 😊"
@@ -710,8 +899,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     await update.message.chat.send_action(action="typing")
-    response = generate_rag_response(user_message, chat_id)
-    await update.message.reply_text(response)
+    reply = StreamingReply(update.message)
+    reply.start()
+    try:
+        response = await asyncio.to_thread(generate_rag_response, user_message, chat_id, reply.push)
+        await reply.finish(response)
+    finally:
+        await reply.stop()
 
 
 def main():
@@ -725,6 +919,7 @@ def main():
 
     TELEGRAM_BOT_TOKEN = "YOUR_TELEGRAM_BOT_TOKEN_HERE"
     app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    schedule_expiry(app)
 
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("new", new_conversation_command))
@@ -4,7 +4,13 @@ import faiss
 import pickle
 import time
 from pathlib import Path
-from langchain_openai import OpenAIEmbeddings
+from knn_graph import KnnGraph, graph_path
+from llm_client import get_embeddings
+from deadline import DeadlineExceeded
+from circuit_breaker import CircuitOpen
+from micro_batch import embedding_batcher, search_batcher
+from answer_cache import normalize_query
+import single_flight
 
 
 OPENAI_API_KEY="YOUR_OPENAI_API_KEY_HERE"
@@ -34,15 +40,17 @@ class BookEmbedder:
         if api_key == "Place for API key":
             raise ValueError("❌ Please enter OpenAI API Key in book_embedder.py or config.py")
 
-        # Create embedding client
-        self.embedding_client = OpenAIEmbeddings(
-            model=EMBEDDING_MODEL,
-            openai_api_key=api_key
-        )
+        # Create embedding client (over the shared connection pool)
+        self.embedding_client = get_embeddings(EMBEDDING_MODEL, api_key)
 
         # FAISS index
         self.index = None
         self.metadata_map = {}  # Mapping ID to metadata
+        self.similar = None  # Similar-items graph (knn_graph.py), if built
+
+        # Concurrent queries are embedded and searched in batches
+        self._embed = embedding_batcher(self.embedding_client)
+        self._search = search_batcher(lambda: self.index)
 
         print("✅ Embedder is ready")
 
@@ -233,28 +241,42 @@ class BookEmbedder:
         with open(metadata_path, 'rb') as f:
             self.metadata_map = pickle.load(f)
 
+        # Load similar-items graph
+        similar_path = graph_path(index_path)
+        if Path(similar_path).exists():
+            self.similar = KnnGraph.load(similar_path)
+
         print(f"✅ Index loaded. Number of vectors: {self.index.ntotal}")
 
     def embed_query(self, query):
         try:
-            vector = self.embedding_client.embed_query(query)
+            # Students sending the same query at once share one embedding
+            vector = single_flight.shared("embedding").do(
+                (self.embedding_client.model, normalize_query(query)), self._embed, query
+            )
             return np.array([vector], dtype='float32')
+        except (DeadlineExceeded, CircuitOpen):
+            raise
         except Exception as e:
             print(f"❌ Error embedding query: {e}")
             return None
 
     def search(self, query, k=None):
-        if k is None:
-            k = TOP_K_RESULTS
-
         # embedding query
         query_vector = self.embed_query(query)
 
         if query_vector is None:
             return []
 
+        return self.search_vector(query_vector, k)
+
+    def search_vector(self, query_vector, k=None):
+        """Search with an embedded query (e.g. one shared by several indexes)"""
+        if k is None:
+            k = TOP_K_RESULTS
+
         # Search in FAISS
-        distances, indices = self.index.search(query_vector, k)
+        distances, indices = self._search((query_vector, k))
 
         # Extract metadata
         results = []
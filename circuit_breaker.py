@@ -0,0 +1,75 @@
+import threading
+import time
+import config
+import metrics
+
+
+class CircuitOpen(Exception):
+    """The service is failing; the call was not sent"""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a service that keeps failing.
+
+    After failure_threshold failures in a row the circuit opens and calls
+    fail at once with CircuitOpen, so the bots answer from what they have
+    locally. Every reset_timeout seconds one trial call is let through
+    (half-open): its success closes the circuit, its failure opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, name, failure_threshold=None, reset_timeout=None):
+        self.name = name
+        self.failure_threshold = failure_threshold or config.CIRCUIT_FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout or config.CIRCUIT_RESET_TIMEOUT
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a call may be sent now"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            # Also when the last trial call never reported back
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._opened_at = time.monotonic()
+                print(f"🔌 {self.name}: trying the service again")
+                return True
+            return False
+
+    def check(self, stage):
+        if not self.allow():
+            metrics.increment(f"{self.name}.circuit_rejected")
+            raise CircuitOpen(stage)
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.state != self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                print(f"✅ {self.name}: service is back, circuit closed")
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.failure_threshold):
+                if self.state == self.CLOSED:
+                    metrics.increment(f"{self.name}.circuit_opened")
+                    print(f"🔌 {self.name}: {self._failures} failures in a row, circuit open for {self.reset_timeout}s")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+# Shared by every bot: chat completions and query embeddings
+chat = CircuitBreaker("chat")
+embedding = CircuitBreaker("embedding")
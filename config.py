@@ -108,3 +108,225 @@ Context: [همان 3 کتاب]
 پاسخ درست: "با توجه به محتوا، [ردیف X] مناسب‌تر است چون..."
 پاسخ غلط: کتاب‌های جدید معرفی کند ❌
 """
+
+
+# Streaming answers: minimum seconds between two edits of the same Telegram message
+# (Telegram rate-limits edits, roughly one per second per chat is safe)
+STREAM_EDIT_INTERVAL = 1.2
+
+# Minimum number of new characters before an intermediate edit is sent
+STREAM_MIN_CHARS = 40
+
+
+# Answer cache for new book/thesis searches (number of answers kept per bot)
+ANSWER_CACHE_SIZE = 2000
+
+# Seconds a cached answer stays valid
+ANSWER_CACHE_TTL = 6 * 3600
+
+
+# Number of regulation chunks (articles) sent to the model per question
+REGULATIONS_TOP_K = 5
+
+# Semantic FAQ cache: cosine similarity needed to reuse an earlier answer
+REGULATIONS_FAQ_SIMILARITY = 0.93
+
+# Maximum number of cached regulations answers
+REGULATIONS_FAQ_CACHE_SIZE = 1000
+
+# Where cached regulations answers are kept between restarts
+REGULATIONS_FAQ_CACHE_PATH = "output/regulations/faq_cache.pkl"
+
+# Seconds between checks of the regulations files for changes (a JobQueue job
+# reloads them in the background; messages keep the loaded regulations)
+REGULATIONS_RELOAD_CHECK_INTERVAL = 60
+
+
+# Conversation history sent to the model starts at a multiple of this many
+# messages, so the prompt prefix stays the same for several turns (provider prompt caching)
+HISTORY_WINDOW_STEP = 4
+
+
+# Token budget of a whole prompt (system prompt, summary, history and results)
+CONTEXT_TOKEN_BUDGET = 4000
+
+# Part of the budget that conversation history (with its summary) may take
+HISTORY_TOKEN_BUDGET = 1200
+
+# Longer history messages are shortened at a sentence boundary
+MAX_HISTORY_MESSAGE_TOKENS = 300
+
+# Maximum length of the rolling summary of older turns
+SUMMARY_MAX_TOKENS = 250
+
+# Model that writes the rolling summaries, and threads updating them in the background
+SUMMARY_MODEL = "gpt-4o-mini"
+SUMMARY_WORKERS = 2
+
+
+# Where chat sessions (history, last results, mode) are kept: "sqlite" or "memory"
+SESSION_STORE = "sqlite"
+SESSION_DB_PATH = "output/sessions.db"
+
+# Seconds between batched writes of changed sessions to the store
+SESSION_FLUSH_INTERVAL = 2
+
+# Messages kept per book/thesis chat (older turns live on in the rolling summary)
+SESSION_HISTORY_SIZE = 40
+
+# Sessions unused for this many seconds are forgotten
+SESSION_MAX_IDLE = 7 * 24 * 3600
+
+# Seconds between two runs of the session expiry job
+SESSION_EXPIRY_INTERVAL = 600
+
+# Memory for the sessions of all bots together, in bytes as estimated by
+# ChatSession.approx_size() (result arrays, history and summary text); the
+# least recently used sessions are unloaded and read back from the store when
+# needed. SESSION_MAX_ACTIVE also bounds their number (each one has a fixed
+# cost the estimate leaves out).
+SESSION_MEMORY_BUDGET = 256 * 1024 * 1024
+SESSION_MAX_ACTIVE = 20000
+
+
+# Results offered per "more" (بیشتر) request, paged from the last search
+MORE_PAGE_SIZE = 6
+
+# Index neighbours fetched for a search; the cursor searches twice as deep when it runs out
+SEARCH_DEPTH = 30
+
+
+# Threads computing the likely next turn after an answer (next page, details, explanation)
+PREFETCH_WORKERS = 4
+
+# Seconds a prefetched result stays usable
+PREFETCH_TTL = 300
+
+# Also prefetch the explanation of the first shown result (one more model call per answer)
+PREFETCH_EXPLANATION = False
+
+
+# Explanations generated offline by `python explanation_store.py <collection>`
+EXPLANATION_DB_PATH = "output/explanations.db"
+
+# Requests per minute of the explanation batch job
+EXPLANATION_RATE_LIMIT = 60
+
+# Maximum length of a precomputed explanation
+EXPLANATION_MAX_TOKENS = 300
+
+
+# Neighbours kept per item in the similar-items graphs (python knn_graph.py)
+SIMILAR_ITEMS_K = 20
+
+# Stored vectors searched per batch while building the graphs
+KNN_BATCH_SIZE = 1024
+
+# Theses kept per book and books per thesis in the related tables (python knn_graph.py --related)
+RELATED_ITEMS_K = 10
+
+# Related items shown for a "پایان‌نامه‌های مرتبط" / "کتاب‌های مرتبط" follow-up
+RELATED_ITEMS_SHOWN = 5
+
+
+# Threads searching the collections of a "search everything" query in parallel
+RETRIEVAL_WORKERS = 4
+
+# Merged results shown in the "search everything" mode
+SEARCH_ALL_SHOWN = 8
+
+
+# Query embeddings requested within this window are sent as one embeddings call (1 = no batching)
+EMBED_BATCH_SIZE = 32
+EMBED_BATCH_WAIT_MS = 5
+
+# Same for FAISS searches of one index
+SEARCH_BATCH_SIZE = 64
+SEARCH_BATCH_WAIT_MS = 2
+
+# Telegram updates handled at once (messages of one chat still run in order)
+CONCURRENT_UPDATES = 16
+
+
+# Connection pool shared by all OpenAI calls (llm_client.get_http_client);
+# sized for the concurrent updates plus prefetch and batch workers
+HTTP_MAX_CONNECTIONS = 32
+HTTP_MAX_KEEPALIVE = 16
+HTTP_KEEPALIVE_EXPIRY = 60
+
+# Seconds allowed per OpenAI call (connect / whole request) and the client's own
+# retries (embeddings; chat calls follow RETRY_ATTEMPTS below)
+OPENAI_CONNECT_TIMEOUT = 5
+OPENAI_TIMEOUT = 30
+OPENAI_MAX_RETRIES = 2
+
+
+# Seconds to answer one message; a stage that would run past it gives way to a shorter reply
+REQUEST_DEADLINE = 40
+
+# Longest single call per stage (named by the part after the dot, e.g. 'book.filter');
+# other stages get OPENAI_TIMEOUT. 'prefetch' is the wait for a prefetched result still
+# running, after which the message does the work itself
+STAGE_BUDGETS = {
+    'embedding': 5,
+    'faiss': 2,
+    'search': 8,
+    'filter': 10,
+    'explain': 20,
+    'answer': 30,
+    'summary': 15,
+    'prefetch': 3,
+}
+
+# No stage is started with less time than this left
+MIN_STAGE_TIME = 1.0
+
+# Attempts per chat call on timeouts, rate limits and server errors (full-jitter backoff)
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+
+
+# Hedged requests: a call still unanswered after its stage's p95 latency is sent again
+# and the first answer wins (stages named as in STAGE_BUDGETS)
+HEDGE_ENABLED = True
+HEDGE_STAGES = ('embedding', 'answer')
+
+# At most this fraction of the calls of a stage is hedged
+HEDGE_MAX_RATIO = 0.05
+
+# Latency samples needed before a stage is hedged
+HEDGE_MIN_SAMPLES = 50
+
+# Threads running hedged requests
+HEDGE_WORKERS = 8
+
+
+# Failures in a row that open the chat / embedding circuit breaker; while it is open
+# the bots answer from search results alone and searches fall back to word matching
+CIRCUIT_FAILURE_THRESHOLD = 5
+
+# Seconds before a trial call is let through an open circuit
+CIRCUIT_RESET_TIMEOUT = 30
+
+
+# Admission control of OpenAI calls (admission.py): calls running at once and tokens
+# per minute, per service; keep under the account's rate limits
+CHAT_MAX_CONCURRENT = 8
+CHAT_TOKENS_PER_MINUTE = 200000
+EMBEDDING_MAX_CONCURRENT = 4
+EMBEDDING_TOKENS_PER_MINUTE = 1000000
+
+# Seconds of tokens that may be spent in one burst
+ADMISSION_BURST_SECONDS = 10
+
+# Calls waiting per service; further calls are rejected at once and the bots answer
+# without the model
+ADMISSION_QUEUE_LIMIT = 32
+
+# Seconds no call is started after a rate-limit error without Retry-After
+RATE_LIMIT_PAUSE = 2
+
+# Commands and menu buttons run in their own lane of this many updates; messages for
+# the model wait in line (up to UPDATE_QUEUE_LIMIT) for one of CONCURRENT_UPDATES slots
+PRIORITY_UPDATES = 8
+UPDATE_QUEUE_LIMIT = 64
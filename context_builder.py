@@ -0,0 +1,243 @@
+import contextvars
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import config
+import deadline
+import metrics
+from llm_client import create_chat_completion
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+    print("⚠️ tiktoken not installed, token counts are estimated")
+
+# Tokens the API adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = """
+خلاصه یک گفتگو بین کاربر و دستیار کتابخانه را به‌روز کن.
+خلاصه فعلی و پیام‌های جدید داده می‌شود. خلاصه جدید را در چند جمله کوتاه فارسی بنویس:
+موضوع‌هایی که کاربر دنبال کرده، منابعی که معرفی شده (با عنوان) و هر ترجیح یا محدودیتی که گفته است.
+فقط خلاصه را بنویس.
+"""
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    if not TIKTOKEN_AVAILABLE:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # The encoding files are downloaded on first use
+        print(f"⚠️ Tokenizer unavailable, token counts are estimated: {e}")
+        return None
+
+
+def count_tokens(text, model=None):
+    """Number of tokens in text (estimated if no tokenizer is available)"""
+    if not text:
+        return 0
+    encoding = _encoding(model or config.GPT_MODEL)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return len(text) // 3 + 1
+
+
+def count_message_tokens(messages, model=None):
+    return sum(count_tokens(m["content"], model) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def shorten(text, max_tokens):
+    """
+    Cut text to max_tokens, at the end of a sentence or line if one is in
+    the last two thirds of the kept text, else after a whole word with "…".
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    # Rough cut by characters first, then back off to a sentence boundary
+    cut = text[:max(1, len(text) * max_tokens // count_tokens(text))]
+    while count_tokens(cut) > max_tokens:
+        cut = cut[:int(len(cut) * 0.9)]
+    boundary = max(cut.rfind(c) for c in ('.', '؟', '?', '!', '\n'))
+    if boundary > len(cut) // 3:
+        return cut[:boundary + 1].rstrip()
+    return cut.rsplit(' ', 1)[0] + " …"
+
+
+def fit_lines(lines, max_tokens, separator="\n"):
+    """The leading lines (results are ranked) that fit in max_tokens"""
+    kept, used = [], 0
+    for line in lines:
+        tokens = count_tokens(line + separator)
+        if kept and used + tokens > max_tokens:
+            break
+        kept.append(line)
+        used += tokens
+    if len(kept) < len(lines):
+        print(f"✂️ Context: kept {len(kept)}/{len(lines)} results within {max_tokens} tokens")
+    return kept
+
+
+def stable_history_window(history, limit, step=None):
+    """
+    The last messages of a conversation, at most limit of them.
+
+    history[-limit:] moves by one message every turn, which changes
+    everything after the system prompt and defeats provider prompt caching.
+    Here the window start only moves in steps, so consecutive turns share
+    the same prefix.
+    """
+    if limit <= 0:
+        return []
+    step = max(1, min(step or config.HISTORY_WINDOW_STEP, limit))
+    start = max(0, len(history) - limit)
+    aligned_start = -(-start // step) * step
+    return history[aligned_start:]
+
+
+# Summary updates of all bots run here, in the background
+_summary_executor = ThreadPoolExecutor(max_workers=config.SUMMARY_WORKERS, thread_name_prefix="summary")
+
+
+class RollingSummary:
+    """
+    Per-chat summary of the turns that no longer fit in the history window.
+
+    Messages leaving the window are folded into the summary in the
+    background, so answering never waits for it. Messages are tracked by
+    timestamp, so trimming the conversation memory does not confuse it.
+    The summary is kept in the chat's session: it is saved with it, and
+    goes when the session is reset or expires.
+    """
+
+    def __init__(self, name, client, sessions):
+        self.name = name
+        self.client = client
+        self.sessions = sessions
+        self._updating = set()
+        self._lock = threading.Lock()
+
+    def get(self, chat_id):
+        return self.sessions.peek(chat_id).summary
+
+    def fold(self, chat_id, messages):
+        """Schedule folding of messages that left the history window"""
+        session = self.sessions.peek(chat_id)
+        folded_until = session.summary_until
+        new_messages = [m for m in messages if folded_until is None or m["timestamp"] > folded_until]
+        with self._lock:
+            if not new_messages or chat_id in self._updating:
+                return
+            self._updating.add(chat_id)
+
+        # Charged to the chat, without the deadline of the message that started it
+        _summary_executor.submit(
+            contextvars.copy_context().run, self._update, chat_id, session, new_messages
+        )
+
+    def _update(self, chat_id, session, new_messages):
+        deadline.clear()
+        summary = session.summary
+        transcript = "\n".join(
+            f"{'کاربر' if m['role'] == 'user' else 'دستیار'}: {shorten(m['content'], config.MAX_HISTORY_MESSAGE_TOKENS)}"
+            for m in new_messages
+        )
+        try:
+            updated = create_chat_completion(
+                self.client,
+                [
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": f"خلاصه فعلی:\n{summary or '-'}\n\nپیام‌های جدید:\n{transcript}"}
+                ],
+                model=config.SUMMARY_MODEL,
+                max_tokens=config.SUMMARY_MAX_TOKENS,
+                temperature=0.2,
+                stage=f"{self.name}.summary"
+            ).strip()
+            # Dropped if the conversation was reset (or unloaded) meanwhile
+            if self.sessions.peek(chat_id) is session:
+                session = self.sessions.get(chat_id)
+                session.summary = updated
+                session.summary_until = new_messages[-1]["timestamp"]
+            print(f"📝 {self.name}: folded {len(new_messages)} messages into the summary")
+        except Exception as e:
+            print(f"⚠️ Error updating {self.name} summary: {e}")
+        finally:
+            with self._lock:
+                self._updating.discard(chat_id)
+
+
+class ContextBuilder:
+    """
+    Fits system prompt, history and retrieved results into a token budget.
+
+    Messages are ordered from the most stable part to the most variable
+    one: system prompt, history window, summary of older turns (rewritten
+    in the background every few turns), then the question with its
+    results, so the cached prompt prefix survives summary updates.
+    History gets at most HISTORY_TOKEN_BUDGET; results get what is left
+    of CONTEXT_TOKEN_BUDGET, best ranked first.
+    """
+
+    def __init__(self, name, system_prompt, summary=None, history_limit=10,
+                 token_budget=None, history_budget=None):
+        self.name = name
+        self.system_prompt = system_prompt
+        self.summary = summary
+        self.history_limit = history_limit
+        self.token_budget = token_budget or config.CONTEXT_TOKEN_BUDGET
+        self.history_budget = history_budget or config.HISTORY_TOKEN_BUDGET
+
+    def history_messages(self, chat_id, history):
+        """History window, then the summary of the turns before it"""
+        summary_messages = []
+        summary = self.summary.get(chat_id) if self.summary and chat_id is not None else ""
+        if summary:
+            summary_messages.append({"role": "system", "content": f"خلاصه گفتگوی قبلی با کاربر:\n{summary}"})
+
+        window = stable_history_window(history or [], self.history_limit)
+        window = [
+            {"role": h["role"], "content": shorten(h["content"], config.MAX_HISTORY_MESSAGE_TOKENS)}
+            for h in window
+        ]
+        # Drop whole steps from the start until the window fits
+        step = config.HISTORY_WINDOW_STEP
+        budget = self.history_budget - count_message_tokens(summary_messages)
+        while window and count_message_tokens(window) > budget:
+            window = window[step:]
+
+        older = (history or [])[:len(history or []) - len(window)]
+        if self.summary and older and chat_id is not None:
+            self.summary.fold(chat_id, older)
+        return window + summary_messages
+
+    def build(self, chat_id, history, template, result_lines=(), separator="\n", **fields):
+        """
+        Chat messages for one question.
+
+        template is formatted with the fitted results as {context} and the
+        other keyword fields (e.g. query).
+        """
+        messages = [{"role": "system", "content": self.system_prompt}]
+        messages.extend(self.history_messages(chat_id, history))
+
+        fixed_tokens = (
+            count_message_tokens(messages)
+            + count_tokens(template.format(context="", **fields))
+            + MESSAGE_OVERHEAD_TOKENS
+        )
+        lines = fit_lines(list(result_lines), max(0, self.token_budget - fixed_tokens), separator)
+        messages.append({"role": "user", "content": template.format(context=separator.join(lines), **fields)})
+
+        prompt_tokens = count_message_tokens(messages)
+        metrics.observe(f"{self.name}.prompt_tokens", prompt_tokens)
+        print(f"📐 {self.name}: {prompt_tokens} prompt tokens ({len(lines)} results, {len(messages) - 2} history messages)")
+        return messages
@@ -0,0 +1,108 @@
+import contextvars
+import functools
+import random
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
+import config
+import metrics
+
+
+class DeadlineExceeded(Exception):
+    """The message ran out of time before a stage could start or finish"""
+
+
+class Deadline:
+    """
+    Time left to answer one user message.
+
+    bounded() sets it for a bot's entry point and the stages read it from
+    the context: each external call gets the smaller of its stage budget
+    and the time left as its timeout, and retries only happen while there
+    is time for them. Background work (prefetch, batch jobs) runs without a
+    deadline, with the stage budgets alone.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+
+_current = contextvars.ContextVar('deadline', default=None)
+
+
+def current():
+    return _current.get()
+
+
+def clear():
+    """Run the rest of the current context without a deadline (background work started by a message)"""
+    _current.set(None)
+
+
+def timeout_for(stage):
+    """Timeout of one call of a stage ('book.answer' has the 'answer' budget)"""
+    budget = config.STAGE_BUDGETS.get(stage.rsplit('.', 1)[-1], config.OPENAI_TIMEOUT)
+    deadline = _current.get()
+    if deadline is None:
+        return budget
+    remaining = deadline.remaining()
+    if remaining < config.MIN_STAGE_TIME:
+        metrics.increment(f"{stage}.deadline_exceeded")
+        raise DeadlineExceeded(stage)
+    return min(budget, remaining)
+
+
+def wait(future, stage):
+    """Result of work shared with other callers, waited for no longer than the stage may take"""
+    try:
+        return future.result(timeout=timeout_for(stage))
+    except FutureTimeout:
+        metrics.increment(f"{stage}.deadline_exceeded")
+        raise DeadlineExceeded(stage) from None
+
+
+def retry(fn, stage, retryable, can_retry=lambda: True):
+    """
+    fn(timeout), retried on retryable errors with full-jitter exponential
+    backoff, up to config.RETRY_ATTEMPTS attempts and only while the
+    deadline leaves time for another one.
+    """
+    for attempt in range(1, config.RETRY_ATTEMPTS + 1):
+        try:
+            return fn(timeout_for(stage))
+        except retryable as e:
+            delay = random.uniform(0, config.RETRY_BASE_DELAY * 2 ** attempt)
+            deadline = _current.get()
+            if deadline and deadline.remaining() - delay < config.MIN_STAGE_TIME:
+                metrics.increment(f"{stage}.deadline_exceeded")
+                raise DeadlineExceeded(stage) from e
+            if attempt == config.RETRY_ATTEMPTS or not can_retry():
+                raise
+            print(f"🔁 {stage}: {type(e).__name__}, retrying in {delay:.1f}s")
+            metrics.increment(f"{stage}.retry")
+            time.sleep(delay)
+
+
+def bounded(seconds, on_timeout):
+    """
+    Run the decorated function under a new deadline of `seconds`.
+
+    If a stage runs out of time, the function's reply is on_timeout(), a
+    shorter answer than a hung request.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            token = _current.set(Deadline(seconds))
+            try:
+                return fn(*args, **kwargs)
+            except DeadlineExceeded as e:
+                print(f"⏳ Deadline reached at '{e}'")
+                return on_timeout()
+            finally:
+                _current.reset(token)
+        return wrapper
+    return decorator
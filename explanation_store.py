@@ -0,0 +1,238 @@
+import argparse
+import pickle
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+import config
+import metrics
+from answer_cache import prompt_version
+
+EXPLAIN_PROMPT = """
+شما دستیار کتابخانه دانشگاه خوارزمی هستید.
+فقط بر اساس مشخصات داده‌شده، در یک پاراگراف کوتاه فارسی بگو این {noun} درباره چیست و برای چه کسانی مناسب است.
+اگر مشخصات کافی نیست، چیزی از خودت نساز.
+"""
+
+# Collections with precomputed explanations: where their rows come from and
+# which fields (label, column) describe a row
+COLLECTIONS = {
+    'book': {
+        'noun': 'کتاب',
+        'excel': "output/final_normalize.xlsx",
+        'fields': [
+            ('عنوان', 'عنوان'), ('نویسنده', 'پديدآورنده'), ('ناشر', 'ناشر'),
+            ('سال', 'تاريخ نشر'), ('موضوع', 'موضوع'),
+        ],
+    },
+    'thesis': {
+        'noun': 'پایان‌نامه',
+        'excel': "output/theses/theses_normalized.xlsx",
+        'fields': [
+            ('عنوان', 'عنوان'), ('پژوهشگر', 'نویسنده'), ('استاد راهنما', 'استاد راهنما'),
+            ('مقطع', 'مقطع'), ('رشته', 'رشته تحصیلی'), ('سال', 'سال'), ('کلیدواژه', 'کلیدواژه'),
+        ],
+    },
+}
+
+
+def collection_version(collection):
+    """Explanations generated with other prompts or fields are not served"""
+    spec = COLLECTIONS[collection]
+    return prompt_version(EXPLAIN_PROMPT, spec['noun'], *(column for _, column in spec['fields']))
+
+
+def describe(item, fields):
+    """The metadata of one row as sent to the model"""
+    lines = []
+    for label, column in fields:
+        value = str(item.get(column) or '').strip()
+        if value and value.lower() not in ('nan', 'none'):
+            lines.append(f"{label}: {value}")
+    return "\n".join(lines)
+
+
+class ExplanationStore:
+    """
+    Short explanations of catalogue items, by collection and row id.
+
+    Written by the batch job of this module and read by the bots, which
+    serve them for generic "توضیح / شرح / درباره" follow-ups instead of a
+    live model call.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or config.EXPLANATION_DB_PATH
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS explanations (
+                collection TEXT NOT NULL,
+                row_id INTEGER NOT NULL,
+                version TEXT NOT NULL,
+                text TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (collection, row_id)
+            )
+        """)
+        self._conn.commit()
+        self._versions = {name: collection_version(name) for name in COLLECTIONS}
+
+    def get(self, collection, row_id):
+        """The stored explanation of a row, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text FROM explanations WHERE collection = ? AND row_id = ? AND version = ?",
+                (collection, int(row_id), self._versions[collection])
+            ).fetchone()
+        metrics.increment(f"{collection}.explanation_{'hit' if row else 'miss'}")
+        return row[0] if row else None
+
+    def stored_ids(self, collection):
+        """Row ids that already have a current explanation (skipped when resuming)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row_id FROM explanations WHERE collection = ? AND version = ?",
+                (collection, self._versions[collection])
+            ).fetchall()
+        return {row_id for row_id, in rows}
+
+    def put(self, collection, row_id, text):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO explanations (collection, row_id, version, text, created_at) VALUES (?, ?, ?, ?, ?)",
+                (collection, int(row_id), self._versions[collection], text, time.time())
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_explanation_store():
+    """The explanation store shared by the bots, or None if it cannot be opened"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            try:
+                _store = ExplanationStore()
+            except Exception as e:
+                print(f"⚠️ Explanation store unavailable: {e}")
+                _store = False
+        return _store or None
+
+
+def frequently_shown(collection, limit):
+    """Row ids shown most often in the saved chat sessions of a collection"""
+    if not Path(config.SESSION_DB_PATH).exists():
+        print(f"⚠️ No chat sessions in {config.SESSION_DB_PATH}")
+        return []
+    counts = Counter()
+    conn = sqlite3.connect(config.SESSION_DB_PATH)
+    try:
+        for data, in conn.execute("SELECT data FROM sessions WHERE namespace = ?", (collection,)):
+            try:
+                session = pickle.loads(data)
+            except Exception:
+                continue
+            counts.update(getattr(session, 'shown_ids', ()))
+            counts.update(getattr(session, 'result_ids', ()))
+    finally:
+        conn.close()
+    return [row_id for row_id, _ in counts.most_common(limit)]
+
+
+def load_rows(collection):
+    """Details loader and a function returning the row of an id"""
+    spec = COLLECTIONS[collection]
+    if collection == 'book':
+        from book_details import BookDetailsLoader
+        loader = BookDetailsLoader(spec['excel'])
+        return list(loader.df.index), loader.get_book_details
+    from thesis_details import ThesisDetailsLoader
+    loader = ThesisDetailsLoader(spec['excel'])
+    return list(loader.df.index), loader.get_thesis_details
+
+
+def generate(store, client, collection, row_ids, get_row, model, rate_limit, limit=None):
+    """
+    Explain the rows that have no current explanation yet.
+
+    Every explanation is committed as soon as it is generated, so an
+    interrupted run continues where it stopped. Requests are spaced to stay
+    under rate_limit per minute.
+    """
+    from llm_client import create_chat_completion
+
+    spec = COLLECTIONS[collection]
+    system_prompt = EXPLAIN_PROMPT.format(noun=spec['noun'])
+    done = store.stored_ids(collection)
+    pending = [row_id for row_id in row_ids if int(row_id) not in done][:limit]
+    interval = 60.0 / rate_limit
+    print(f"📝 {collection}: {len(pending)} to explain ({len(done)} already stored)")
+
+    generated = failed = 0
+    for i, row_id in enumerate(pending, 1):
+        started = time.monotonic()
+        item = get_row(row_id)
+        if not item:
+            continue
+        try:
+            text = create_chat_completion(
+                client,
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": describe(item, spec['fields'])}
+                ],
+                model=model,
+                max_tokens=config.EXPLANATION_MAX_TOKENS,
+                temperature=0.3,
+                stage=f"{collection}.explanation_batch"
+            ).strip()
+            store.put(collection, row_id, text)
+            generated += 1
+        except Exception as e:
+            print(f"⚠️ Row {row_id}: {e}")
+            failed += 1
+
+        if i % 50 == 0:
+            print(f"   {i}/{len(pending)} ({generated} stored, {failed} failed)")
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    print(f"✅ {collection}: {generated} explanations stored, {failed} failed")
+
+
+if __name__ == "__main__":
+    from llm_client import get_openai_client
+
+    parser = argparse.ArgumentParser(description="Generate explanations of catalogue items offline")
+    parser.add_argument("collection", choices=sorted(COLLECTIONS))
+    parser.add_argument("--shown", type=int, metavar="N", help="only the N items shown most often in chat sessions")
+    parser.add_argument("--limit", type=int, help="explain at most this many items in this run")
+    parser.add_argument("--rate", type=float, default=config.EXPLANATION_RATE_LIMIT, help="requests per minute")
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--base-url", help="OpenAI-compatible endpoint, e.g. a local stand-in for testing")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"🧠 Precomputing {args.collection} explanations")
+    print("=" * 60)
+
+    all_ids, get_row = load_rows(args.collection)
+    row_ids = frequently_shown(args.collection, args.shown) if args.shown else all_ids
+
+    client = get_openai_client(config.OPENAI_API_KEY or "local", args.base_url)
+    store = ExplanationStore()
+    try:
+        generate(store, client, args.collection, row_ids, get_row, args.model, args.rate, args.limit)
+    except KeyboardInterrupt:
+        print("\n⚠️ Stopped; run again to continue")
+    finally:
+        store.close()
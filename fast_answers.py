@@ -0,0 +1,139 @@
+import re
+import metrics
+from intent_router import DIGITS, ordinal_of, pick
+
+# "Which one is newer / older?"
+WHICH_WORDS = ['کدوم', 'کدام']
+NEWER_WORDS = ['جدیدتر', 'جدید تر', 'تازه‌تر', 'تازه تر']
+OLDER_WORDS = ['قدیمی‌تر', 'قدیمی تر', 'قدیمیتر']
+
+# Longest follow-up (in words) answered from metadata, and longest "which is newer"
+MAX_WORDS = 8
+MAX_COMPARE_WORDS = 4
+
+# Whole-word boundaries; a zero-width non-joiner (as in "کتاب‌ها") continues the word
+WORD_START = r'(?<![\w\u200c])'
+WORD_END = r'(?![\w\u200c])'
+POSITIONS = r'اول|دوم|سوم|چهارم|پنجم|ششم|آخر|اخر|[1-9۱-۹١-٩]'
+
+YEAR = re.compile(r'(?<![0-9])([12][0-9]{3})(?![0-9])')
+
+
+def whole_words(words):
+    """Expression matching any of words, only as whole words"""
+    alternatives = '|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+    return f'{WORD_START}(?:{alternatives}){WORD_END}'
+
+
+def parse_year(value):
+    """Solar year of a date field ('۱۳۹۸', '1398/05/01', '2019'), or None"""
+    match = YEAR.search(str(value or '').translate(DIGITS))
+    if not match:
+        return None
+    year = int(match.group(1))
+    return year - 621 if year > 1700 else year
+
+
+class FastAnswers:
+    """
+    Answers follow-ups about shown items from their metadata alone.
+
+    "ناشر کتاب آخر", "سال انتشار دومی" or "کدوم جدیدتره" need no search and
+    no model call: the fields are read from the shown results. fields maps
+    a name to (label, result keys, words); the words are matched as whole
+    words by the 'field:<name>' patterns added to the bot's IntentRouter,
+    next to the 'reference' pattern naming a shown item ("کتاب دوم",
+    "اولی", "این کتاب"; its position is the 'position' entity).
+    """
+
+    def __init__(self, name, noun, fields, year_keys):
+        self.name = name
+        self.noun = noun
+        self.fields = fields
+        self.year_keys = year_keys
+
+    @property
+    def keywords(self):
+        return {'which': WHICH_WORDS, 'newer': NEWER_WORDS, 'older': OLDER_WORDS}
+
+    @property
+    def patterns(self):
+        noun = re.escape(self.noun).replace('\u200c', '[\u200c ]?')
+        groups = {f'field:{name}': [whole_words(words)] for name, (_, _, words) in self.fields.items()}
+        groups['reference'] = [
+            rf'{WORD_START}(?:{noun}|مورد|شماره)\s+(?P<position>{POSITIONS})ی?{WORD_END}',
+            rf'{WORD_START}(?P<position>(?:{POSITIONS})ی){WORD_END}',
+            rf'{WORD_START}(?:این|اون|همین|همون|آن)\s+{noun}{WORD_END}',
+        ]
+        return groups
+
+    @staticmethod
+    def _title(item):
+        return item.get('عنوان') or item.get('عنوان پایان‌نامه', '')
+
+    def _value(self, item, keys):
+        for key in keys:
+            value = str(item.get(key) or '').strip()
+            if value and value.lower() not in ('nan', 'none', 'نامشخص'):
+                return value
+        return 'نامشخص'
+
+    def _year(self, item):
+        for key in self.year_keys:
+            if (year := parse_year(item.get(key))) is not None:
+                return year
+        return None
+
+    def answer(self, route, items):
+        """
+        Reply for a metadata follow-up about items, or None if it is not one.
+
+        Only messages naming a shown item count (or a short "which is
+        newer"): "کتاب‌های انتشارات سمت" is a new search, not a question
+        about the last results.
+        """
+        if not items or route.word_count > MAX_WORDS:
+            return None
+
+        if route.has('which') and route.has('newer', 'older') and route.word_count <= MAX_COMPARE_WORDS:
+            reply = self._compare(items, newest=route.has('newer'))
+        else:
+            asked = [name for name in self.fields if route.has(f'field:{name}')]
+            if not asked or not route.has('reference'):
+                return None
+            position = route.entities.get('position')
+            reply = self._fields(items, ordinal_of(position) if position else None, asked)
+
+        metrics.increment(f"{self.name}.fast_answer")
+        print(f"⚡ {self.name}: answered from metadata")
+        return reply
+
+    def _fields(self, items, ordinal, asked):
+        if ordinal is not None:
+            item = pick(items, ordinal)
+            if item is None:
+                return f"متأسفم، من فقط {len(items)} {self.noun} معرفی کردم."
+            items = [item]
+
+        blocks = []
+        for item in items:
+            lines = [f"🔹 «{self._title(item)}»"]
+            for name in asked:
+                label, keys, _ = self.fields[name]
+                lines.append(f"   {label}: {self._value(item, keys)}")
+            blocks.append("\n".join(lines))
+        return "\n\n".join(blocks)
+
+    def _compare(self, items, newest):
+        dated = [(year, item) for item in items if (year := self._year(item)) is not None]
+        if not dated:
+            return f"متأسفم، سال {self.noun}‌های معرفی‌شده در سیستم ثبت نشده است."
+
+        # Sorted by solar year, shown with the dates as recorded
+        dated.sort(key=lambda pair: pair[0], reverse=newest)
+        item = dated[0][1]
+        lines = [f"{'جدیدترین' if newest else 'قدیمی‌ترین'} {self.noun}: «{self._title(item)}» ({self._value(item, self.year_keys)})", ""]
+        lines += [f"{i}. «{self._title(item)}» — {self._value(item, self.year_keys)}" for i, (_, item) in enumerate(dated, 1)]
+        if len(dated) < len(items):
+            lines.append(f"\n(سال {len(items) - len(dated)} {self.noun} ثبت نشده است)")
+        return "\n".join(lines)
@@ -0,0 +1,120 @@
+import contextvars
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import config
+import deadline
+import metrics
+
+# Only the second requests run here; with every worker busy no hedge is sent
+_executor = ThreadPoolExecutor(max_workers=config.HEDGE_WORKERS, thread_name_prefix="hedge")
+_hedge_slots = threading.BoundedSemaphore(config.HEDGE_WORKERS)
+
+
+class HedgeLost(Exception):
+    """The other request of a hedged call answered first"""
+
+
+def stage_kind(stage):
+    return stage.rsplit('.', 1)[-1]
+
+
+def hedge_delay(stage, metric):
+    """
+    How long to wait before hedging a call of stage, or None to not hedge it.
+
+    The delay is the observed p95 of metric; calls are hedged only for the
+    stages in config.HEDGE_STAGES, once enough samples are known, and while
+    hedges stay under config.HEDGE_MAX_RATIO of the calls.
+    """
+    if not config.HEDGE_ENABLED or stage_kind(stage) not in config.HEDGE_STAGES:
+        return None
+    if metrics.sample_count(metric) < config.HEDGE_MIN_SAMPLES:
+        return None
+    calls = metrics.get_counter(f"{stage}.hedge_calls")
+    if metrics.get_counter(f"{stage}.hedge_sent") >= config.HEDGE_MAX_RATIO * calls:
+        return None
+    return metrics.percentile(metric, 95)
+
+
+def _start(name, fn, *args):
+    # fn(*args) on a thread of its own, so callers never wait for a pool worker
+    future = Future()
+
+    def target():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, name=name, daemon=True).start()
+    return future
+
+
+def hedged(stage, call, metric=None):
+    """
+    call(claim), with a second identical request if the first is slow.
+
+    If the first request has not answered after the p95 latency of its
+    stage, the same request is sent again and the first answer wins. claim()
+    tells a request whether it is the winner: a request calls it when it has
+    its answer, or when it starts delivering it (the first streamed token),
+    and stops if it returns False. The losing request finishes in the
+    background and is ignored.
+
+    The first request runs on a thread of its own, as many at once as there
+    are callers; the caller waits for whichever request wins. Second requests
+    share config.HEDGE_WORKERS threads, and none is sent while all are busy.
+    """
+    metrics.increment(f"{stage}.hedge_calls")
+    delay = hedge_delay(stage, metric or f"{stage}.latency")
+    if delay is None:
+        return call(lambda: True)
+
+    winner = []
+    lock = threading.Lock()
+
+    def run(attempt):
+        def claim():
+            with lock:
+                if not winner:
+                    winner.append(attempt)
+                return winner[0] == attempt
+
+        result = call(claim)
+        if not claim():
+            raise HedgeLost()
+        return result
+
+    # Both requests keep the caller's deadline
+    primary = _start(f"{stage}-primary", contextvars.copy_context().run, run, 'primary')
+    done, _ = wait([primary], timeout=delay)
+    current = deadline.current()
+    if done or (current is not None and current.remaining() < delay + config.MIN_STAGE_TIME):
+        return primary.result()
+
+    if not _hedge_slots.acquire(blocking=False):
+        metrics.increment(f"{stage}.hedge_skipped")
+        return primary.result()
+
+    metrics.increment(f"{stage}.hedge_sent")
+    print(f"🪁 {stage}: no answer after {delay:.2f}s (p95), sending a hedged request")
+    hedge = _executor.submit(contextvars.copy_context().run, run, 'hedge')
+    hedge.add_done_callback(lambda _: _hedge_slots.release())
+
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except HedgeLost:
+                continue
+            except Exception as e:
+                error = error or e
+                continue
+            if future is hedge:
+                metrics.increment(f"{stage}.hedge_win")
+                print(f"🪁 {stage}: the hedged request won")
+            return result
+    raise error
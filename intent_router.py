@@ -0,0 +1,190 @@
+import re
+import time
+from collections import deque
+
+# Positions named in follow-ups ("کتاب دوم", "نویسنده آخری"); -1 is the last one
+ORDINAL_WORDS = {
+    'اول': 0, 'دوم': 1, 'سوم': 2, 'چهارم': 3, 'پنجم': 4, 'ششم': 5,
+    'آخر': -1, 'اخر': -1, 'آخرین': -1,
+}
+
+# A lone digit (any script) used as a position: "کتاب 2"
+ORDINAL_DIGIT = re.compile(r'(?<![0-9۰-۹٠-٩])([1-9۱-۹١-٩])(?![0-9۰-۹٠-٩])')
+DIGITS = str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
+
+
+def ordinal_of(word):
+    """Position named by an ordinal word or digit ('دوم', 'آخری', '۲'), or None"""
+    word = word.translate(DIGITS)
+    if word.isdigit():
+        return int(word) - 1
+    if word not in ORDINAL_WORDS and word.endswith('ی'):
+        word = word[:-1]
+    return ORDINAL_WORDS.get(word)
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over labelled keywords.
+
+    One pass over the text finds every keyword occurring in it (the same
+    as testing `keyword in text` for each keyword), however many keywords
+    there are.
+    """
+
+    def __init__(self, labelled_keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [set()]
+
+        for keyword, label in labelled_keywords:
+            node = 0
+            for char in keyword:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(set())
+                node = next_node
+            self._output[node].add(label)
+
+        # Breadth-first construction of failure links
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] |= self._output[self._fail[child]]
+
+    def find(self, text):
+        """Labels of all keywords occurring in text"""
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found |= output[node]
+        return found
+
+
+class Route:
+    """Result of routing one message"""
+
+    __slots__ = ('text', 'flags', 'ordinal', 'entities', 'word_count')
+
+    def __init__(self, text, flags, ordinal, entities, word_count):
+        self.text = text
+        self.flags = flags          # names of the keyword groups and patterns that matched
+        self.ordinal = ordinal      # position named in the message (-1 = last), or None
+        self.entities = entities    # named groups captured by the patterns
+        self.word_count = word_count
+
+    def has(self, *names):
+        return any(name in self.flags for name in names)
+
+    def __repr__(self):
+        return f"Route(flags={sorted(self.flags)}, ordinal={self.ordinal}, entities={self.entities})"
+
+
+class IntentRouter:
+    """
+    Classifies messages with keyword groups and regular expressions that
+    are compiled once.
+
+    keywords maps a group name to its keywords; patterns maps a name to
+    regular expressions, whose named groups are returned as entities.
+    """
+
+    def __init__(self, keywords=None, patterns=None):
+        labelled = [(kw.lower(), name) for name, words in (keywords or {}).items() for kw in words]
+        labelled += [(word, ('ordinal', position)) for word, position in ORDINAL_WORDS.items()]
+        self._automaton = KeywordAutomaton(labelled)
+        self._patterns = [
+            (name, [re.compile(p, re.IGNORECASE) for p in expressions])
+            for name, expressions in (patterns or {}).items()
+        ]
+
+    def route(self, message):
+        text = message.lower()
+        found = self._automaton.find(text)
+
+        flags = {label for label in found if not isinstance(label, tuple)}
+        positions = [label[1] for label in found if isinstance(label, tuple)]
+        digit = ORDINAL_DIGIT.search(text)
+        if digit:
+            positions.append(int(digit.group(1).translate(DIGITS)) - 1)
+        # The first named position wins over "last", as in "اولی یا آخری"
+        ordinal = min((p for p in positions if p >= 0), default=-1 if positions else None)
+
+        entities = {}
+        for name, expressions in self._patterns:
+            for expression in expressions:
+                match = expression.search(text)
+                if match:
+                    flags.add(name)
+                    entities.update({k: v for k, v in match.groupdict().items() if v})
+                    break
+
+        return Route(text, flags, ordinal, entities, len(message.split()))
+
+
+def pick(items, ordinal, default=-1):
+    """The item at the named position (default if none is named), or None if out of range"""
+    position = default if ordinal is None else ordinal
+    if not items or position >= len(items):
+        return None
+    return items[position]
+
+
+if __name__ == "__main__":
+    # Micro-benchmark: one automaton pass against one substring scan per keyword
+    import random
+
+    messages = [
+        "نویسنده کتاب دوم کیه",
+        "چند تا دیگه از این نویسنده معرفی کن",
+        "کتاب‌های نیما یوشیج در مورد شعر نو",
+        "استاد راهنمای پایان نامه سوم چه کسی است",
+        "درباره کتاب آخر بیشتر توضیح بده",
+    ]
+    random.seed(0)
+    letters = "ابپتثجچحخدذرزسشصضطظعغفقکگلمنوهی"
+
+    print("=" * 60)
+    print("⏱️ Intent routing benchmark (µs per message)")
+    print("=" * 60)
+    for size in (50, 500, 5000):
+        keywords = ['بیشتر', 'دوباره', 'توضیح', 'نویسنده', 'معرفی کن'] + [
+            "".join(random.choice(letters) for _ in range(random.randint(3, 8))) for _ in range(size - 5)
+        ]
+        router = IntentRouter(keywords={'k': keywords})
+        rounds = 2000
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for message in messages:
+                text = message.lower()
+                [kw for kw in keywords if kw in text]
+        scan = (time.perf_counter() - started) / (rounds * len(messages)) * 1e6
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for message in messages:
+                router.route(message)
+        automaton = (time.perf_counter() - started) / (rounds * len(messages)) * 1e6
+
+        print(f"{size:>5} keywords: substring scans {scan:8.1f} µs | router {automaton:6.1f} µs")
+
+    router = IntentRouter(keywords={'more': ['بیشتر', 'دوباره']}, patterns={'ask_author': [r'نویسنده\s+(کتاب\s+)?(?P<which>اول|دوم|سوم|آخر)']})
+    for message in messages:
+        print(f"\n{message}\n   {router.route(message)}")
@@ -0,0 +1,147 @@
+import argparse
+import time
+from pathlib import Path
+import faiss
+import numpy as np
+import config
+
+# Indexes whose similar-items graphs are built by this module's batch job
+INDEXES = {
+    'book': config.FAISS_INDEX_PATH,
+    'thesis': "output/theses/faiss_index.bin",
+}
+
+# Cross-collection tables: (source, target) -> nearest target items of every source item
+RELATED_GRAPHS = {
+    ('book', 'thesis'): "output/related_theses_knn.npz",
+    ('thesis', 'book'): "output/theses/related_books_knn.npz",
+}
+
+
+def graph_path(index_path):
+    """Where the similar-items graph of an index is saved"""
+    return index_path.replace('.bin', '_knn.npz')
+
+
+def index_vectors(index):
+    """Ids and vectors stored in an IndexIDMap over a flat index"""
+    inner = faiss.downcast_index(index.index)
+    ids = faiss.vector_to_array(index.id_map).astype('int64')
+    return ids, inner.reconstruct_n(0, inner.ntotal)
+
+
+class KnnGraph:
+    """
+    Nearest neighbours of every item, in CSR layout.
+
+    Row i belongs to ids[i] (ids are sorted); its neighbours are
+    neighbours[indptr[i]:indptr[i + 1]], nearest first, with their
+    distances. A lookup is a binary search and a slice, with no embedding
+    or index search.
+    """
+
+    def __init__(self, ids, indptr, neighbours, distances):
+        self.ids = ids
+        self.indptr = indptr
+        self.neighbours = neighbours
+        self.distances = distances
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        graph = cls(data['ids'], data['indptr'], data['neighbours'], data['distances'])
+        print(f"✅ Similar-items graph loaded: {len(graph)} items, {len(graph.neighbours)} links")
+        return graph
+
+    def save(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(
+            path, ids=self.ids, indptr=self.indptr,
+            neighbours=self.neighbours, distances=self.distances
+        )
+        print(f"💾 Graph saved: {path}")
+
+    def neighbours_of(self, row_id, limit=None):
+        """(id, distance) pairs of the nearest items to row_id, nearest first"""
+        position = int(np.searchsorted(self.ids, row_id))
+        if position >= len(self.ids) or self.ids[position] != row_id:
+            return []
+        start, end = int(self.indptr[position]), int(self.indptr[position + 1])
+        if limit is not None:
+            end = min(end, start + limit)
+        return list(zip(self.neighbours[start:end].tolist(), self.distances[start:end].tolist()))
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def build_knn_graph(index, k, batch_size=None, target=None):
+    """
+    The k nearest neighbours of every vector of index, by batched search.
+
+    Each batch of stored vectors is searched against target, by default the
+    index itself (then an item is removed from its own neighbour list).
+    With another index as target the graph is a bipartite table, e.g. the
+    theses nearest to every book; both must use the same embedding model.
+    """
+    batch_size = batch_size or config.KNN_BATCH_SIZE
+    self_search = target is None
+    target = index if self_search else target
+    ids, vectors = index_vectors(index)
+    order = np.argsort(ids)
+    ids, vectors = ids[order], vectors[order]
+
+    counts = np.zeros(len(ids), dtype='int64')
+    neighbour_rows, distance_rows = [], []
+    started = time.time()
+    for start in range(0, len(ids), batch_size):
+        distances, found = target.search(vectors[start:start + batch_size], k + 1 if self_search else k)
+        for offset, (row_distances, row_found) in enumerate(zip(distances, found)):
+            keep = row_found != -1
+            if self_search:
+                keep &= row_found != ids[start + offset]
+            row_found, row_distances = row_found[keep][:k], row_distances[keep][:k]
+            counts[start + offset] = len(row_found)
+            neighbour_rows.append(row_found)
+            distance_rows.append(row_distances)
+        print(f"   {min(start + batch_size, len(ids))}/{len(ids)} ({time.time() - started:.0f}s)")
+
+    indptr = np.zeros(len(ids) + 1, dtype='int64')
+    np.cumsum(counts, out=indptr[1:])
+    return KnnGraph(
+        ids,
+        indptr,
+        np.concatenate(neighbour_rows).astype('int64') if neighbour_rows else np.zeros(0, dtype='int64'),
+        np.concatenate(distance_rows).astype('float32') if distance_rows else np.zeros(0, dtype='float32'),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute similar-items graphs of the saved indexes")
+    parser.add_argument("collections", nargs="*", default=sorted(INDEXES), choices=sorted(INDEXES))
+    parser.add_argument("--k", type=int, default=config.SIMILAR_ITEMS_K, help="neighbours kept per item")
+    parser.add_argument("--related", action="store_true", help="also build the book <-> thesis tables")
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("🕸️ Building similar-items graphs")
+    print("=" * 60)
+
+    for name in args.collections:
+        index_path = INDEXES[name]
+        if not Path(index_path).exists():
+            print(f"⚠️ {name}: no index at {index_path}")
+            continue
+        print(f"\n📖 {name}: {index_path}")
+        graph = build_knn_graph(faiss.read_index(index_path), args.k)
+        graph.save(graph_path(index_path))
+
+    if args.related:
+        if not all(Path(path).exists() for path in INDEXES.values()):
+            print("⚠️ The book and thesis indexes are both needed for the related tables")
+        else:
+            indexes = {name: faiss.read_index(path) for name, path in INDEXES.items()}
+            for (source, target), path in RELATED_GRAPHS.items():
+                print(f"\n🔗 {source} -> {target}")
+                graph = build_knn_graph(indexes[source], config.RELATED_ITEMS_K, target=indexes[target])
+                graph.save(path)
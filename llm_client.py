@@ -0,0 +1,241 @@
+import json
+import threading
+import time
+import httpx
+from openai import APIConnectionError, APITimeoutError, InternalServerError, OpenAI, RateLimitError
+import admission
+import circuit_breaker
+from circuit_breaker import CircuitOpen
+import config
+import deadline
+import hedging
+import metrics
+from single_flight import SingleFlight
+
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Identical requests sent at the same time (same stage, model, messages and
+# settings) are answered by one call; the others wait within their stage's budget
+_flights = SingleFlight("llm")
+
+# Errors worth another attempt (timeouts are connection errors)
+RETRYABLE_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+_http_client = None
+_openai_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_http_client():
+    """
+    The connection pool shared by every OpenAI call of the process.
+
+    Connections are kept alive between calls, so the bots, embedders and
+    background jobs reuse them instead of opening new TLS connections.
+    """
+    global _http_client
+    with _clients_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=config.HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=config.HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY
+                ),
+                timeout=httpx.Timeout(config.OPENAI_TIMEOUT, connect=config.OPENAI_CONNECT_TIMEOUT)
+            )
+            print(f"🌐 Shared HTTP client: {config.HTTP_MAX_CONNECTIONS} connections, HTTP/2 {'on' if HTTP2_AVAILABLE else 'off'}")
+        return _http_client
+
+
+def get_openai_client(api_key=None, base_url=None):
+    """OpenAI client over the shared connection pool (one per key and endpoint)"""
+    api_key = api_key or config.OPENAI_API_KEY
+    http_client = get_http_client()
+    with _clients_lock:
+        if (api_key, base_url) not in _openai_clients:
+            _openai_clients[api_key, base_url] = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=http_client,
+                timeout=config.OPENAI_TIMEOUT,
+                max_retries=config.OPENAI_MAX_RETRIES
+            )
+        return _openai_clients[api_key, base_url]
+
+
+def get_embeddings(model=None, api_key=None):
+    """LangChain embeddings sending their requests through the shared OpenAI client"""
+    from langchain_openai import OpenAIEmbeddings
+
+    client = get_openai_client(api_key)
+    return OpenAIEmbeddings(
+        model=model or config.EMBEDDING_MODEL,
+        openai_api_key=client.api_key,
+        client=client.embeddings
+    )
+
+
+def _usage_value(obj, name):
+    # Newer usage fields may arrive as plain dicts with older SDK versions
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def record_usage(stage, usage):
+    """Record prompt, cached and completion tokens of one call"""
+    if usage is None:
+        return
+    prompt_tokens = _usage_value(usage, "prompt_tokens") or 0
+    completion_tokens = _usage_value(usage, "completion_tokens") or 0
+    cached_tokens = _usage_value(_usage_value(usage, "prompt_tokens_details"), "cached_tokens") or 0
+
+    for name, value in (("prompt_tokens", prompt_tokens),
+                        ("cached_tokens", cached_tokens),
+                        ("completion_tokens", completion_tokens)):
+        metrics.increment(f"llm.{name}", value)
+        metrics.increment(f"{stage}.{name}", value)
+    if prompt_tokens:
+        metrics.observe(f"{stage}.cached_ratio", cached_tokens / prompt_tokens)
+
+    print(f"🧾 {stage}: {prompt_tokens} prompt tokens ({cached_tokens} cached), {completion_tokens} completion")
+
+
+def create_chat_completion(client, messages, model=None, max_tokens=None,
+                           temperature=None, on_delta=None, stage="chat", timeout=None):
+    """
+    Send a chat completion and return the answer text.
+
+    When on_delta is given the answer is streamed and on_delta is called
+    with every new piece of text as soon as it arrives. Token usage
+    (including provider-cached prompt tokens) is recorded for every call.
+    Callers repeating a request that is still running wait for its answer
+    instead of sending their own (they get it whole, not streamed).
+
+    The call's timeout is its stage budget (config.STAGE_BUDGETS, by the
+    part of stage after the dot), cut to the time left before the message's
+    deadline; timeout (seconds) shortens it further. A streamed answer is
+    also stopped when the deadline passes between two chunks. Failed calls
+    are retried by deadline.retry, a streamed one only if nothing was sent
+    yet; a timeout that is not retried raises DeadlineExceeded.
+    Slow calls of the hedged stages are raced against a second request
+    (hedging.hedged); a streamed answer goes to the request whose first
+    token arrives first. While the chat circuit breaker is open the call
+    fails at once with CircuitOpen. Every request waits for its turn in
+    admission.chat, which rejects it (Overloaded) when too many are waiting.
+    """
+    request = {
+        "model": model or config.GPT_MODEL,
+        "messages": messages,
+        "max_tokens": max_tokens or config.MAX_TOKENS,
+        "temperature": config.TEMPERATURE if temperature is None else temperature,
+    }
+    circuit_breaker.chat.check(stage)
+    key = (stage, json.dumps(request, ensure_ascii=False, sort_keys=True))
+    return _flights.do(key, _complete, client, request, on_delta, stage, timeout, stage=stage)
+
+
+def _complete(client, request, on_delta, stage, timeout):
+    # Retries follow the deadline instead of the client's own policy
+    client = client.with_options(max_retries=0)
+    parts = []
+
+    def attempt(stage_timeout):
+        call_timeout = stage_timeout if timeout is None else min(timeout, stage_timeout)
+        return hedging.hedged(
+            stage,
+            lambda claim: _send(client, {**request, "timeout": call_timeout}, on_delta, stage, parts, claim),
+            metric=f"{stage}.latency" if on_delta is None else f"{stage}.ttft"
+        )
+
+    try:
+        answer = deadline.retry(attempt, stage, RETRYABLE_ERRORS, can_retry=lambda: not parts)
+    except RETRYABLE_ERRORS as e:
+        circuit_breaker.chat.record_failure()
+        if circuit_breaker.chat.is_open:
+            # This failure opened the circuit: answer like the calls after it
+            raise CircuitOpen(stage) from e
+        if isinstance(e, APITimeoutError):
+            # Out of time rather than broken (e.g. a stream stalled after its first
+            # token, which cannot be retried): the bots give their shorter reply
+            metrics.increment(f"{stage}.deadline_exceeded")
+            raise deadline.DeadlineExceeded(stage) from e
+        raise
+    except deadline.DeadlineExceeded as e:
+        # Given up on a failing or too slow call (not just a message out of time)
+        if isinstance(e.__cause__, RETRYABLE_ERRORS):
+            circuit_breaker.chat.record_failure()
+        raise
+    circuit_breaker.chat.record_success()
+    return answer
+
+
+def _send(client, request, on_delta, stage, parts, claim):
+    # Retries and hedges are requests too, each admitted on its own
+    tokens = admission.estimate_tokens([m["content"] for m in request["messages"]], request["max_tokens"])
+    with admission.chat.admit(stage, tokens) as ticket:
+        try:
+            answer, usage = _request(client, request, on_delta, stage, parts, claim)
+        except RateLimitError as e:
+            admission.chat.throttle(admission.retry_after(e))
+            raise
+        if usage is not None:
+            ticket.used = (_usage_value(usage, "prompt_tokens") or 0) + (_usage_value(usage, "completion_tokens") or 0)
+        return answer
+
+
+def _request(client, request, on_delta, stage, parts, claim):
+    started = time.monotonic()
+
+    if on_delta is None:
+        response = client.chat.completions.create(**request)
+        metrics.observe(f"{stage}.latency", time.monotonic() - started)
+        record_usage(stage, response.usage)
+        return response.choices[0].message.content, response.usage
+
+    # The usage of a streamed answer comes in a last chunk without choices
+    stream = client.chat.completions.create(
+        stream=True,
+        extra_body={"stream_options": {"include_usage": True}},
+        **request
+    )
+    usage = None
+    answering = False
+    # The call's timeout bounds each read, not the whole stream: the deadline is checked per chunk
+    current = deadline.current()
+    for chunk in stream:
+        if current is not None and current.remaining() <= 0:
+            stream.close()
+            metrics.increment(f"{stage}.deadline_exceeded")
+            raise deadline.DeadlineExceeded(stage)
+        if getattr(chunk, "usage", None) is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        if not answering:
+            ttft = time.monotonic() - started
+            metrics.observe(f"{stage}.ttft", ttft)
+            print(f"⚡ {stage}: first token after {ttft:.2f}s")
+            # Only one request of a hedged call streams to the user
+            if not claim():
+                stream.close()
+                raise hedging.HedgeLost()
+            answering = True
+        parts.append(delta)
+        on_delta(delta)
+
+    metrics.observe(f"{stage}.latency", time.monotonic() - started)
+    record_usage(stage, usage)
+    return "".join(parts), usage
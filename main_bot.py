@@ -1,14 +1,37 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from collections import defaultdict
 from datetime import datetime
+from pathlib import Path
+from stream_reply import StreamingReply
+from session_store import SessionManager, schedule_expiry
+from intent_router import IntentRouter, ordinal_of, pick
+from knn_graph import KnnGraph, RELATED_GRAPHS
+from retrieval_engine import RetrievalEngine
+from deadline import bounded
+from priority_updates import PriorityUpdateProcessor
+import admission
+import asyncio
+import functools
+import re
+import weakref
+import config
 
 MODE_IDLE = "idle"
 MODE_BOOK = "book"
 MODE_THESIS = "thesis"
 MODE_REGULATIONS = "regulations"
+MODE_ALL = "all"
 
-user_mode = defaultdict(lambda: MODE_IDLE)
+# Selected mode of each chat, kept in the session store so it survives restarts
+mode_sessions = SessionManager("main", lambda: {'mode': MODE_IDLE})
+
+
+def get_mode(chat_id):
+    return mode_sessions.peek(chat_id)['mode']
+
+
+def set_mode(chat_id, mode):
+    mode_sessions.get(chat_id)['mode'] = mode
 
 # Import book_bot
 try:
@@ -38,13 +61,205 @@ except Exception as e:
     print(f"⚠️ Error loading regulations_bot: {e}")
 
 
+# Updates are handled concurrently (PriorityUpdateProcessor); one lock per
+# chat keeps the messages of a chat in order. Unused locks are dropped. The
+# chat's OpenAI calls are queued under its id (admission.current_user).
+chat_locks = weakref.WeakValueDictionary()
+
+
+def one_at_a_time_per_chat(handler):
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        chat_id = update.effective_chat.id
+        admission.current_user.set(chat_id)
+        lock = chat_locks.get(chat_id)
+        if lock is None:
+            lock = chat_locks[chat_id] = asyncio.Lock()
+        async with lock:
+            return await handler(update, context)
+    return wrapper
+
+
+# Book <-> thesis tables (python knn_graph.py --related), loaded in main()
+related_graphs = {}
+
+# Books and theses searched with one query embedding, set up in main()
+retrieval = RetrievalEngine()
+
+# "پایان‌نامه‌های مرتبط با این کتاب" in book mode, "کتاب‌های مرتبط" in thesis mode
+RELATED_ROUTER = IntentRouter(
+    keywords={
+        'thesis': ['پایان نامه', 'پایان‌نامه', 'پایاننامه', 'رساله'],
+        'book': ['کتاب'],
+        'related': ['مرتبط', 'مربوط', 'مشابه', 'همین موضوع', 'این موضوع', 'این زمینه', 'هم موضوع'],
+    }
+)
+
+# Words pointing at the shown items ("این کتاب", "همین‌ها"); ordinals ("دوم", "اولی", "2") count too
+RELATED_REFERENCES = {'این', 'همین', 'همون', 'اون', 'آن', 'اینها', 'اینا', 'همینها', 'همینا', 'اونها', 'اونا'}
+
+# The other words a related-items request is made of; any word outside these is a
+# topic ("پایان‌نامه‌های مرتبط با هوش مصنوعی") and the message is searched instead
+RELATED_WORDS = RELATED_REFERENCES | {
+    'کتاب', 'کتابها', 'کتابهای', 'کتابای', 'کتابی', 'پایان', 'نامه', 'پایاننامه', 'رساله',
+    'ها', 'های', 'ای', 'مرتبط', 'مربوط', 'مشابه', 'موضوع', 'زمینه', 'هم',
+    'با', 'به', 'از', 'و', 'را', 'رو', 'برای', 'درباره', 'در', 'مورد', 'شماره', 'که', 'یه', 'چند', 'تا',
+    'دارید', 'داری', 'داریم', 'هست', 'هستن', 'چی', 'چه', 'بده', 'بدید', 'بیار', 'نشون', 'نشان',
+    'معرفی', 'کن', 'کنید', 'لطفا', 'لطفاً', 'میخوام', 'می', 'خوام',
+}
+
+
+def load_related_graphs():
+    for pair, path in RELATED_GRAPHS.items():
+        if Path(path).exists():
+            related_graphs[pair] = KnnGraph.load(path)
+
+
+def load_retrieval_engine():
+    if BOOK_MODULE_AVAILABLE:
+        retrieval.register('book', book_bot.embedder, book_bot.enrich_search_result, lexical=book_bot.handler.lexical_search)
+    if THESIS_MODULE_AVAILABLE:
+        retrieval.register('thesis', thesis_bot.embedder, thesis_bot.enrich_search_result, lexical=thesis_bot.handler.lexical_search)
+
+
+def hand_over(bot, chat_id, items, shown, query):
+    """Make items the last results of bot, so its follow-ups work after switching mode"""
+    bot.save_search_results(chat_id, shown, query)
+    bot.save_cursor(chat_id, items)
+    bot.set_shown_results(chat_id, shown)
+
+
+def format_book(r):
+    return (
+        f"🔹 «{r.get('عنوان', '')}»\n"
+        f"   نویسنده: {r.get('پديدآورنده') or 'نامشخص'}\n"
+        f"   شماره بازیابی: {r.get('شماره_بازیابی') or 'نامشخص'}\n"
+        f"   محل نگهداری: {r.get('محل_نگهداری') or 'کتابخانه مرکزی'}\n"
+    )
+
+
+def format_thesis(r):
+    title = r.get('عنوان') or r.get('عنوان پایان‌نامه', '')
+    author = thesis_bot.clean_text_for_display(r.get('نویسنده', ''))
+    advisor = thesis_bot.clean_text_for_display(r.get('استاد راهنما', ''))
+    degree = thesis_bot.clean_text_for_display(thesis_bot.format_field(r.get('مقطع')))
+    field = thesis_bot.clean_text_for_display(
+        thesis_bot.format_field(r.get('رشته')) or
+        thesis_bot.format_field(r.get('رشته تحصیلی'))
+    )
+    year = thesis_bot.clean_text_for_display(
+        thesis_bot.format_field(r.get('سال')) or
+        thesis_bot.format_field(r.get('سال دفاع'))
+    )
+
+    return (
+        f"📄 «{title}»\n"
+        f"   پژوهشگر: {author}\n"
+        f"   استاد راهنما: {advisor}\n"
+        f"   مقطع: {degree}\n"
+        f"   رشته: {field}\n"
+        f"   سال: {year}\n"
+    )
+
+
+def related_request(mode, message):
+    """
+    The route of a request for the other collection's items related to the
+    shown ones, or None.
+
+    The message has to point at the shown items (an ordinal or "این/همین")
+    and name nothing else: a topic makes it a search. The route's ordinal
+    is the position named as a whole word (None: all shown items).
+    """
+    source, target = ('book', 'thesis') if mode == MODE_BOOK else ('thesis', 'book')
+    if (source, target) not in related_graphs or not (BOOK_MODULE_AVAILABLE and THESIS_MODULE_AVAILABLE):
+        return None
+    route = RELATED_ROUTER.route(message)
+    if not (route.has(target) and route.has('related')) or route.word_count > 12:
+        return None
+
+    words = re.findall(r'\w+', route.text)
+    positions = [position for word in words if (position := ordinal_of(word)) is not None]
+    if not positions and not RELATED_REFERENCES.intersection(words):
+        return None
+    if any(word not in RELATED_WORDS and ordinal_of(word) is None for word in words):
+        return None
+    route.ordinal = positions[0] if positions else None
+    return route
+
+
+def related_reply(chat_id, mode, route):
+    """
+    Items of the other collection related to the shown ones, or None.
+
+    They are read from the precomputed tables, with no embedding, search or
+    model call, and become the last results of the other bot, so its
+    follow-ups work after switching mode.
+    """
+    source, target = ('book', 'thesis') if mode == MODE_BOOK else ('thesis', 'book')
+    graph = related_graphs[source, target]
+
+    source_bot, target_bot = (book_bot, thesis_bot) if source == 'book' else (thesis_bot, book_bot)
+    if not (shown := source_bot.get_shown_results(chat_id)):
+        return None
+    chosen = shown if route.ordinal is None else [pick(shown, route.ordinal)]
+    if chosen == [None]:
+        return f"متأسفم، من فقط {len(shown)} مورد معرفی کردم."
+
+    # Nearest first, over the neighbours of all chosen items
+    best = {}
+    for item in chosen:
+        for row_id, distance in graph.neighbours_of(int(item['رديف'])):
+            best[row_id] = min(distance, best.get(row_id, distance))
+    ranked = sorted(best.items(), key=lambda pair: pair[1])
+    items = target_bot.load_results([row_id for row_id, _ in ranked])
+    for item, (_, distance) in zip(items, ranked):
+        item['distance'] = distance
+    if not items:
+        return None
+
+    print(f"🔗 Related {target}: {len(items)} from the precomputed table")
+    shown_items = items[:config.RELATED_ITEMS_SHOWN]
+    hand_over(target_bot, chat_id, items, shown_items, chosen[0].get('عنوان', ''))
+
+    if target == 'thesis':
+        header = "📄 پایان‌نامه‌های مرتبط:\n\n"
+        body = "\n".join(format_thesis(r) for r in shown_items)
+        footer = "\nبرای پرسش درباره این پایان‌نامه‌ها، از /start جستجوی پایان‌نامه را انتخاب کنید."
+    else:
+        header = "📚 کتاب‌های مرتبط:\n\n"
+        body = "\n".join(format_book(r) for r in shown_items)
+        footer = "\nبرای پرسش درباره این کتاب‌ها، از /start جستجوی کتاب را انتخاب کنید."
+    return header + body + footer
+
+
+@bounded(config.REQUEST_DEADLINE, lambda: "⏳ پاسخ‌گویی بیش از حد طول کشید. لطفاً چند لحظه دیگر دوباره بپرسید.")
+def search_all_reply(chat_id, message):
+    """Books and theses for one query, nearest first, with no model call"""
+    found = retrieval.search(message)
+    bots = {'book': book_bot, 'thesis': thesis_bot}
+    merged = retrieval.merge(found, config.SEARCH_ALL_SHOWN)
+    if not merged:
+        return "متأسفم، کتاب یا پایان‌نامه‌ای برای این جستجو پیدا نکردم. 🔍"
+
+    for name, results in found.items():
+        hand_over(bots[name], chat_id, results, [r for r in merged if r['collection'] == name], message)
+
+    body = "\n".join(format_book(r) if r['collection'] == 'book' else format_thesis(r) for r in merged)
+    return (
+        f"🔎 نتایج جستجو در همه منابع ({len(merged)} مورد):\n\n" + body +
+        "\nبرای پرسش درباره هر مورد، از /start حالت کتاب یا پایان‌نامه را انتخاب کنید."
+    )
+
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_mode[chat_id] = MODE_IDLE
+    set_mode(chat_id, MODE_IDLE)
 
     keyboard = [
         [InlineKeyboardButton("📚 جستجوی کتاب فارسی", callback_data="mode_book")],
         [InlineKeyboardButton("📄 جستجوی پایان‌نامه فارسی", callback_data="mode_thesis")],
+        [InlineKeyboardButton("🔎 جستجو در همه منابع", callback_data="mode_all")],
         [InlineKeyboardButton("📋 قوانین و مقررات کتابخانه", callback_data="mode_regulations")],  # ✅ دکمه جدید
         [InlineKeyboardButton("ℹ️ درباره ما", callback_data="about")]
     ]
@@ -57,6 +272,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "   جستجو در میان هزاران کتاب فارسی\n\n"
         "📄 **جستجوی پایان‌نامه فارسی**\n"
         "   جستجو در پایان‌نامه‌های دانشگاه\n\n"
+        "🔎 **جستجو در همه منابع**\n"
+        "   جستجوی هم‌زمان کتاب‌ها و پایان‌نامه‌ها\n\n"
         "📋 **قوانین و مقررات کتابخانه**\n"
         "   پاسخ به سوالات درباره قوانین و آیین‌نامه‌ها\n\n"
         "ℹ️ **درباره ما**\n"
@@ -78,6 +295,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+@one_at_a_time_per_chat
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -93,7 +311,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        user_mode[chat_id] = MODE_BOOK
+        set_mode(chat_id, MODE_BOOK)
 
         await query.edit_message_text(
             "📚 **حالت جستجوی کتاب فعال شد**\n\n"
@@ -120,7 +338,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        user_mode[chat_id] = MODE_THESIS
+        set_mode(chat_id, MODE_THESIS)
 
         await query.edit_message_text(
             "📄 **حالت جستجوی پایان‌نامه فعال شد**\n\n"
@@ -139,6 +357,27 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='Markdown'
         )
 
+    # Search everything mode
+    elif query.data == "mode_all":
+        if not retrieval.collections:
+            await query.edit_message_text(
+                "❌ متأسفانه جستجو در همه منابع در دسترس نیست.\n\n"
+                "لطفاً با مدیر سیستم تماس بگیرید."
+            )
+            return
+
+        set_mode(chat_id, MODE_ALL)
+
+        await query.edit_message_text(
+            "🔎 **حالت جستجو در همه منابع فعال شد**\n\n"
+            "موضوع مورد نظرتان را بنویسید تا کتاب‌ها و پایان‌نامه‌های مرتبط را با هم ببینید.\n\n"
+            "**مثال‌ها:**\n"
+            "• یادگیری ماشین\n"
+            "• تاریخ معاصر ایران\n\n"
+            "🔙 برای بازگشت: /start",
+            parse_mode='Markdown'
+        )
+
     # Regulations mode
     elif query.data == "mode_regulations":
         if not REGULATIONS_MODULE_AVAILABLE:
@@ -148,7 +387,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        user_mode[chat_id] = MODE_REGULATIONS
+        set_mode(chat_id, MODE_REGULATIONS)
 
         await query.edit_message_text(
             "📋 **حالت قوانین و مقررات فعال شد**\n\n"
@@ -192,9 +431,10 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await start_command(update, context)
 
 
+@one_at_a_time_per_chat
 async def new_conversation_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    mode = user_mode.get(chat_id, MODE_IDLE)
+    mode = get_mode(chat_id)
 
     if mode == MODE_IDLE:
         await update.message.reply_text(
@@ -206,24 +446,24 @@ async def new_conversation_command(update: Update, context: ContextTypes.DEFAULT
     try:
         # Clear memory based on mode
         if mode == MODE_BOOK and BOOK_MODULE_AVAILABLE:
-            book_bot.conversation_memory.pop(chat_id, None)
-            book_bot.search_results_memory.pop(chat_id, None)
-            book_bot.last_query_memory.pop(chat_id, None)
-            book_bot.last_shown_results.pop(chat_id, None)
+            book_bot.reset_conversation(chat_id)
             mode_name = "**کتاب**"
 
         elif mode == MODE_THESIS and THESIS_MODULE_AVAILABLE:
-            thesis_bot.conversation_memory.pop(chat_id, None)
-            thesis_bot.search_results_memory.pop(chat_id, None)
-            thesis_bot.last_query_memory.pop(chat_id, None)
-            thesis_bot.last_shown_results.pop(chat_id, None)
-            thesis_bot.filter_state.pop(chat_id, None)
+            thesis_bot.reset_conversation(chat_id)
             mode_name = "**پایان‌نامه**"
 
         elif mode == MODE_REGULATIONS and REGULATIONS_MODULE_AVAILABLE:
-            regulations_bot.conversation_memory.pop(chat_id, None)
+            regulations_bot.reset_conversation(chat_id)
             mode_name = "**قوانین و مقررات**"
 
+        elif mode == MODE_ALL:
+            if BOOK_MODULE_AVAILABLE:
+                book_bot.reset_conversation(chat_id)
+            if THESIS_MODULE_AVAILABLE:
+                thesis_bot.reset_conversation(chat_id)
+            mode_name = "**همه منابع**"
+
         else:
             mode_name = "**نامشخص**"
 
@@ -245,7 +485,7 @@ async def new_conversation_command(update: Update, context: ContextTypes.DEFAULT
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    mode = user_mode.get(chat_id, MODE_IDLE)
+    mode = get_mode(chat_id)
 
     if mode == MODE_BOOK:
         help_text = (
@@ -291,6 +531,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "• کتاب‌های قدیمی رو قبول می‌کنید؟"
         )
 
+    elif mode == MODE_ALL:
+        help_text = (
+            "📖 **راهنمای جستجو در همه منابع:**\n\n"
+            "🔹 موضوع را بنویسید؛ کتاب‌ها و پایان‌نامه‌ها با هم نمایش داده می‌شوند\n"
+            "🔹 برای پرسش درباره نتایج، حالت کتاب یا پایان‌نامه را از /start انتخاب کنید\n"
+            "🔹 برای مکالمه جدید: /new"
+        )
+
     else:
         help_text = (
             "📖 **راهنمای استفاده:**\n\n"
@@ -307,10 +555,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
 
+@one_at_a_time_per_chat
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_message = update.message.text
     chat_id = update.effective_chat.id
-    mode = user_mode.get(chat_id, MODE_IDLE)
+    mode = get_mode(chat_id)
 
     if mode == MODE_IDLE:
         await update.message.reply_text(
@@ -324,13 +573,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # Book mode
         if mode == MODE_BOOK and BOOK_MODULE_AVAILABLE:
-            response = book_bot.generate_rag_response(user_message, chat_id)
-            await update.message.reply_text(response)
+            if (route := related_request(mode, user_message)) and (related := await asyncio.to_thread(related_reply, chat_id, mode, route)):
+                await update.message.reply_text(related)
+                return
+
+            reply = StreamingReply(update.message)
+            reply.start()
+            try:
+                response = await asyncio.to_thread(book_bot.generate_rag_response, user_message, chat_id, reply.push)
+                await reply.finish(response)
+            finally:
+                await reply.stop()
 
         # Thesis mode
         elif mode == MODE_THESIS and THESIS_MODULE_AVAILABLE:
             # Check filter status
-            if thesis_bot.filter_state[chat_id].get('active', False):
+            if thesis_bot.get_filter_state(chat_id).get('active', False):
                 filter_result = thesis_bot.handle_filter_interaction(user_message, chat_id)
 
                 if filter_result:
@@ -346,34 +604,23 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             filtered_results = thesis_bot.get_last_search_results(chat_id)
                             if filtered_results:
                                 for r in filtered_results[:6]:
-                                    title = r.get('عنوان') or r.get('عنوان پایان‌نامه', '')
-                                    author = thesis_bot.clean_text_for_display(r.get('نویسنده', ''))
-                                    advisor = thesis_bot.clean_text_for_display(r.get('استاد راهنما', ''))
-                                    degree = thesis_bot.clean_text_for_display(thesis_bot.format_field(r.get('مقطع')))
-                                    field = thesis_bot.clean_text_for_display(
-                                        thesis_bot.format_field(r.get('رشته')) or
-                                        thesis_bot.format_field(r.get('رشته تحصیلی'))
-                                    )
-                                    year = thesis_bot.clean_text_for_display(
-                                        thesis_bot.format_field(r.get('سال')) or
-                                        thesis_bot.format_field(r.get('سال دفاع'))
-                                    )
-
-                                    result_text = (
-                                        f"📄 «{title}»\n"
-                                        f"   پژوهشگر: {author}\n"
-                                        f"   استاد راهنما: {advisor}\n"
-                                        f"   مقطع: {degree}\n"
-                                        f"   رشته: {field}\n"
-                                        f"   سال: {year}\n"
-                                    )
-                                    await update.message.reply_text(result_text)
+                                    await update.message.reply_text(format_thesis(r))
                         return
 
+            # Related books from the precomputed table
+            if (route := related_request(mode, user_message)) and (related := await asyncio.to_thread(related_reply, chat_id, mode, route)):
+                await update.message.reply_text(related)
+                return
+
             # Normal search
-            result = thesis_bot.generate_rag_response(user_message, chat_id)
-            response, is_new_search = result if isinstance(result, tuple) else (result, False)
-            await update.message.reply_text(response)
+            reply = StreamingReply(update.message)
+            reply.start()
+            try:
+                result = await asyncio.to_thread(thesis_bot.generate_rag_response, user_message, chat_id, reply.push)
+                response, is_new_search = result if isinstance(result, tuple) else (result, False)
+                await reply.finish(response)
+            finally:
+                await reply.stop()
 
             # Suggest filter
             if thesis_bot.should_offer_filter(
@@ -382,16 +629,25 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 is_new_search
             ):
                 await update.message.reply_text("💡 آیا مایلید نتایج را فیلتر کنید؟ (بله/خیر)")
-                thesis_bot.filter_state[chat_id].update({
+                thesis_bot.get_filter_state(chat_id).update({
                     'active': True,
                     'stage': 'ask',
                     'last_offer': thesis_bot.datetime.now()
                 })
 
+        # Search everything mode
+        elif mode == MODE_ALL and retrieval.collections:
+            await update.message.reply_text(await asyncio.to_thread(search_all_reply, chat_id, user_message))
+
         # Regulations mode
         elif mode == MODE_REGULATIONS and REGULATIONS_MODULE_AVAILABLE:
-            response = regulations_bot.generate_response(user_message, chat_id)
-            await update.message.reply_text(response)
+            reply = StreamingReply(update.message)
+            reply.start()
+            try:
+                response = await asyncio.to_thread(regulations_bot.generate_response, user_message, chat_id, reply.push)
+                await reply.finish(response)
+            finally:
+                await reply.stop()
 
         else:
             await update.message.reply_text(
@@ -452,8 +708,15 @@ def main():
             return
         print("✅ regulations_bot is ready")
 
+    load_related_graphs()
+    load_retrieval_engine()
+
     TELEGRAM_BOT_TOKEN = "YOUR_TELEGRAM_BOT_TOKEN_HERE"
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    updates = PriorityUpdateProcessor(config.CONCURRENT_UPDATES, cheap_commands=("start", "help", "new"))
+    app = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(updates).build()
+    schedule_expiry(app)
+    if REGULATIONS_MODULE_AVAILABLE:
+        regulations_bot.schedule_reload(app)
 
     # Handlers
     app.add_handler(CommandHandler("start", start_command))
@@ -468,6 +731,8 @@ def main():
         print("📚 Book mode: active")
     if THESIS_MODULE_AVAILABLE:
         print("📄 Thesis mode: active")
+    if retrieval.collections:
+        print("🔎 Search everything mode: active")
     if REGULATIONS_MODULE_AVAILABLE:
         print("📋 Regulations mode: active")
     print("=" * 60)
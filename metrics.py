@@ -0,0 +1,59 @@
+import threading
+from collections import defaultdict, deque
+
+
+# Number of latest samples kept per metric
+SAMPLE_WINDOW = 1000
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_samples = defaultdict(lambda: deque(maxlen=SAMPLE_WINDOW))
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def observe(name, value):
+    with _lock:
+        _samples[name].append(value)
+
+
+def get_counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def sample_count(name):
+    with _lock:
+        return len(_samples.get(name, ()))
+
+
+def percentile(name, q):
+    with _lock:
+        values = sorted(_samples.get(name, ()))
+    if not values:
+        return None
+    position = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[position]
+
+
+def snapshot():
+    """Counters and sample summaries (count, avg, p50, p95) of all metrics"""
+    with _lock:
+        counters = dict(_counters)
+        samples = {name: sorted(values) for name, values in _samples.items()}
+
+    summaries = {}
+    for name, values in samples.items():
+        if not values:
+            continue
+        summaries[name] = {
+            'count': len(values),
+            'avg': sum(values) / len(values),
+            'p50': values[int(0.5 * (len(values) - 1))],
+            'p95': values[int(0.95 * (len(values) - 1))],
+        }
+
+    return {'counters': counters, 'samples': summaries}
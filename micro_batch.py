@@ -0,0 +1,142 @@
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+from openai import RateLimitError
+import admission
+import circuit_breaker
+import config
+import deadline
+import hedging
+import metrics
+
+
+class MicroBatcher:
+    """
+    Groups calls made at nearly the same time into one call of fn.
+
+    fn takes a list of items and returns their results in the same order.
+    The first waiting call opens a batch, which is sent when max_batch items
+    are waiting or max_wait seconds have passed; each caller gets its own
+    result, or the exception of its batch. Up to `workers` batches run at
+    once, so a slow batch does not hold up the next one.
+
+    A batch runs in the context of its most urgent caller: under the earliest
+    deadline of its callers and in the admission queue of that caller's chat.
+    """
+
+    def __init__(self, name, fn, max_batch, max_wait, workers=2):
+        self.name = name
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.SimpleQueue()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-batch")
+        threading.Thread(target=self._collect, name=f"{name}-batcher", daemon=True).start()
+
+    def __call__(self, item):
+        if self.max_batch <= 1:
+            return self.fn([item])[0]
+        future = Future()
+        self._queue.put((item, future, contextvars.copy_context()))
+        return deadline.wait(future, self.name)
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        context = most_urgent([context for _, _, context in batch])
+        try:
+            results = context.run(self.fn, [item for item, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+        metrics.increment(f"{self.name}.batches")
+        metrics.increment(f"{self.name}.batched_items", len(batch))
+
+
+def most_urgent(contexts):
+    """The context whose deadline ends first (the first one if none has a deadline)"""
+    def expires_at(context):
+        current = context.run(deadline.current)
+        return current.expires_at if current is not None else float('inf')
+
+    return min(contexts, key=expires_at)
+
+
+_embedding_batchers = {}
+_embedding_lock = threading.Lock()
+
+
+def embedding_batcher(client):
+    """
+    Query-embedding batcher shared by all embedders of the same model.
+
+    Each call embeds one text; concurrent queries of the book, thesis and
+    regulations bots go out as one embeddings request.
+    """
+    def attempt(texts):
+        with admission.embedding.admit("embedding", admission.estimate_tokens(texts)):
+            started = time.monotonic()
+            try:
+                vectors = client.embed_documents(texts)
+            except RateLimitError as e:
+                admission.embedding.throttle(admission.retry_after(e))
+                raise
+            metrics.observe("embedding.latency", time.monotonic() - started)
+            return vectors
+
+    def embed(texts):
+        circuit_breaker.embedding.check("embedding")
+        try:
+            # A slow embeddings call is raced against a second one
+            vectors = hedging.hedged("embedding", lambda claim: attempt(texts))
+        except (admission.Overloaded, deadline.DeadlineExceeded):
+            # Not sent or still waiting for a turn: says nothing about the service
+            raise
+        except Exception as e:
+            circuit_breaker.embedding.record_failure()
+            if circuit_breaker.embedding.is_open:
+                raise circuit_breaker.CircuitOpen("embedding") from e
+            raise
+        circuit_breaker.embedding.record_success()
+        return vectors
+
+    with _embedding_lock:
+        if client.model not in _embedding_batchers:
+            _embedding_batchers[client.model] = MicroBatcher(
+                "embedding", embed, config.EMBED_BATCH_SIZE, config.EMBED_BATCH_WAIT_MS / 1000
+            )
+        return _embedding_batchers[client.model]
+
+
+def search_batcher(get_index):
+    """
+    FAISS search batcher of one index.
+
+    Each call searches one (query_vector, k); a batch is searched as one
+    matrix of queries with the largest k and cut back to each caller's k.
+    get_index returns the current index, which may be reloaded.
+    """
+    def search(items):
+        vectors = np.vstack([vector for vector, _ in items])
+        distances, indices = get_index().search(vectors, max(k for _, k in items))
+        return [(distances[i:i + 1, :k], indices[i:i + 1, :k]) for i, (_, k) in enumerate(items)]
+
+    return MicroBatcher("faiss", search, config.SEARCH_BATCH_SIZE, config.SEARCH_BATCH_WAIT_MS / 1000)
@@ -1,11 +1,20 @@
+import re
+import threading
 from abc import ABC, abstractmethod
+from collections import Counter, defaultdict
+from answer_cache import normalize_query
 
 
 class BaseHandler(ABC):
 
+    # Metadata fields matched word by word when embeddings are unavailable
+    LEXICAL_FIELDS = ()
+
     def __init__(self, embedder, details_loader):
         self.embedder = embedder
         self.details_loader = details_loader
+        self._word_index = None
+        self._word_index_lock = threading.Lock()
 
     @abstractmethod
     def get_content_type(self):
@@ -28,6 +37,42 @@ class BaseHandler(ABC):
 
         return filtered
 
+    def lexical_search(self, query, k=10):
+        """
+        Items sharing the most words with the query, for when embeddings are
+        unavailable. distance is the share of query words an item lacks, so
+        the usual distance thresholds still apply.
+        """
+        words = {w for w in re.findall(r'\w+', normalize_query(query)) if len(w) > 2}
+        if not words:
+            return []
+
+        scores = Counter()
+        index = self._lexical_index()
+        for word in words:
+            scores.update(index.get(word, ()))
+
+        results = []
+        for row_id, score in scores.most_common(k):
+            result = dict(self.embedder.metadata_map[row_id])
+            result['distance'] = 1.0 - score / len(words)
+            results.append(result)
+        return results
+
+    def _lexical_index(self):
+        # Word -> row ids, built on first use from the index metadata
+        with self._word_index_lock:
+            if self._word_index is None:
+                print(f"🔤 Building the {self.get_content_type()} word index...")
+                index = defaultdict(set)
+                for row_id, metadata in self.embedder.metadata_map.items():
+                    text = " ".join(str(metadata.get(field) or '') for field in self.LEXICAL_FIELDS)
+                    for word in re.findall(r'\w+', normalize_query(text)):
+                        if len(word) > 2:
+                            index[word].add(row_id)
+                self._word_index = index
+            return self._word_index
+
     def enrich_result(self, result):
         row_id = result.get('رديف')
         if not row_id:
@@ -2,6 +2,8 @@ from modules.base_handler import BaseHandler
 
 
 class BookHandler(BaseHandler):
+    LEXICAL_FIELDS = ('عنوان', 'پديدآورنده', 'موضوع', 'رده اصلي')
+
     def get_content_type(self):
         return 'book'
 
@@ -1,30 +1,52 @@
+import re
 from modules.base_handler import BaseHandler
+from answer_cache import normalize_query
+from regulations_loader import NUMBER_PATTERN, parse_number
+
+# Words that do not identify a document ("آیین‌نامه اهدا" -> "اهدا")
+GENERIC_DOCUMENT_WORDS = {'آیین', 'آئین', 'نامه', 'قوانین', 'قانون', 'مقررات', 'دستورالعمل', 'کتابخانه', 'دانشگاه', 'خوارزمی'}
+
+# Words that can surround a plain article reference ("ماده 2 چی میگه؟")
+REFERENCE_FILLER_WORDS = GENERIC_DOCUMENT_WORDS | {
+    'ماده', 'تبصره', 'متن', 'چیه', 'چی', 'چیست', 'چه', 'میگه', 'می', 'گه', 'گوید', 'را', 'رو',
+    'بگو', 'بده', 'نشون', 'نشان', 'کامل', 'لطفا', 'لطفاً', 'در', 'از', 'و', 'به', 'هست', 'است',
+    'مربوط', 'میخوام', 'بخون', 'ببینم', 'کن', 'بنویس', 'اون', 'این',
+}
 
 
 class RegulationsHandler(BaseHandler):
-    def __init__(self, regulations_text):
-        # This handler doesn't use embedder
-        super().__init__(embedder=None, details_loader=None)
+    def __init__(self, regulations_text, chunks=None, embedder=None, article_index=None):
+        # The embedder (if any) indexes regulation chunks; there are no details to load
+        super().__init__(embedder=embedder, details_loader=None)
         self.regulations_text = regulations_text
+        self.chunks = chunks or []
+        self.article_index = article_index or {}
+        self._document_words = {
+            document: self._significant_words(document) for document in self.article_index
+        }
 
     def get_content_type(self):
         return 'regulations'
 
     def format_result(self, result):
+        """Format a regulation chunk for the model context"""
+        if isinstance(result, dict):
+            return f"📋 {result['document']} - {result['title']}\n{result['text']}"
         return result
 
+    def build_context(self, chunks):
+        return "\n\n".join(self.format_result(c) for c in chunks)
+
     def get_system_prompt(self):
-        """System prompt for regulations"""
-        return f"""
+        """System prompt for regulations (the relevant articles come with each question)"""
+        return """
 شما یک دستیار هوشمند قوانین و مقررات کتابخانه دانشگاه خوارزمی هستید.
 
-**متن کامل قوانین و آیین‌نامه‌ها:**
-
-{self.regulations_text}
+همراه هر سوال، بخش‌های مرتبط از قوانین و آیین‌نامه‌ها (با نام آیین‌نامه و شماره ماده) ارسال می‌شود.
 
 **قوانین مهم پاسخ‌دهی:**
 
-1. **فقط از قوانین بالا استفاده کنید:**
+1. **فقط از بخش‌های ارسال شده از قوانین استفاده کنید:**
    - اگر سوال در قوانین جواب دارد، دقیق پاسخ دهید
    - اگر سوال خارج از قوانین موجود است، بگویید: "این موضوع در قوانین و آیین‌نامه‌های فعلی کتابخانه ذکر نشده است. لطفاً با کتابخانه تماس بگیرید."
 
@@ -66,8 +88,122 @@ class RegulationsHandler(BaseHandler):
 **توجه:** هرگز قوانین جعلی ننویسید. اگر جواب نیست، صادقانه بگویید!
 """
 
-    def search(self, query, k=10, distance_threshold=0.8):
-        return []
+    @staticmethod
+    def _significant_words(document):
+        words = normalize_query(document.replace('_', ' ').replace('-', ' ')).split()
+        return {w for w in words if w not in GENERIC_DOCUMENT_WORDS and len(w) > 1}
+
+    @staticmethod
+    def _word_matches(word, query_words):
+        # "اهدا" matches "اهدایی" and the other way round
+        stem = word[:4]
+        return any(q.startswith(stem) or word.startswith(q[:4]) for q in query_words if len(q) > 2)
+
+    def resolve_reference(self, query):
+        """
+        Find the article a question names ("ماده 2 آیین‌نامه اهدا").
+
+        Returns None if no article is named, otherwise a dict with the matched
+        document, article and note, the candidate documents when the name is
+        ambiguous, and whether the question is a plain lookup (direct).
+        """
+        if not self.article_index:
+            return None
+
+        normalized = normalize_query(query)
+        article_match = re.search(r'ماده\s*' + NUMBER_PATTERN, normalized)
+        if not article_match:
+            return None
+
+        article_no = parse_number(article_match.group(1))
+        note_match = re.search(r'تبصره\s*' + NUMBER_PATTERN, normalized)
+        note_no = parse_number(note_match.group(1)) if note_match else None
+
+        query_words = set(normalized.split())
+        candidates = [doc for doc, articles in self.article_index.items() if article_no in articles]
+        if not candidates:
+            return None
+
+        scored = sorted(
+            ((sum(1 for w in self._document_words[doc] if self._word_matches(w, query_words)), doc) for doc in candidates),
+            reverse=True
+        )
+        if scored[0][0] > 0:
+            document = scored[0][1]
+        elif len(candidates) == 1:
+            document = candidates[0]
+        else:
+            document = None
+
+        # Anything left besides the reference itself makes it a free-form question
+        leftover = [
+            w for w in query_words
+            if w not in REFERENCE_FILLER_WORDS and parse_number(w) is None
+            and not (document and self._word_matches(w, self._document_words[document]))
+        ]
+
+        article = self.article_index[document][article_no] if document else None
+        note = article['notes'].get(note_no) if article and note_no else None
+
+        return {
+            'document': document,
+            'candidates': candidates,
+            'article_no': article_no,
+            'article': article,
+            'note_no': note_no if note else None,
+            'note': note,
+            'direct': len(leftover) <= 1,
+        }
+
+    def format_reference_answer(self, reference):
+        """Extractive answer for a direct article reference"""
+        if reference['document'] is None:
+            documents = "\n".join(f"• {doc}" for doc in reference['candidates'])
+            return (
+                f"📋 ماده {reference['article_no']} در چند آیین‌نامه وجود دارد:\n\n{documents}\n\n"
+                f"لطفاً نام آیین‌نامه را هم بنویسید، مثلاً: «ماده {reference['article_no']} {reference['candidates'][0]}»"
+            )
+
+        article = reference['article']
+        if reference['note']:
+            label = f"تبصره {reference['note_no']} {article['title']}"
+            text = reference['note']
+        else:
+            label = article['title']
+            text = article['text']
+
+        return f"📋 متن {label}:\n\n{text}\n\nℹ️ مرجع: {reference['document']} - {label}"
+
+    def reference_chunk(self, reference):
+        """The referenced article as a context chunk for free-form questions"""
+        article = reference['article']
+        return {'document': reference['document'], 'title': article['title'], 'text': article['text']}
+
+    def search(self, query, k=5, distance_threshold=None, query_vector=None):
+        """Most relevant chunks for a question (lexical matching if embeddings are unavailable)"""
+        if self.embedder is not None:
+            if query_vector is not None:
+                results = self.embedder.search_vector(query_vector, k)
+            else:
+                results = self.embedder.search(query, k)
+            if results:
+                return results
+        return self.lexical_search(query, k)
+
+    def lexical_search(self, query, k=5):
+        words = {w for w in re.findall(r'\w+', query) if len(w) > 2}
+        if not words:
+            return []
+
+        scored = []
+        for chunk in self.chunks:
+            haystack = f"{chunk['document']} {chunk['title']} {chunk['text']}"
+            score = sum(1 for w in words if w in haystack)
+            if score:
+                scored.append((score, chunk))
+
+        scored.sort(key=lambda item: -item[0])
+        return [chunk for _, chunk in scored[:k]]
 
     def get_filters(self):
         return None
@@ -2,6 +2,7 @@ from modules.base_handler import BaseHandler
 
 
 class ThesisHandler(BaseHandler):
+    LEXICAL_FIELDS = ('عنوان پایان‌نامه', 'عنوان', 'نویسنده', 'استاد راهنما', 'رشته')
 
     def get_content_type(self):
         return 'thesis'
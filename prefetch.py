@@ -0,0 +1,93 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+import config
+import deadline
+import metrics
+
+
+class Prefetcher:
+    """
+    Work for the likely next turn of a chat, done in the background.
+
+    After an answer the bot submits what the next message will probably
+    need (the next page of results, the explanation of the top result).
+    Results stay usable for config.PREFETCH_TTL seconds, cancel() drops
+    them when the chat moves to a new query, and take() hands a result
+    over once, waiting for it if it is still being computed. The work is
+    queued for admission with the chat that submitted it, without the
+    deadline of the message it was submitted from.
+    """
+
+    def __init__(self, name, max_workers=None):
+        self.name = name
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or config.PREFETCH_WORKERS,
+            thread_name_prefix=f"{name}-prefetch"
+        )
+        self._tasks = {}  # chat_id -> {key: (future, expires_at)}
+        self._lock = threading.Lock()
+        self._next_prune = 0.0
+
+    def _run(self, key, fn, args):
+        deadline.clear()
+        try:
+            return fn(*args)
+        except Exception as e:
+            print(f"⚠️ {self.name} prefetch '{key}' failed: {e}")
+            return None
+
+    def submit(self, chat_id, key, fn, *args):
+        """Compute fn(*args) for a later take(chat_id, key)"""
+        future = self._executor.submit(contextvars.copy_context().run, self._run, key, fn, args)
+        now = time.monotonic()
+        with self._lock:
+            replaced = self._tasks.setdefault(chat_id, {}).get(key)
+            self._tasks[chat_id][key] = (future, now + config.PREFETCH_TTL)
+            self._prune(now)
+        if replaced:
+            replaced[0].cancel()
+
+    def warm(self, fn, *args):
+        """Run fn(*args) in the background for its side effects (e.g. filling caches)"""
+        self._executor.submit(contextvars.copy_context().run, self._run, fn.__name__, fn, args)
+
+    def take(self, chat_id, key):
+        """The prefetched result, or None if there is none or it expired"""
+        with self._lock:
+            task = self._tasks.get(chat_id, {}).pop(key, None)
+        if task is None:
+            return None
+
+        future, expires_at = task
+        if time.monotonic() > expires_at:
+            future.cancel()
+            return None
+        try:
+            value = deadline.wait(future, f"{self.name}.prefetch")
+        except (CancelledError, deadline.DeadlineExceeded):
+            return None
+        if value is not None:
+            metrics.increment(f"{self.name}.prefetch_hit")
+            print(f"⚡ {self.name}: prefetched '{key}' used")
+        return value
+
+    def cancel(self, chat_id):
+        """Forget everything prefetched for a chat (results still running are discarded)"""
+        with self._lock:
+            tasks = self._tasks.pop(chat_id, {})
+        for future, _ in tasks.values():
+            future.cancel()
+
+    def _prune(self, now):
+        # Called with _lock held; drops expired results of chats that never came back
+        if now < self._next_prune:
+            return
+        self._next_prune = now + config.PREFETCH_TTL
+        for chat_id in list(self._tasks):
+            tasks = self._tasks[chat_id]
+            for key in [k for k, (_, expires_at) in tasks.items() if expires_at < now]:
+                del tasks[key]
+            if not tasks:
+                del self._tasks[chat_id]
@@ -0,0 +1,79 @@
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+import config
+import metrics
+
+BUSY_REPLY = "⏳ ربات در این لحظه پیام‌های زیادی دریافت کرده است. لطفاً یک دقیقه دیگر دوباره بپرسید."
+
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """
+    Two lanes for the updates of the bot.
+
+    Cheap updates (the given commands and all menu buttons) run at once, up
+    to config.PRIORITY_UPDATES at a time. Messages that may need the model
+    run at most `workers` at a time; up to config.UPDATE_QUEUE_LIMIT more
+    wait for a turn outside the priority lane, and the next ones are
+    answered at once with BUSY_REPLY. /start and the menu stay responsive
+    during a burst of questions.
+    """
+
+    def __init__(self, workers, cheap_commands=()):
+        super().__init__(config.PRIORITY_UPDATES)
+        self.workers = workers
+        self.cheap_commands = set(cheap_commands)
+        self._slots = None
+        self._waiting = 0
+        self._tasks = set()
+
+    def is_cheap(self, update):
+        if not isinstance(update, Update) or update.callback_query is not None:
+            return True
+        text = (update.message.text or '') if update.message else ''
+        if not text.startswith('/'):
+            return False
+        command = text[1:].split(maxsplit=1)[0].split('@')[0] if len(text) > 1 else ''
+        return command in self.cheap_commands
+
+    async def do_process_update(self, update, coroutine):
+        if self.is_cheap(update):
+            await coroutine
+            return
+
+        if self._waiting >= config.UPDATE_QUEUE_LIMIT:
+            coroutine.close()
+            metrics.increment("updates.rejected")
+            print(f"🚦 {self._waiting} messages waiting, update rejected")
+            if update.effective_message:
+                try:
+                    await update.effective_message.reply_text(BUSY_REPLY)
+                except Exception as e:
+                    print(f"⚠️ Busy reply failed: {e}")
+            return
+
+        # Waits for its turn in a task of its own, freeing the priority lane's slot
+        self._waiting += 1
+        task = asyncio.create_task(self._run(coroutine))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, coroutine):
+        try:
+            await self._slots.acquire()
+        except asyncio.CancelledError:
+            coroutine.close()
+            raise
+        finally:
+            self._waiting -= 1
+        try:
+            await coroutine
+        finally:
+            self._slots.release()
+
+    async def initialize(self):
+        self._slots = asyncio.Semaphore(self.workers)
+
+    async def shutdown(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -1,35 +1,95 @@
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from openai import OpenAI
 import config
 from regulations_loader import RegulationsLoader
+from regulations_embedder import RegulationsEmbedder
+from semantic_cache import SemanticCache
 from modules.regulations_handler import RegulationsHandler
-from collections import defaultdict
+from llm_client import create_chat_completion, get_openai_client
+from context_builder import ContextBuilder, RollingSummary
+from intent_router import IntentRouter
+from fast_answers import whole_words
+from stream_reply import StreamingReply
+from session_store import ChatSession, SessionManager, schedule_expiry
+from deadline import DeadlineExceeded, bounded
+from circuit_breaker import CircuitOpen
 from datetime import datetime, timedelta
+import asyncio
+import threading
 
-openai_client = OpenAI(api_key=config.OPENAI_API_KEY)
-regulations_handler = None
-conversation_memory = defaultdict(list)
-last_message_time = defaultdict(lambda: datetime.now())
+REGULATIONS_DIR = "data/regulations"
+
+# Messages that continue the previous question ("بیشتر توضیح بده", "این یعنی چی")
+ROUTER = IntentRouter(patterns={
+    'followup': [whole_words([
+        'بیشتر', 'توضیح', 'یعنی', 'منظور', 'ادامه', 'جزئیات', 'مثال', 'چرا',
+        'این', 'اون', 'آن', 'همین', 'همون', 'اینو', 'اونو', 'پس', 'دیگه'
+    ])],
+})
+
+# Follow-ups longer than this are retrieved on their own
+FOLLOWUP_MAX_WORDS = 6
+
+# Reply when a message runs past config.REQUEST_DEADLINE before the articles are found
+TIMEOUT_REPLY = "⏳ پاسخ‌گویی بیش از حد طول کشید. لطفاً چند لحظه دیگر دوباره بپرسید."
+
+openai_client = get_openai_client()
+# (handler, context builder) of the loaded regulations, replaced together on reload
+loaded_regulations = None
+regulations_fingerprint = None
+# One check (and reload) at a time; messages go on with the loaded regulations
+reload_lock = threading.Lock()
+faq_cache = SemanticCache("regulations.faq_cache", path=config.REGULATIONS_FAQ_CACHE_PATH)
 
 
 def initialize_handler():
     """Load regulations"""
-    global regulations_handler
+    global loaded_regulations, regulations_fingerprint
 
     print("🔄 Loading regulations...")
 
     try:
         # Load regulations text
-        loader = RegulationsLoader("data/regulations")
+        loader = RegulationsLoader(REGULATIONS_DIR)
         regulations_text = loader.get_regulations_text()
 
         if not regulations_text:
             print("❌ Regulations text is empty!")
             return False
 
+        # Split into articles and index them
+        chunks = loader.get_chunks()
+        print(f"📊 {len(chunks)} regulation chunks")
+
+        embedder = None
+        try:
+            embedder = RegulationsEmbedder(api_key=config.OPENAI_API_KEY)
+            embedder.build_index(chunks)
+        except Exception as e:
+            print(f"⚠️ Regulations index unavailable, using keyword matching: {e}")
+            embedder = None
+
         # Create handler
-        regulations_handler = RegulationsHandler(regulations_text)
+        handler = RegulationsHandler(
+            regulations_text,
+            chunks=chunks,
+            embedder=embedder,
+            article_index=loader.article_index
+        )
+        builder = ContextBuilder(
+            "regulations",
+            handler.get_system_prompt(),
+            summary=history_summary,
+            history_limit=5
+        )
+
+        # Swapped in one assignment: a message being answered sees the old
+        # regulations or the new ones, never half of each
+        loaded_regulations = (handler, builder)
+        regulations_fingerprint = loader.fingerprint
+
+        # Cached answers are only valid for the regulations they were generated from
+        faq_cache.load(regulations_fingerprint)
 
         print("✅ Regulations loaded successfully")
         return True
@@ -39,87 +99,172 @@ def initialize_handler():
         return False
 
 
-def clean_old_conversations():
-    """Clean up old conversations"""
-    current_time = datetime.now()
-    expired_chats = []
+def reload_if_changed():
+    """Reload regulations (and empty the FAQ cache) when the files changed"""
+    if not reload_lock.acquire(blocking=False):
+        return
+    try:
+        if RegulationsLoader.files_fingerprint(REGULATIONS_DIR) != regulations_fingerprint:
+            print("🔄 Regulations files changed, reloading...")
+            initialize_handler()
+    finally:
+        reload_lock.release()
+
+
+def schedule_reload(application):
+    """Run reload_if_changed periodically from the bot's JobQueue, off the message handlers"""
+    if application.job_queue is None:
+        print("⚠️ JobQueue unavailable (install python-telegram-bot[job-queue]), regulations are not reloaded")
+        return
+
+    async def check_regulations(context):
+        await asyncio.to_thread(reload_if_changed)
+
+    application.job_queue.run_repeating(
+        check_regulations,
+        interval=config.REGULATIONS_RELOAD_CHECK_INTERVAL,
+        first=config.REGULATIONS_RELOAD_CHECK_INTERVAL
+    )
+
+
+def new_session():
+    return ChatSession()
+
 
-    for chat_id, last_time in last_message_time.items():
-        if current_time - last_time > timedelta(days=7):
-            expired_chats.append(chat_id)
+# Per-chat state, kept in the session store so it survives restarts
+# (idle sessions are expired by session_store.expire_idle_sessions)
+sessions = SessionManager("regulations", new_session)
+history_summary = RollingSummary("regulations", openai_client, sessions)
 
-    for chat_id in expired_chats:
-        conversation_memory.pop(chat_id, None)
-        last_message_time.pop(chat_id, None)
+
+def reset_conversation(chat_id):
+    """Forget the conversation of a chat"""
+    sessions.reset(chat_id)
 
 
 def add_to_conversation(chat_id, role, content):
     """Add message to memory"""
-    conversation_memory[chat_id].append({
+    history = sessions.get(chat_id).history
+    history.append({
         "role": role,
         "content": content,
         "timestamp": datetime.now()
     })
 
-    # Keep last 20 messages
-    if len(conversation_memory[chat_id]) > 20:
-        conversation_memory[chat_id] = conversation_memory[chat_id][-20:]
-
-    last_message_time[chat_id] = datetime.now()
+    # Keep at most 20 messages, dropping old ones a whole window step at a time
+    # so the history sent to the model keeps its prefix
+    if len(history) > 20:
+        for _ in range(config.HISTORY_WINDOW_STEP):
+            history.popleft()
 
 
 def get_conversation_history(chat_id, limit=10):
-    """Get conversation history"""
-    if chat_id not in conversation_memory:
-        return []
+    """Get conversation history (all of it if limit is None)"""
+    history = list(sessions.peek(chat_id).history)
+    return history[-limit:] if limit else history
 
-    return conversation_memory[chat_id][-limit:]
-
-
-def generate_response(user_query, chat_id):
-    """Generate response to user query"""
-    clean_old_conversations()
 
+@bounded(config.REQUEST_DEADLINE, lambda: TIMEOUT_REPLY)
+def generate_response(user_query, chat_id, on_delta=None):
+    """Generate response to user query (streamed to on_delta if given)"""
     # Greetings
     greetings = ['سلام', 'درود', 'صبح بخیر', 'hello', 'hi']
     if any(g in user_query.lower() for g in greetings) and len(user_query.split()) <= 3:
         return "سلام! 👋\n\nمن دستیار قوانین کتابخانه هستم.\nسوال خود را درباره قوانین، آیین‌نامه‌ها و مقررات کتابخانه بپرسید.\n\n**مثال:**\n• چطور کتاب اهدا کنم؟\n• شرایط استفاده از پایان‌نامه‌ها چیه؟\n• چطور فرم اهدا پر کنم؟"
 
-    # Get history
-    history = get_conversation_history(chat_id, limit=5)
-
-    # Build messages for GPT
-    messages = [
-        {"role": "system", "content": regulations_handler.get_system_prompt()}
-    ]
-
-    # Add history
-    for h in history:
-        messages.append({
-            "role": h["role"],
-            "content": h["content"][:500]  # محدود کردن طول
-        })
+    regulations_handler, context_builder = loaded_regulations
 
-    # Add new query
-    messages.append({"role": "user", "content": user_query})
+    # Questions naming an article are answered from its text directly
+    reference = regulations_handler.resolve_reference(user_query)
+    if reference and reference['direct']:
+        print(f"📑 Direct article lookup: ماده {reference['article_no']} ({reference['document']})")
+        answer = regulations_handler.format_reference_answer(reference)
+        add_to_conversation(chat_id, "user", user_query)
+        add_to_conversation(chat_id, "assistant", answer)
+        return answer
+
+    # Get history (the window sent to the model is chosen in build_messages)
+    history = get_conversation_history(chat_id, limit=None)
+
+    # Short follow-ups ("بیشتر توضیح بده") are retrieved together with the previous
+    # question; any other message, however short ("ماده ۱۲"), stands on its own
+    retrieval_query = user_query
+    previous_questions = [h["content"] for h in history if h["role"] == "user"]
+    route = ROUTER.route(user_query)
+    if previous_questions and route.has('followup') and route.word_count <= FOLLOWUP_MAX_WORDS:
+        retrieval_query = f"{previous_questions[-1]} {user_query}"
+
+    # Standalone questions go through the FAQ cache; the query vector is reused for retrieval
+    query_vector = None
+    is_standalone = retrieval_query == user_query
+    if regulations_handler.embedder is not None:
+        query_vector = regulations_handler.embedder.embed_query(retrieval_query)
+    if is_standalone and query_vector is not None:
+        cached_answer = faq_cache.lookup(query_vector)
+        if cached_answer is not None:
+            add_to_conversation(chat_id, "user", user_query)
+            add_to_conversation(chat_id, "assistant", cached_answer)
+            return cached_answer
+
+    relevant_chunks = regulations_handler.search(
+        retrieval_query,
+        k=config.REGULATIONS_TOP_K,
+        query_vector=query_vector
+    )
+    if reference and reference['article']:
+        # The named article always comes first
+        pinned = regulations_handler.reference_chunk(reference)
+        relevant_chunks = [pinned] + [
+            c for c in relevant_chunks
+            if (c['document'], c['title']) != (pinned['document'], pinned['title'])
+        ][:config.REGULATIONS_TOP_K - 1]
+    print(f"📋 Regulations: {len(relevant_chunks)} chunks")
+
+    # Build messages for GPT: the relevant articles go with the new query,
+    # after the system prompt and history that stay the same between turns
+    messages = context_builder.build(
+        chat_id,
+        history,
+        "بخش‌های مرتبط از قوانین:\n\n{context}\n\nسوال: {query}",
+        [regulations_handler.format_result(c) for c in relevant_chunks] or ['موردی پیدا نشد.'],
+        separator="\n\n",
+        query=user_query
+    )
 
     try:
         # Send to GPT
-        response = openai_client.chat.completions.create(
-            model=config.GPT_MODEL,
-            messages=messages,
+        assistant_response = create_chat_completion(
+            openai_client,
+            messages,
             max_tokens=800,
-            temperature=0.3
+            temperature=0.3,
+            on_delta=on_delta,
+            stage="regulations.answer"
         )
 
-        assistant_response = response.choices[0].message.content
-
         # Save to memory
         add_to_conversation(chat_id, "user", user_query)
         add_to_conversation(chat_id, "assistant", assistant_response)
 
+        if is_standalone and query_vector is not None:
+            faq_cache.add(user_query, query_vector, assistant_response)
+
         return assistant_response
 
+    except (DeadlineExceeded, CircuitOpen) as e:
+        if isinstance(e, CircuitOpen):
+            if not relevant_chunks:
+                return "⚠️ دستیار هوشمند موقتاً در دسترس نیست. لطفاً کمی بعد دوباره بپرسید."
+            header = "⚠️ دستیار هوشمند موقتاً در دسترس نیست؛ بخش‌های مرتبط قوانین:"
+        elif not relevant_chunks:
+            raise
+        else:
+            header = "⏳ پاسخ کامل آماده نشد؛ این بخش‌های قوانین به سوال شما مربوط است:"
+        # The articles are found; they are sent as they are
+        return header + "\n\n" + "\n\n".join(
+            regulations_handler.format_result(c) for c in relevant_chunks[:2]
+        )
+
     except Exception as e:
         print(f"❌ Error generating response: {e}")
         return "متأسفم، مشکلی پیش آمد. لطفاً دوباره تلاش کنید."
@@ -151,7 +296,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def new_conversation_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start new conversation"""
     chat_id = update.effective_chat.id
-    conversation_memory.pop(chat_id, None)
+    reset_conversation(chat_id)
 
     await update.message.reply_text(
         "✅ مکالمه جدید شروع شد!\n\n"
@@ -189,11 +334,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Show typing indicator
     await update.message.chat.send_action(action="typing")
 
-    # Generate response
-    response = generate_response(user_message, chat_id)
-
-    # Send response
-    await update.message.reply_text(response)
+    # Generate response, streaming it into one message
+    reply = StreamingReply(update.message)
+    reply.start()
+    try:
+        response = await asyncio.to_thread(generate_response, user_message, chat_id, reply.push)
+        await reply.finish(response)
+    finally:
+        await reply.stop()
 
 
 def main():
@@ -210,6 +358,8 @@ def main():
     # Create Application
     TELEGRAM_BOT_TOKEN = "YOUR_TELEGRAM_BOT_TOKEN_HERE"
     app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    schedule_expiry(app)
+    schedule_reload(app)
 
     # Handlers
     app.add_handler(CommandHandler("start", start_command))
@@ -0,0 +1,95 @@
+import hashlib
+import pickle
+from pathlib import Path
+import numpy as np
+import faiss
+import config
+from llm_client import get_embeddings
+from deadline import DeadlineExceeded
+from micro_batch import embedding_batcher, search_batcher
+from answer_cache import normalize_query
+import single_flight
+
+# Chunk vectors are cached by text hash so only changed articles are re-embedded
+VECTORS_CACHE_PATH = "output/regulations/chunk_vectors.pkl"
+
+
+def chunk_embedding_text(chunk):
+    return f"{chunk['document']} - {chunk['title']}\n{chunk['text']}"
+
+
+class RegulationsEmbedder:
+    def __init__(self, api_key=None):
+        print("🔧 Initializing regulations embedder...")
+        self.embedding_client = get_embeddings(config.EMBEDDING_MODEL, api_key)
+        self.index = None
+        self.chunks = []
+        self._embed = embedding_batcher(self.embedding_client)
+        self._search = search_batcher(lambda: self.index)
+
+    def build_index(self, chunks, cache_path=VECTORS_CACHE_PATH, batch_size=100):
+        print(f"🔄 Indexing {len(chunks)} regulation chunks...")
+        if not chunks:
+            self.index, self.chunks = None, []
+            return
+
+        cache = {}
+        if Path(cache_path).exists():
+            try:
+                with open(cache_path, 'rb') as f:
+                    cache = pickle.load(f)
+            except Exception as e:
+                print(f"⚠️ Ignoring unreadable vector cache: {e}")
+
+        texts = [chunk_embedding_text(c) for c in chunks]
+        hashes = [hashlib.sha1(t.encode('utf-8')).hexdigest() for t in texts]
+
+        missing = [(h, t) for h, t in zip(hashes, texts) if h not in cache]
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            vectors = self.embedding_client.embed_documents([t for _, t in batch])
+            for (h, _), vector in zip(batch, vectors):
+                cache[h] = vector
+        print(f"   🌐 Embedded {len(missing)} new chunks, {len(chunks) - len(missing)} from cache")
+
+        # Keep only vectors of the current chunks
+        cache = {h: cache[h] for h in hashes}
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, 'wb') as f:
+            pickle.dump(cache, f)
+
+        vectors = np.array([cache[h] for h in hashes], dtype='float32')
+        self.index = faiss.IndexFlatL2(vectors.shape[1])
+        self.index.add(vectors)
+        self.chunks = chunks
+
+        print(f"✅ Regulations index ready ({self.index.ntotal} chunks)")
+
+    def embed_query(self, query):
+        try:
+            vector = single_flight.shared("embedding").do(
+                (self.embedding_client.model, normalize_query(query)), self._embed, query
+            )
+            return np.array([vector], dtype='float32')
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print(f"❌ Error embedding query: {e}")
+            return None
+
+    def search_vector(self, query_vector, k=5):
+        if self.index is None or query_vector is None:
+            return []
+
+        distances, indices = self._search((query_vector, min(k, self.index.ntotal)))
+
+        results = []
+        for idx, dist in zip(indices[0], distances[0]):
+            if idx != -1:
+                result = self.chunks[int(idx)].copy()
+                result['distance'] = float(dist)
+                results.append(result)
+        return results
+
+    def search(self, query, k=5):
+        return self.search_vector(self.embed_query(query), k)
@@ -1,13 +1,59 @@
 from docx import Document
+import hashlib
 import os
+import re
+
+
+NUMBER_WORDS = {
+    'یک': 1, 'اول': 1, 'واحده': 1, 'دو': 2, 'دوم': 2, 'سه': 3, 'سوم': 3,
+    'چهار': 4, 'چهارم': 4, 'پنج': 5, 'پنجم': 5, 'شش': 6, 'ششم': 6,
+    'هفت': 7, 'هفتم': 7, 'هشت': 8, 'هشتم': 8, 'نه': 9, 'نهم': 9, 'ده': 10, 'دهم': 10,
+}
+
+# An article or note number: digits (any script) or a number word
+NUMBER_PATTERN = r'([0-9۰-۹٠-٩]+|' + '|'.join(sorted(NUMBER_WORDS, key=len, reverse=True)) + r')(?![آ-ی])'
+
+# Start of an article: "ماده ۲", "ماده 2-", "ماده دوم", "ماده واحده"
+ARTICLE_HEADING = re.compile(r'^\s*ماده\s*' + NUMBER_PATTERN)
+
+# Start of a note (تبصره) inside an article, optionally numbered
+NOTE_HEADING = re.compile(r'^\s*تبصره(?:\s*' + NUMBER_PATTERN + r'|(?![آ-ی]))')
+
+# Maximum characters per chunk sent to the model
+MAX_CHUNK_CHARS = 1500
+
+
+def parse_number(token):
+    """'۲', '2', '٢' or 'دوم' -> 2"""
+    if token is None:
+        return None
+    digits = token.translate(str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789'))
+    if digits.isdigit():
+        return int(digits)
+    return NUMBER_WORDS.get(token)
 
 
 class RegulationsLoader:
     def __init__(self, regulations_dir="data/regulations"):
         self.regulations_dir = regulations_dir
         self.regulations_text = ""
+        self.documents = []  # (file name, text) pairs
+        self.article_index = {}  # document -> article number -> article
+        self.fingerprint = self.files_fingerprint(regulations_dir)
         self.load_all_regulations()
 
+    @staticmethod
+    def files_fingerprint(regulations_dir):
+        """Changes whenever a regulations file is added, removed or modified"""
+        if not os.path.exists(regulations_dir):
+            return None
+        digest = hashlib.sha1()
+        for filename in sorted(os.listdir(regulations_dir)):
+            if filename.endswith('.docx'):
+                stat = os.stat(os.path.join(regulations_dir, filename))
+                digest.update(f"{filename}|{stat.st_size}|{stat.st_mtime_ns}\n".encode('utf-8'))
+        return digest.hexdigest()
+
     def extract_text_from_docx(self, file_path):
         try:
             doc = Document(file_path)
@@ -57,6 +103,8 @@ class RegulationsLoader:
             text = self.extract_text_from_docx(file_path)
 
             if text:
+                self.documents.append((filename, text))
+
                 # Add file title
                 regulations_parts.append(f"\n{'='*60}")
                 regulations_parts.append(f"📋 {filename}")
@@ -65,6 +113,7 @@ class RegulationsLoader:
 
         # Combine all texts
         self.regulations_text = "\n".join(regulations_parts)
+        self.article_index = self.build_article_index()
 
         print(f"✅ {len(docx_files)} regulation files loaded")
         print(f"📊 Text volume: {len(self.regulations_text)} characters")
@@ -72,6 +121,101 @@ class RegulationsLoader:
     def get_regulations_text(self):
         return self.regulations_text
 
+    def get_chunks(self, max_chars=MAX_CHUNK_CHARS):
+        """
+        Split the regulations into article-aware chunks.
+
+        Every chunk belongs to one article (ماده) of one document. Long
+        articles are split at their notes (تبصره), and every continuation
+        repeats the article heading so it can be understood on its own.
+        """
+        chunks = []
+        for filename, text in self.documents:
+            document = os.path.splitext(filename)[0]
+            for title, lines in self._split_articles(text):
+                for body in self._pack_lines(lines, title, max_chars):
+                    chunks.append({
+                        'id': len(chunks),
+                        'document': document,
+                        'title': title,
+                        'text': body,
+                    })
+        return chunks
+
+    def build_article_index(self):
+        """
+        Structured view of the regulations: documents -> articles -> notes.
+
+        {document: {2: {'title': 'ماده 2', 'text': ..., 'notes': {1: ...}}}}
+        """
+        index = {}
+        for filename, text in self.documents:
+            articles = {}
+            for title, lines in self._split_articles(text):
+                match = ARTICLE_HEADING.match(lines[0])
+                if not match:
+                    continue  # Text before the first article
+
+                notes = {}
+                current = None
+                for line in lines[1:]:
+                    note = NOTE_HEADING.match(line)
+                    if note:
+                        current = parse_number(note.group(1)) or len(notes) + 1
+                        notes[current] = [line]
+                    elif current is not None:
+                        notes[current].append(line)
+
+                # Numbering may restart in a document; the first article wins
+                articles.setdefault(parse_number(match.group(1)), {
+                    'title': title,
+                    'text': "\n".join(lines),
+                    'notes': {n: "\n".join(note_lines) for n, note_lines in notes.items()},
+                })
+            index[os.path.splitext(filename)[0]] = articles
+
+        print(f"📑 Article index: {sum(len(a) for a in index.values())} articles in {len(index)} documents")
+        return index
+
+    def _split_articles(self, text):
+        sections = []
+        title, lines = "مقدمه", []
+
+        for line in text.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+            if ARTICLE_HEADING.match(line):
+                if lines:
+                    sections.append((title, lines))
+                title = ARTICLE_HEADING.match(line).group(0).strip()
+                lines = []
+            lines.append(line)
+
+        if lines:
+            sections.append((title, lines))
+        return sections
+
+    def _pack_lines(self, lines, title, max_chars):
+        # Group lines into pieces that start at each note
+        pieces = []
+        for line in lines:
+            if not pieces or NOTE_HEADING.match(line):
+                pieces.append([line])
+            else:
+                pieces[-1].append(line)
+
+        bodies, current = [], []
+        for piece in pieces:
+            for line in piece if len("\n".join(piece)) > max_chars else ["\n".join(piece)]:
+                if current and len("\n".join(current)) + len(line) > max_chars:
+                    bodies.append("\n".join(current))
+                    current = [f"({title} - ادامه)"]
+                current.append(line)
+        if current:
+            bodies.append("\n".join(current))
+        return bodies
+
 
 if __name__ == "__main__":
     print("="*60)
@@ -0,0 +1,99 @@
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+import config
+import metrics
+from circuit_breaker import CircuitOpen
+
+
+class Collection:
+    """
+    One searchable index: its embedder, how its raw results are completed
+    and, optionally, a word search used while embeddings are unavailable.
+    """
+
+    def __init__(self, name, embedder, enrich=None, threshold=0.8, lexical=None):
+        self.name = name
+        self.embedder = embedder
+        self.enrich = enrich or (lambda result: result)
+        self.threshold = threshold
+        self.lexical = lexical
+
+    def search(self, query, query_vector, k):
+        if query_vector is not None:
+            found = self.embedder.search_vector(query_vector, k)
+        elif self.lexical is not None:
+            found = self.lexical(query, k)
+        else:
+            found = []
+
+        results = []
+        for r in found:
+            enriched = self.enrich(r)
+            if enriched['distance'] < self.threshold:
+                enriched['collection'] = self.name
+                results.append(enriched)
+        return results
+
+
+class RetrievalEngine:
+    """
+    Searches several collections with a single query embedding.
+
+    All registered embedders must use the same embedding model, so the query
+    is embedded once and the vector is searched in every index on its own
+    thread (faiss releases the GIL while searching). Distances are then
+    comparable across collections, which is what merge() relies on.
+    """
+
+    def __init__(self, max_workers=None):
+        self.collections = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or config.RETRIEVAL_WORKERS,
+            thread_name_prefix="retrieval"
+        )
+
+    def register(self, name, embedder, enrich=None, threshold=0.8, lexical=None):
+        model = embedder.embedding_client.model
+        for other in self.collections.values():
+            if other.embedder.embedding_client.model != model:
+                raise ValueError(f"❌ {name} uses {model}, {other.name} uses {other.embedder.embedding_client.model}")
+        self.collections[name] = Collection(name, embedder, enrich, threshold, lexical)
+
+    def search(self, query, names=None, k=None):
+        """Results of each collection ({name: results}, nearest first)"""
+        names = [name for name in (names or self.collections) if name in self.collections]
+        if not names:
+            return {}
+
+        started = time.time()
+        try:
+            query_vector = self.collections[names[0]].embedder.embed_query(query)
+        except CircuitOpen:
+            query_vector = None
+        if query_vector is None:
+            print("🔤 Embeddings unavailable, searching by words")
+
+        k = k or config.SEARCH_DEPTH
+        # Each search keeps the message's deadline and chat
+        futures = {
+            name: self._executor.submit(contextvars.copy_context().run, self.collections[name].search, query, query_vector, k)
+            for name in names
+        }
+        found = {}
+        for name, future in futures.items():
+            try:
+                found[name] = future.result()
+            except Exception as e:
+                print(f"❌ Error searching {name}: {e}")
+                found[name] = []
+
+        metrics.increment("retrieval.search")
+        print(f"📊 Search all: '{query[:50]}...' → " + ", ".join(f"{name} {len(r)}" for name, r in found.items()) + f" ({time.time() - started:.2f}s)")
+        return found
+
+    @staticmethod
+    def merge(found, limit=None):
+        """Results of all collections in one list, nearest first"""
+        merged = sorted((r for results in found.values() for r in results), key=lambda r: r['distance'])
+        return merged[:limit] if limit else merged
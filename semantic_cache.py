@@ -0,0 +1,126 @@
+import pickle
+import threading
+import time
+from pathlib import Path
+import numpy as np
+import config
+import metrics
+
+# Minimum seconds between two saves of the cache file
+SAVE_INTERVAL = 60
+
+
+class SemanticCache:
+    """
+    Answers stored next to the embeddings of their questions.
+
+    A new question gets a cached answer when its cosine similarity to a
+    stored question reaches the threshold. The cache is tied to a
+    fingerprint of its source data and is emptied when that changes.
+    """
+
+    def __init__(self, name, threshold=None, max_size=None, path=None):
+        self.name = name
+        self.threshold = threshold or config.REGULATIONS_FAQ_SIMILARITY
+        self.max_size = max_size or config.REGULATIONS_FAQ_CACHE_SIZE
+        self.path = path
+        self.fingerprint = None
+        self.vectors = None
+        self.questions = []
+        self.answers = []
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype='float32').reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def reset(self, fingerprint):
+        with self._lock:
+            self.fingerprint = fingerprint
+            self.vectors = None
+            self.questions = []
+            self.answers = []
+        print(f"🗑️ {self.name} cache emptied")
+
+    def load(self, fingerprint):
+        """Load the saved cache, dropping it if it belongs to other source data"""
+        self.reset(fingerprint)
+        if not self.path or not Path(self.path).exists():
+            return
+
+        try:
+            with open(self.path, 'rb') as f:
+                saved = pickle.load(f)
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable {self.name} cache: {e}")
+            return
+
+        if saved.get('fingerprint') != fingerprint:
+            print(f"🔄 {self.name} cache is outdated, starting empty")
+            return
+
+        with self._lock:
+            self.vectors = saved['vectors']
+            self.questions = saved['questions']
+            self.answers = saved['answers']
+        print(f"✅ {self.name} cache loaded ({len(self.answers)} answers)")
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            saved = {
+                'fingerprint': self.fingerprint,
+                'vectors': self.vectors,
+                'questions': list(self.questions),
+                'answers': list(self.answers),
+            }
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'wb') as f:
+            pickle.dump(saved, f)
+        self._last_save = time.monotonic()
+
+    def lookup(self, vector):
+        """Cached answer for the most similar stored question, or None"""
+        with self._lock:
+            if self.vectors is None or not len(self.answers):
+                metrics.increment(f"{self.name}.miss")
+                return None
+            similarities = self.vectors @ self._normalize(vector)
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            answer, question = self.answers[best], self.questions[best]
+
+        if similarity < self.threshold:
+            metrics.increment(f"{self.name}.miss")
+            return None
+
+        metrics.increment(f"{self.name}.hit")
+        print(f"⚡ {self.name} hit ({similarity:.3f}): «{question[:40]}»")
+        return answer
+
+    def add(self, question, vector, answer):
+        vector = self._normalize(vector)[np.newaxis, :]
+        with self._lock:
+            if self.vectors is None:
+                self.vectors = vector
+            else:
+                self.vectors = np.vstack([self.vectors, vector])
+            self.questions.append(question)
+            self.answers.append(answer)
+
+            # Drop the oldest answers beyond the size limit
+            overflow = len(self.answers) - self.max_size
+            if overflow > 0:
+                self.vectors = self.vectors[overflow:]
+                self.questions = self.questions[overflow:]
+                self.answers = self.answers[overflow:]
+
+        if time.monotonic() - self._last_save > SAVE_INTERVAL:
+            self.save()
+
+    def __len__(self):
+        return len(self.answers)
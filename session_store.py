@@ -0,0 +1,487 @@
+import asyncio
+import atexit
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict, deque
+from pathlib import Path
+import config
+
+
+class SessionStore(ABC):
+    """Storage backend for per-chat session state"""
+
+    @abstractmethod
+    def load(self, namespace, chat_id):
+        """The saved session of a chat, or None"""
+        pass
+
+    @abstractmethod
+    def save_many(self, namespace, sessions):
+        """Save {chat_id: session} in one batch"""
+        pass
+
+    @abstractmethod
+    def delete(self, namespace, chat_id):
+        pass
+
+    def delete_older_than(self, namespace, seconds):
+        """Remove sessions not saved for the given number of seconds"""
+        pass
+
+    def close(self):
+        pass
+
+
+class InMemorySessionStore(SessionStore):
+    """Keeps nothing beyond the loaded sessions (state is lost on restart)"""
+
+    def load(self, namespace, chat_id):
+        return None
+
+    def save_many(self, namespace, sessions):
+        pass
+
+    def delete(self, namespace, chat_id):
+        pass
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions pickled into a SQLite database in WAL mode.
+
+    WAL lets several bot processes read the database while one writes,
+    and batched saves keep disk writes off the message path.
+    """
+
+    def __init__(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                namespace TEXT NOT NULL,
+                chat_id INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (namespace, chat_id)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (namespace, updated_at)")
+        self._conn.commit()
+        print(f"✅ Session store: {path}")
+
+    def load(self, namespace, chat_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM sessions WHERE namespace = ? AND chat_id = ?",
+                (namespace, chat_id)
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0])
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable session {namespace}/{chat_id}: {e}")
+            return None
+
+    def save_many(self, namespace, sessions):
+        now = time.time()
+        rows = [(namespace, chat_id, data, now) for chat_id, data in sessions.items()]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sessions (namespace, chat_id, data, updated_at) VALUES (?, ?, ?, ?)",
+                rows
+            )
+
+    def delete(self, namespace, chat_id):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM sessions WHERE namespace = ? AND chat_id = ?",
+                (namespace, chat_id)
+            )
+
+    def delete_older_than(self, namespace, seconds):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM sessions WHERE namespace = ? AND updated_at < ?",
+                (namespace, time.time() - seconds)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ChatSession:
+    """
+    State of one chat.
+
+    Search results are kept as arrays of row ids and rebuilt from the
+    index metadata and details when needed, and the history is a ring
+    buffer of at most history_size messages.
+
+    The cursor holds the ranked candidates of the last search, so "more"
+    requests page through it instead of searching again; candidates before
+    cursor_pos have already been offered.
+    """
+
+    __slots__ = ('history', 'result_ids', 'shown_ids', 'query', 'filter',
+                 'cursor', 'cursor_distances', 'cursor_pos', 'cursor_depth',
+                 'summary', 'summary_until')
+
+    def __init__(self, history_size=None, filter_state=None):
+        self.history = deque(maxlen=history_size)  # oldest first
+        self.result_ids = array('q')  # last search results
+        self.shown_ids = array('q')   # results shown to the user
+        self.query = ""               # query of the last search
+        self.filter = filter_state
+        self.cursor = array('q')            # ranked candidate ids of the last search
+        self.cursor_distances = array('f')
+        self.cursor_pos = 0
+        self.cursor_depth = 0               # index neighbours the cursor was built from
+        self.summary = ""                   # rolling summary of the turns before the history window
+        self.summary_until = None           # timestamp of the last message folded into it
+
+    def __setstate__(self, state):
+        # Sessions saved before a slot was added get its default value
+        self.__init__()
+        for slots in state:
+            for name, value in (slots or {}).items():
+                setattr(self, name, value)
+
+    def set_cursor(self, results, depth):
+        """Start a new cursor over ranked results (dicts with رديف and distance)"""
+        self.cursor = row_ids(results)
+        self.cursor_distances = array('f', (r.get('distance', 0.0) for r in results if r.get('رديف') is not None))
+        self.cursor_pos = 0
+        self.cursor_depth = depth
+
+    def extend_cursor(self, results, depth):
+        """Append candidates found by a deeper search"""
+        self.cursor.extend(row_ids(results))
+        self.cursor_distances.extend(r.get('distance', 0.0) for r in results if r.get('رديف') is not None)
+        self.cursor_depth = depth
+
+    def approx_size(self):
+        """Rough bytes held by the session: its id arrays and texts"""
+        arrays = (self.result_ids, self.shown_ids, self.cursor, self.cursor_distances)
+        texts = [self.query, self.summary] + [m.get('content', '') for m in list(self.history)]
+        # Persian text takes 2 bytes a character in memory
+        return (SESSION_BASE_BYTES
+                + sum(a.itemsize * len(a) for a in arrays)
+                + sum(2 * len(text or '') + TEXT_OVERHEAD_BYTES for text in texts))
+
+    def offered(self):
+        """Ids the user was offered in this conversation: results, shown ones and the cursor up to cursor_pos"""
+        return set(self.result_ids) | set(self.shown_ids) | set(self.cursor[:self.cursor_pos])
+
+    def remaining(self, skip=()):
+        """Candidates of the cursor not offered yet, apart from the ids in skip"""
+        return sum(1 for row_id in self.cursor[self.cursor_pos:] if row_id not in skip)
+
+    def next_page(self, size, skip=()):
+        """Up to size (id, distance) pairs not offered yet, skipping ids in skip"""
+        page = []
+        while self.cursor_pos < len(self.cursor) and len(page) < size:
+            row_id = self.cursor[self.cursor_pos]
+            if row_id not in skip:
+                page.append((row_id, self.cursor_distances[self.cursor_pos]))
+            self.cursor_pos += 1
+        return page
+
+
+def session_size(session):
+    """Estimated bytes of a loaded session, or None while it is being changed"""
+    try:
+        if isinstance(session, ChatSession):
+            return session.approx_size()
+        return sys.getsizeof(session)
+    except RuntimeError:
+        # The history was changed by a message while being read
+        return None
+
+
+def row_ids(results):
+    """Compact array of the row ids (رديف) of search results"""
+    return array('q', (int(r['رديف']) for r in results if r.get('رديف') is not None))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """The session store configured by config.SESSION_STORE (shared by all bots)"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if config.SESSION_STORE == "sqlite":
+                try:
+                    _store = SQLiteSessionStore(config.SESSION_DB_PATH)
+                except Exception as e:
+                    print(f"⚠️ Session database unavailable, keeping sessions in memory: {e}")
+                    _store = InMemorySessionStore()
+            else:
+                _store = InMemorySessionStore()
+        return _store
+
+
+# Fixed cost of a session object, and of each text it holds, in approx_size()
+SESSION_BASE_BYTES = 1024
+TEXT_OVERHEAD_BYTES = 100
+
+# One lock and one recency order for the sessions of all bots:
+# (manager, chat_id) -> time of last use, least recently used first
+_lock = threading.Lock()
+_active = OrderedDict()
+_managers = []
+# (manager, chat_id) -> estimated bytes of the loaded session, and their sum
+_sizes = {}
+_loaded_bytes = 0
+
+
+class SessionManager:
+    """
+    Sessions of one bot, loaded lazily from the store.
+
+    A chat's session is read from the store on its first message and kept
+    in memory afterwards. Sessions handed out by get() are written back
+    in batches by a background thread (write-behind), so handling a
+    message never waits for the disk. Reads that change nothing use peek(),
+    which loads the session the same way but never marks it for saving.
+    The store is opened on first use, not when the bot module is imported.
+
+    All loaded sessions share one recency order: while their estimated
+    size is over config.SESSION_MEMORY_BUDGET (or there are more than
+    config.SESSION_MAX_ACTIVE) the least recently used one is unloaded
+    (and stays in the store), and expire_idle_sessions() drops idle ones
+    from the front without looking at the others. Sizes are measured when
+    a session is handed out and when it is written.
+    """
+
+    def __init__(self, namespace, factory, store=None, on_expire=None):
+        self.namespace = namespace
+        self.factory = factory
+        self._store = store
+        self.on_expire = on_expire
+        self._sessions = {}
+        self._dirty = set()
+        self._unloaded = {}  # evicted sessions not written yet
+        self._flusher = None
+        with _lock:
+            _managers.append(self)
+
+    @property
+    def store(self):
+        # Saved sessions of chats that never came back are removed by
+        # expire_idle_sessions(), the first time the expiry job runs
+        if self._store is None:
+            self._store = get_store()
+        return self._store
+
+    def get(self, chat_id):
+        """Session of a chat (created if new); it will be saved in the next flush"""
+        session = self._load(chat_id)
+        size = session_size(session)
+        with _lock:
+            _active[(self, chat_id)] = time.monotonic()
+            _active.move_to_end((self, chat_id))
+            _measure((self, chat_id), size)
+            self._dirty.add(chat_id)
+            _evict_over_capacity()
+
+        self._start_flusher()
+        return session
+
+    def peek(self, chat_id):
+        """
+        Session of a chat for reading only: it is not marked for saving, and
+        a chat that is already loaded does not become more recently used.
+        A chat without a saved session gets a new default one, kept in
+        memory only, so later reads of the same message do not go to the
+        store again.
+        """
+        with _lock:
+            session = self._sessions.get(chat_id)
+        if session is not None:
+            return session
+        session = self._load(chat_id)
+        size = session_size(session)
+        with _lock:
+            if (self, chat_id) not in _active:
+                _active[(self, chat_id)] = time.monotonic()
+                _measure((self, chat_id), size)
+                _evict_over_capacity()
+        return session
+
+    def _load(self, chat_id):
+        # The loaded session of a chat, read from the store if it is not in memory
+        with _lock:
+            session = self._sessions.get(chat_id)
+            if session is None:
+                session = self._unloaded.pop(chat_id, None)
+                if session is not None:
+                    # Still to be written
+                    self._sessions[chat_id] = session
+                    self._dirty.add(chat_id)
+        if session is not None:
+            return session
+
+        loaded = self.store.load(self.namespace, chat_id)
+        fresh = self.factory()
+        if type(loaded) is not type(fresh):
+            # Missing, or saved by an older version of the bot
+            loaded = fresh
+        with _lock:
+            return self._sessions.setdefault(chat_id, loaded)
+
+    def reset(self, chat_id):
+        with _lock:
+            self._sessions.pop(chat_id, None)
+            self._unloaded.pop(chat_id, None)
+            self._dirty.discard(chat_id)
+            _active.pop((self, chat_id), None)
+            _forget((self, chat_id))
+        self.store.delete(self.namespace, chat_id)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def flush(self):
+        with _lock:
+            dirty, self._dirty = self._dirty, set()
+            sessions = {chat_id: self._sessions[chat_id] for chat_id in dirty if chat_id in self._sessions}
+            sessions.update(self._unloaded)
+            self._unloaded = {}
+        if not sessions:
+            return
+
+        batch, retry, sizes = {}, set(), {}
+        for chat_id, session in sessions.items():
+            try:
+                batch[chat_id] = pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                # Changed by a message while being pickled; try again next time
+                retry.add(chat_id)
+            sizes[chat_id] = session_size(session)
+        with _lock:
+            # Sizes after the changes of the messages since get()
+            for chat_id, size in sizes.items():
+                if self._sessions.get(chat_id) is sessions[chat_id]:
+                    _measure((self, chat_id), size)
+            _evict_over_capacity()
+        try:
+            self.store.save_many(self.namespace, batch)
+        except Exception as e:
+            print(f"⚠️ Error saving {self.namespace} sessions: {e}")
+            retry.update(batch)
+        if retry:
+            with _lock:
+                for chat_id in retry:
+                    if chat_id in self._sessions:
+                        self._dirty.add(chat_id)
+                    elif chat_id in sessions:
+                        self._unloaded.setdefault(chat_id, sessions[chat_id])
+
+    def _start_flusher(self):
+        if self._flusher is not None or isinstance(self.store, InMemorySessionStore):
+            return
+        with _lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(config.SESSION_FLUSH_INTERVAL)
+            self.flush()
+
+
+def _measure(key, size):
+    # Called with _lock held; a size of None keeps the last one known
+    global _loaded_bytes
+    if size is None or key not in _active:
+        return
+    _loaded_bytes += size - _sizes.get(key, 0)
+    _sizes[key] = size
+
+
+def _forget(key):
+    # Called with _lock held
+    global _loaded_bytes
+    _loaded_bytes -= _sizes.pop(key, 0)
+
+
+def _evict_over_capacity():
+    # Called with _lock held; the session just used is always kept
+    while len(_active) > 1 and (
+            len(_active) > config.SESSION_MAX_ACTIVE or _loaded_bytes > config.SESSION_MEMORY_BUDGET):
+        (manager, chat_id), _ = _active.popitem(last=False)
+        _forget((manager, chat_id))
+        session = manager._sessions.pop(chat_id, None)
+        # Only changes not written yet need to be kept until the next flush
+        if session is not None and chat_id in manager._dirty and not isinstance(manager.store, InMemorySessionStore):
+            manager._unloaded[chat_id] = session
+        manager._dirty.discard(chat_id)
+
+
+def expire_idle_sessions(max_idle=None):
+    """
+    Forget sessions unused for max_idle seconds (config.SESSION_MAX_IDLE).
+
+    Only the expired sessions at the front of the recency order are
+    visited; saved sessions are removed with one query per bot.
+    """
+    max_idle = max_idle or config.SESSION_MAX_IDLE
+    cutoff = time.monotonic() - max_idle
+    expired = []
+    with _lock:
+        while _active:
+            (manager, chat_id), last_used = next(iter(_active.items()))
+            if last_used > cutoff:
+                break
+            _active.popitem(last=False)
+            _forget((manager, chat_id))
+            manager._sessions.pop(chat_id, None)
+            manager._dirty.discard(chat_id)
+            expired.append((manager, chat_id))
+        managers = list(_managers)
+
+    for manager, chat_id in expired:
+        if manager.on_expire:
+            manager.on_expire(chat_id)
+    for manager in managers:
+        try:
+            manager.store.delete_older_than(manager.namespace, max_idle)
+        except Exception as e:
+            print(f"⚠️ Error expiring {manager.namespace} sessions: {e}")
+
+    if expired:
+        print(f"🗑️ Cleaned: {len(expired)} old conversations")
+    return len(expired)
+
+
+def schedule_expiry(application):
+    """Run expire_idle_sessions periodically from the bot's JobQueue"""
+    if application.job_queue is None:
+        print("⚠️ JobQueue unavailable (install python-telegram-bot[job-queue]), idle sessions are not expired")
+        return
+
+    async def expire_sessions(context):
+        await asyncio.to_thread(expire_idle_sessions)
+
+    application.job_queue.run_repeating(
+        expire_sessions,
+        interval=config.SESSION_EXPIRY_INTERVAL,
+        first=config.SESSION_EXPIRY_INTERVAL
+    )
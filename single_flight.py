@@ -0,0 +1,56 @@
+import threading
+from concurrent.futures import Future
+import deadline
+import metrics
+
+
+class SingleFlight:
+    """
+    Runs a call once for concurrent callers with the same key.
+
+    The first caller of a key runs fn; callers arriving while it runs wait
+    for it and get the same result (or exception), waiting no longer than
+    the budget of their stage (the name of the SingleFlight unless do() is
+    given one). Nothing is kept once the call ends: results that should
+    outlive it belong in a cache.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, stage=None, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            metrics.increment(f"{self.name}.coalesced")
+            return deadline.wait(future, stage or self.name)
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared(name):
+    """The process-wide SingleFlight of a stage (e.g. 'embedding')"""
+    with _shared_lock:
+        if name not in _shared:
+            _shared[name] = SingleFlight(name)
+        return _shared[name]
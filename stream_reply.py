@@ -0,0 +1,121 @@
+import asyncio
+import time
+from telegram.error import BadRequest, RetryAfter, TelegramError
+import config
+
+# Telegram rejects messages longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Split a long answer into Telegram-sized parts, preferring line breaks"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text:
+        parts.append(text)
+    return parts
+
+
+class StreamingReply:
+    """
+    Shows a streamed answer by editing one Telegram message.
+
+    push() may be called from a worker thread while the answer is generated;
+    the message is created with the first piece of text and then edited at
+    most once per STREAM_EDIT_INTERVAL seconds. finish() replaces it with the
+    final (post-processed) answer; a send or edit in progress is let finish
+    first, so the message it creates is the one replaced.
+    """
+
+    def __init__(self, message, interval=None, min_chars=None):
+        self.message = message
+        self.interval = interval or config.STREAM_EDIT_INTERVAL
+        self.min_chars = min_chars or config.STREAM_MIN_CHARS
+        self.sent_message = None
+        self._text = ""
+        self._shown = ""
+        self._next_edit = 0.0
+        self._loop = None
+        self._wakeup = None
+        self._pump_task = None
+        self._stopped = False
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._pump_task = asyncio.create_task(self._pump())
+
+    def push(self, delta):
+        first = not self._text
+        self._text += delta
+        if first and self._loop is not None:
+            # Show the first tokens right away instead of waiting for the next tick
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _pump(self):
+        while not self._stopped:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopped:
+                break
+            await self._flush()
+
+    async def _flush(self):
+        text = self._text
+        if not text or time.monotonic() < self._next_edit:
+            return
+        if self.sent_message is not None and len(text) - len(self._shown) < self.min_chars:
+            return
+
+        display = split_message(text)[0] + " ▌"
+        try:
+            if self.sent_message is None:
+                self.sent_message = await self.message.reply_text(display)
+            else:
+                await self.sent_message.edit_text(display)
+            self._shown = text
+            self._next_edit = time.monotonic() + self.interval
+        except RetryAfter as e:
+            print(f"⚠️ Telegram flood control, waiting {e.retry_after}s")
+            self._next_edit = time.monotonic() + float(e.retry_after)
+        except TelegramError as e:
+            print(f"⚠️ Error editing streamed message: {e}")
+            self._next_edit = time.monotonic() + self.interval
+
+    async def stop(self):
+        # Not cancelled: a message being sent must be known to finish()
+        self._stopped = True
+        if self._pump_task is not None:
+            self._wakeup.set()
+            await self._pump_task
+            self._pump_task = None
+
+    async def finish(self, final_text):
+        await self.stop()
+
+        parts = split_message(final_text) or [final_text]
+
+        if self.sent_message is None:
+            for part in parts:
+                await self.message.reply_text(part)
+            return
+
+        try:
+            await self.sent_message.edit_text(parts[0])
+        except RetryAfter as e:
+            await asyncio.sleep(float(e.retry_after))
+            await self.sent_message.edit_text(parts[0])
+        except BadRequest as e:
+            # "Message is not modified" is harmless
+            if 'not modified' not in str(e).lower():
+                raise
+        for part in parts[1:]:
+            await self.message.reply_text(part)
@@ -0,0 +1,146 @@
+import threading
+import time
+import pytest
+import admission
+import config
+import deadline
+import metrics
+
+
+def governor(max_concurrent=1, tokens_per_minute=6_000_000, max_queue=32):
+    return admission.Governor("test", max_concurrent, tokens_per_minute, max_queue)
+
+
+def wait_until(condition, timeout=2.0):
+    stop = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < stop, "condition not reached"
+        time.sleep(0.005)
+
+
+def start_waiting(g, user, name, order):
+    """A call of user queued behind the busy governor; it records name when admitted"""
+    def target():
+        admission.current_user.set(user)
+        with g.admit("test", 1):
+            order.append(name)
+
+    waiting = g._waiting
+    thread = threading.Thread(target=target)
+    thread.start()
+    wait_until(lambda: g._waiting == waiting + 1)
+    return thread
+
+
+def test_chats_are_served_round_robin():
+    g = governor()
+    order = []
+    with g.admit("test", 1):
+        threads = [
+            start_waiting(g, 'a', 'a1', order),
+            start_waiting(g, 'a', 'a2', order),
+            start_waiting(g, 'a', 'a3', order),
+            start_waiting(g, 'b', 'b1', order),
+            start_waiting(g, 'c', 'c1', order),
+        ]
+    for thread in threads:
+        thread.join()
+
+    assert order == ['a1', 'b1', 'c1', 'a2', 'a3']
+    assert g._running == 0 and g._waiting == 0 and not g._queues
+
+
+def test_full_queue_rejects_at_once():
+    g = governor(max_queue=1)
+    order = []
+    rejected = metrics.get_counter("test.admission_rejected")
+    with g.admit("test", 1):
+        thread = start_waiting(g, None, 'queued', order)
+        started = time.monotonic()
+        with pytest.raises(admission.Overloaded):
+            with g.admit("test", 1):
+                pass
+        assert time.monotonic() - started < 0.5
+    thread.join()
+
+    assert order == ['queued']
+    assert metrics.get_counter("test.admission_rejected") == rejected + 1
+
+
+def test_waiting_call_gives_up_at_its_deadline(monkeypatch):
+    monkeypatch.setitem(config.STAGE_BUDGETS, 'probe', 0.2)
+    g = governor()
+    with g.admit("test", 1):
+        started = time.monotonic()
+        with pytest.raises(deadline.DeadlineExceeded):
+            with g.admit("test.probe", 1):
+                pass
+        assert 0.15 <= time.monotonic() - started < 1.0
+        # Its place in the queue is given up
+        assert g._waiting == 0 and not g._queues
+
+    with g.admit("test", 1):
+        assert g._running == 1
+
+
+def test_tokens_refill_at_the_rate(monkeypatch):
+    monkeypatch.setattr(config, 'ADMISSION_BURST_SECONDS', 0.5)
+    g = governor(max_concurrent=4, tokens_per_minute=600)  # 10 tokens a second, 5 in the bucket
+
+    with g.admit("test", 5):
+        pass
+    started = time.monotonic()
+    with g.admit("test", 3):
+        pass
+    assert 0.25 <= time.monotonic() - started < 1.0
+
+
+def test_reported_usage_corrects_the_estimate(monkeypatch):
+    monkeypatch.setattr(config, 'ADMISSION_BURST_SECONDS', 0.5)
+    g = governor(max_concurrent=4, tokens_per_minute=600)
+
+    with g.admit("test", 5) as ticket:
+        ticket.used = 1
+    started = time.monotonic()
+    with g.admit("test", 4):
+        pass
+    assert time.monotonic() - started < 0.2
+
+
+def test_call_larger_than_the_bucket_waits_for_a_full_bucket(monkeypatch):
+    monkeypatch.setattr(config, 'ADMISSION_BURST_SECONDS', 0.5)
+    g = governor(max_concurrent=4, tokens_per_minute=600)
+
+    started = time.monotonic()
+    with g.admit("test", 12):
+        pass
+    assert time.monotonic() - started < 0.2
+    # It took more than the bucket held: the next call waits for the debt
+    started = time.monotonic()
+    with g.admit("test", 1):
+        pass
+    assert time.monotonic() - started >= 0.6
+
+
+def test_throttle_holds_new_calls():
+    g = governor(max_concurrent=4)
+    g.throttle(0.3)
+    started = time.monotonic()
+    with g.admit("test", 1):
+        pass
+    assert 0.25 <= time.monotonic() - started < 1.0
+
+
+def test_estimate_tokens():
+    assert admission.estimate_tokens(["abcdef", None], max_tokens=10) == 3 + 1 + 10
+
+
+def test_retry_after():
+    class Response:
+        headers = {'retry-after': '2.5'}
+
+    class Error(Exception):
+        response = Response()
+
+    assert admission.retry_after(Error()) == 2.5
+    assert admission.retry_after(Exception()) is None
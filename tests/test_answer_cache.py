@@ -0,0 +1,60 @@
+import time
+from answer_cache import AnswerCache, TTLCache, normalize_query, prompt_version
+
+
+def test_normalize_query():
+    assert normalize_query("كتاب‌هاي  شعر؟") == normalize_query("کتاب های شعر")
+    assert normalize_query("  Hello, World! ") == "hello world"
+    assert normalize_query(None) == ""
+
+
+def test_prompt_version():
+    assert prompt_version("system", "template") == prompt_version("system", "template")
+    assert prompt_version("system", "template") != prompt_version("system", "template 2")
+    assert len(prompt_version("x")) == 12
+
+
+def test_keys():
+    key = AnswerCache.make_key("کتاب شعر", [3, 1, 2], "v1")
+    # Spelling and result order do not matter
+    assert key == AnswerCache.make_key("كتاب شعر؟", [1, 2, 3], "v1")
+    assert key != AnswerCache.make_key("کتاب شعر", [1, 2, 4], "v1")
+    assert key != AnswerCache.make_key("کتاب شعر", [1, 2, 3], "v2")
+
+
+def test_keys_of_different_conversations_differ():
+    history = [{"role": "user", "content": "کتاب‌های نیما"}, {"role": "assistant", "content": "..."}]
+    summary = [{"role": "system", "content": "خلاصه: کاربر دنبال شعر نو است"}]
+    fresh = AnswerCache.make_key("کتاب شعر", [1, 2], "v1")
+    assert fresh == AnswerCache.make_key("کتاب شعر", [1, 2], "v1", [])
+    assert fresh != AnswerCache.make_key("کتاب شعر", [1, 2], "v1", history)
+    assert fresh != AnswerCache.make_key("کتاب شعر", [1, 2], "v1", summary)
+    assert AnswerCache.make_key("کتاب شعر", [1, 2], "v1", history) == AnswerCache.make_key("کتاب شعر", [1, 2], "v1", list(history))
+
+
+def test_hits_and_misses():
+    cache = AnswerCache("test", max_size=10, ttl=60)
+    key = AnswerCache.make_key("q", [1], "v1")
+    assert cache.get(key) is None
+    cache.put(key, "answer")
+    assert cache.get(key) == "answer"
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1, 'hit_rate': 0.5}
+
+
+def test_entries_expire():
+    cache = AnswerCache("test-ttl", max_size=10, ttl=0.05)
+    cache.put("key", "answer")
+    assert cache.get("key") == "answer"
+    time.sleep(0.06)
+    assert cache.get("key") is None
+
+
+def test_least_recently_used_entry_is_dropped():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert len(cache) == 2
@@ -0,0 +1,68 @@
+import time
+import pytest
+from circuit_breaker import CircuitBreaker, CircuitOpen
+
+
+def test_opens_after_failures_in_a_row():
+    breaker = CircuitBreaker("test-circuit", failure_threshold=3, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open
+
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+    with pytest.raises(CircuitOpen):
+        breaker.check("test.answer")
+
+
+def test_one_trial_call_after_the_reset_timeout():
+    breaker = CircuitBreaker("test-circuit-trial", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Only the one trial call goes through
+    assert not breaker.allow()
+
+
+def test_trial_success_closes_the_circuit():
+    breaker = CircuitBreaker("test-circuit-close", failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+    # The failure count starts again
+    breaker.record_failure()
+    assert not breaker.is_open
+
+
+def test_trial_failure_opens_the_circuit_again():
+    breaker = CircuitBreaker("test-circuit-reopen", failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_lost_trial_call_is_retried():
+    breaker = CircuitBreaker("test-circuit-lost", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    # The trial never reported back: another one goes after the timeout
+    time.sleep(0.06)
+    assert breaker.allow()
@@ -0,0 +1,132 @@
+import time
+from collections import OrderedDict
+import pytest
+import config
+import context_builder
+import session_store
+from context_builder import ContextBuilder, RollingSummary, fit_lines, shorten, stable_history_window
+from session_store import ChatSession, InMemorySessionStore, SessionManager
+
+
+@pytest.fixture(autouse=True)
+def estimated_tokens(monkeypatch):
+    """Token counts of len(text) // 3 + 1, whatever tokenizer is installed"""
+    monkeypatch.setattr(context_builder, '_encoding', lambda model: None)
+    monkeypatch.setattr(session_store, '_active', OrderedDict())
+    monkeypatch.setattr(session_store, '_managers', [])
+    monkeypatch.setattr(session_store, '_sizes', {})
+    monkeypatch.setattr(session_store, '_loaded_bytes', 0)
+
+
+def test_stable_history_window_moves_in_steps():
+    history = list(range(14))
+    assert stable_history_window(history, 10, step=4) == list(range(4, 14))
+    assert stable_history_window(history[:11], 10, step=4) == list(range(4, 11))
+    # Turns in between keep the same start, so the prompt prefix stays the same
+    starts = [stable_history_window(list(range(n)), 10, step=4)[0] for n in range(11, 15)]
+    assert starts == [4, 4, 4, 4]
+    assert stable_history_window(history, 0) == []
+    assert stable_history_window(history[:3], 10, step=4) == [0, 1, 2]
+
+
+def test_fit_lines_keeps_the_leading_lines():
+    lines = ["a" * 29, "b" * 29, "c" * 29]  # 11 tokens each with the separator
+    assert fit_lines(lines, 25) == lines[:2]
+    assert fit_lines(lines, 100) == lines
+    # The first line is kept even if it does not fit
+    assert fit_lines(lines, 1) == lines[:1]
+
+
+def test_shorten():
+    assert shorten("کوتاه", 10) == "کوتاه"
+
+    text = "جمله اول است. جمله دوم هم هست. " * 10
+    short = shorten(text, 20)
+    assert context_builder.count_tokens(short) <= 20
+    assert short.endswith(".")
+
+    words = "واژه " * 100
+    short = shorten(words, 10)
+    assert short.endswith(" …")
+    assert context_builder.count_tokens(short[:-2]) <= 10
+
+
+def test_build_orders_the_prompt_and_fits_the_results():
+    builder = ContextBuilder("test", "system", history_limit=4, token_budget=60, history_budget=40)
+    history = [{"role": "user", "content": "سوال قبلی"}, {"role": "assistant", "content": "پاسخ قبلی"}]
+    messages = builder.build(None, history, "{context}\n{query}", ["x" * 30] * 10, query="سوال")
+
+    assert [m["role"] for m in messages] == ["system", "user", "assistant", "user"]
+    assert messages[0]["content"] == "system"
+    assert messages[-1]["content"].endswith("\nسوال")
+    assert 0 < messages[-1]["content"].count("x" * 30) < 10
+
+
+class FakeCompletion:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, client, messages, **kwargs):
+        self.calls.append((messages, kwargs))
+        return f"خلاصه {len(self.calls)}"
+
+
+def wait_for_update(summary):
+    stop = time.monotonic() + 2
+    while summary._updating:
+        assert time.monotonic() < stop
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def summary(monkeypatch):
+    completion = FakeCompletion()
+    monkeypatch.setattr(context_builder, 'create_chat_completion', completion)
+    sessions = SessionManager("test-summary", ChatSession, store=InMemorySessionStore())
+    summary = RollingSummary("test", None, sessions)
+    summary.completion = completion
+    return summary
+
+
+def messages(*timestamps):
+    return [{"role": "user", "content": f"پیام {t}", "timestamp": t} for t in timestamps]
+
+
+def test_summary_is_kept_in_the_session(summary):
+    summary.fold(1, messages(1, 2))
+    wait_for_update(summary)
+    assert summary.get(1) == "خلاصه 1"
+    assert summary.sessions.peek(1).summary_until == 2
+    assert summary.completion.calls[0][1]["model"] == config.SUMMARY_MODEL
+
+    # Only messages not folded yet are sent
+    summary.fold(1, messages(1, 2, 3))
+    wait_for_update(summary)
+    assert summary.get(1) == "خلاصه 2"
+    assert "پیام 3" in summary.completion.calls[1][0][1]["content"]
+    assert "پیام 1" not in summary.completion.calls[1][0][1]["content"]
+    summary.fold(1, messages(1, 2, 3))
+    wait_for_update(summary)
+    assert len(summary.completion.calls) == 2
+
+
+def test_summary_goes_with_a_reset(summary):
+    summary.fold(1, messages(1))
+    wait_for_update(summary)
+    summary.sessions.reset(1)
+    assert summary.get(1) == ""
+
+
+def test_summary_goes_after_the_history():
+    class Summary:
+        def get(self, chat_id):
+            return "خلاصه"
+
+        def fold(self, chat_id, messages):
+            pass
+
+    builder = ContextBuilder("test", "system", summary=Summary(), history_limit=4)
+    history = [{"role": "user", "content": "سوال قبلی"}]
+    messages = builder.build(1, history, "{context}{query}", query="q")
+    assert [m["role"] for m in messages] == ["system", "user", "system", "user"]
+    assert "خلاصه" in messages[2]["content"]
@@ -0,0 +1,65 @@
+import pickle
+from session_store import ChatSession, row_ids
+
+
+def ranked(*ids):
+    return [{'رديف': row_id, 'distance': i / 10} for i, row_id in enumerate(ids)]
+
+
+def test_pages_follow_the_ranking():
+    session = ChatSession()
+    session.set_cursor(ranked(5, 3, 9, 1, 7), depth=40)
+    assert [row_id for row_id, _ in session.next_page(2)] == [5, 3]
+    assert [row_id for row_id, _ in session.next_page(2)] == [9, 1]
+    assert [row_id for row_id, _ in session.next_page(2)] == [7]
+    assert session.next_page(2) == []
+    assert session.cursor_depth == 40
+
+
+def test_pages_skip_ids_already_shown():
+    session = ChatSession()
+    session.set_cursor(ranked(1, 2, 3, 4, 5), depth=40)
+    page = session.next_page(2, skip={1, 3})
+    assert [row_id for row_id, _ in page] == [2, 4]
+    assert session.remaining() == 1
+    assert session.remaining(skip={5}) == 0
+
+
+def test_pages_keep_the_distances():
+    session = ChatSession()
+    session.set_cursor(ranked(8, 6), depth=40)
+    assert [round(distance, 3) for _, distance in session.next_page(2)] == [0.0, 0.1]
+
+
+def test_extended_cursor_continues_where_it_stopped():
+    session = ChatSession()
+    session.set_cursor(ranked(1, 2), depth=40)
+    session.next_page(2)
+    session.extend_cursor(ranked(3, 4), depth=80)
+    assert [row_id for row_id, _ in session.next_page(5)] == [3, 4]
+    assert session.cursor_depth == 80
+
+
+def test_offered_ids():
+    session = ChatSession()
+    session.set_cursor(ranked(1, 2, 3, 4, 5, 6), depth=40)
+    session.next_page(3)
+    session.result_ids = row_ids(ranked(10, 11))
+    session.shown_ids = row_ids(ranked(11, 12))
+    # Candidates not reached yet were never offered
+    assert session.offered() == {1, 2, 3, 10, 11, 12}
+
+
+def test_results_without_a_row_id_are_left_out():
+    session = ChatSession()
+    session.set_cursor([{'رديف': 4, 'distance': 0.2}, {'عنوان': 'x', 'distance': 0.3}, {'رديف': '7'}], depth=40)
+    assert list(session.cursor) == [4, 7]
+    assert len(session.cursor_distances) == 2
+
+
+def test_cursor_survives_pickling():
+    session = ChatSession()
+    session.set_cursor(ranked(1, 2, 3), depth=40)
+    session.next_page(1)
+    restored = pickle.loads(pickle.dumps(session))
+    assert [row_id for row_id, _ in restored.next_page(5)] == [2, 3]
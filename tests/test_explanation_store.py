@@ -0,0 +1,63 @@
+import pytest
+import explanation_store
+from explanation_store import ExplanationStore, collection_version, describe
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ExplanationStore(str(tmp_path / "explanations.db"))
+    yield store
+    store.close()
+
+
+def test_describe_skips_empty_fields():
+    fields = explanation_store.COLLECTIONS['book']['fields']
+    item = {'عنوان': 'شازده کوچولو', 'پديدآورنده': 'nan', 'ناشر': ' ', 'تاريخ نشر': 1398}
+    assert describe(item, fields) == "عنوان: شازده کوچولو\nسال: 1398"
+
+
+def test_put_and_get(store):
+    assert store.get('book', 7) is None
+    store.put('book', 7, "explanation")
+    assert store.get('book', 7) == "explanation"
+    assert store.get('thesis', 7) is None
+    store.put('book', 7, "newer explanation")
+    assert store.get('book', 7) == "newer explanation"
+    assert store.stored_ids('book') == {7}
+    assert store.stored_ids('thesis') == set()
+
+
+def test_explanations_of_other_prompt_are_not_served(tmp_path, monkeypatch):
+    path = str(tmp_path / "explanations.db")
+    store = ExplanationStore(path)
+    store.put('book', 7, "explanation")
+    store.close()
+
+    version = collection_version('book')
+    monkeypatch.setattr(explanation_store, "EXPLAIN_PROMPT", explanation_store.EXPLAIN_PROMPT + "\nتغییر")
+    assert collection_version('book') != version
+
+    store = ExplanationStore(path)
+    assert store.get('book', 7) is None
+    assert store.stored_ids('book') == set()
+    store.close()
+
+
+def test_generate_skips_stored_rows(store, monkeypatch):
+    import llm_client
+
+    calls = []
+
+    def complete(client, messages, **kwargs):
+        calls.append(messages[1]['content'])
+        return f" explanation {len(calls)} "
+
+    monkeypatch.setattr(llm_client, "create_chat_completion", complete)
+    store.put('book', 1, "stored")
+    rows = {1: {'عنوان': 'الف'}, 2: {'عنوان': 'ب'}, 3: None}
+    explanation_store.generate(store, None, 'book', [1, 2, 3], rows.get, "model", rate_limit=60000)
+
+    assert calls == ["عنوان: ب"]
+    assert store.get('book', 1) == "stored"
+    assert store.get('book', 2) == "explanation 1"
+    assert store.stored_ids('book') == {1, 2}
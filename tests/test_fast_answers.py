@@ -0,0 +1,82 @@
+import re
+from fast_answers import FastAnswers, parse_year, whole_words
+from intent_router import IntentRouter
+
+FAST = FastAnswers(
+    "test", "کتاب",
+    fields={
+        'year': ('سال انتشار', ['تاريخ نشر'], ['سال انتشار', 'سال نشر']),
+        'publisher': ('ناشر', ['ناشر'], ['ناشر', 'انتشارات']),
+    },
+    year_keys=['تاريخ نشر']
+)
+ROUTER = IntentRouter(keywords=FAST.keywords, patterns=FAST.patterns)
+
+ITEMS = [
+    {'عنوان': 'الف', 'ناشر': 'سمت', 'تاريخ نشر': '1398/05/01'},
+    {'عنوان': 'ب', 'ناشر': 'nan', 'تاريخ نشر': '2001'},
+    {'عنوان': 'ج', 'ناشر': 'نی', 'تاريخ نشر': ''},
+]
+
+
+def answer(message, items=ITEMS):
+    return FAST.answer(ROUTER.route(message), items)
+
+
+def test_whole_words():
+    expression = re.compile(whole_words(['ناشر', 'سال نشر']))
+    assert expression.search("ناشر کتاب")
+    assert expression.search("سال نشر دومی")
+    assert not expression.search("ناشران")
+    assert not expression.search("ناشر‌ها")
+
+
+def test_parse_year():
+    assert parse_year('۱۳۹۸') == 1398
+    assert parse_year('1398/05/01') == 1398
+    assert parse_year('2019') == 1398
+    assert parse_year('nan') is None
+    assert parse_year(None) is None
+
+
+def test_field_of_named_item():
+    reply = answer("ناشر کتاب اول")
+    assert "«الف»" in reply and "سمت" in reply
+    assert "«ب»" not in reply
+
+
+def test_missing_value_is_unknown():
+    reply = answer("ناشر دومی")
+    assert "«ب»" in reply and "نامشخص" in reply
+
+
+def test_field_of_all_shown_items():
+    reply = answer("ناشر این کتاب")
+    assert all(f"«{item['عنوان']}»" in reply for item in ITEMS)
+
+
+def test_position_beyond_shown_items():
+    assert "3" in answer("ناشر کتاب پنجم")
+
+
+def test_new_search_is_not_a_follow_up():
+    assert answer("کتاب‌های انتشارات سمت") is None
+    assert answer("کتاب اول") is None
+    assert answer("ناشر کتاب اول", items=[]) is None
+    assert answer("ناشر کتاب اول را بگو و بعد چند کتاب دیگر از همین موضوع پیدا کن") is None
+
+
+def test_which_is_newer():
+    reply = answer("کدوم جدیدتره")
+    # 2001 is solar 1380, older than 1398; the undated one is left out
+    assert reply.splitlines()[0].endswith("«الف» (1398/05/01)")
+    assert reply.index("«الف»", 20) < reply.index("«ب»")
+    assert "(سال 1 کتاب ثبت نشده است)" in reply
+
+
+def test_which_is_older():
+    assert "«ب» (2001)" in answer("کدام قدیمی‌تر")
+
+
+def test_compare_without_years():
+    assert "ثبت نشده" in answer("کدوم جدیدتره", items=[{'عنوان': 'الف'}])
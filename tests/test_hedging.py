@@ -0,0 +1,120 @@
+import threading
+import time
+import pytest
+import config
+import hedging
+import metrics
+
+
+@pytest.fixture
+def stage(monkeypatch, request):
+    """An 'answer' stage of its own whose p95 latency is 0.05s"""
+    monkeypatch.setattr(config, 'HEDGE_ENABLED', True)
+    monkeypatch.setattr(config, 'HEDGE_MIN_SAMPLES', 3)
+    monkeypatch.setattr(config, 'HEDGE_MAX_RATIO', 0.5)
+    name = f"{request.node.name}.answer"
+    for _ in range(3):
+        metrics.observe(f"{name}.latency", 0.05)
+    return name
+
+
+def attempts(*behaviours):
+    """A call whose n-th request behaves as behaviours[n](claim)"""
+    calls = []
+    lock = threading.Lock()
+
+    def call(claim):
+        with lock:
+            behaviour = behaviours[len(calls)]
+            calls.append(threading.current_thread())
+        return behaviour(claim)
+
+    call.calls = calls
+    return call
+
+
+def test_hedge_delay(stage, monkeypatch):
+    metrics.increment(f"{stage}.hedge_calls")
+    assert hedging.hedge_delay(stage, f"{stage}.latency") == 0.05
+    assert hedging.hedge_delay("test.rewrite", f"{stage}.latency") is None
+    assert hedging.hedge_delay(stage, "test.unknown.latency") is None
+    # Hedges stay under HEDGE_MAX_RATIO of the calls
+    metrics.increment(f"{stage}.hedge_sent")
+    assert hedging.hedge_delay(stage, f"{stage}.latency") is None
+    metrics.increment(f"{stage}.hedge_calls", 2)
+    assert hedging.hedge_delay(stage, f"{stage}.latency") == 0.05
+    monkeypatch.setattr(config, 'HEDGE_ENABLED', False)
+    assert hedging.hedge_delay(stage, f"{stage}.latency") is None
+
+
+def test_without_samples_the_call_runs_directly():
+    call = attempts(lambda claim: claim() and "answer")
+    assert hedging.hedged("test-cold.answer", call) == "answer"
+    assert call.calls == [threading.current_thread()]
+
+
+def test_fast_request_is_not_hedged(stage):
+    call = attempts(lambda claim: claim() and "first")
+    assert hedging.hedged(stage, call) == "first"
+    assert len(call.calls) == 1
+    assert metrics.get_counter(f"{stage}.hedge_sent") == 0
+
+
+def test_slow_request_is_hedged_and_the_first_answer_wins(stage):
+    release = threading.Event()
+    lost = []
+
+    def slow(claim):
+        release.wait(2)
+        lost.append(claim())
+        return "first"
+
+    call = attempts(slow, lambda claim: claim() and "second")
+    assert hedging.hedged(stage, call) == "second"
+    release.set()
+    assert len(call.calls) == 2
+    assert metrics.get_counter(f"{stage}.hedge_sent") == 1
+    assert metrics.get_counter(f"{stage}.hedge_win") == 1
+
+    # The slow request is told it lost
+    deadline = time.monotonic() + 2
+    while not lost and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert lost == [False]
+
+
+def test_failed_request_leaves_the_answer_to_the_other(stage):
+    def slow_failure(claim):
+        time.sleep(0.1)
+        raise ValueError("first failed")
+
+    def slower_answer(claim):
+        time.sleep(0.2)
+        return claim() and "second"
+
+    call = attempts(slow_failure, slower_answer)
+    assert hedging.hedged(stage, call) == "second"
+
+
+def test_both_requests_failing_raise(stage):
+    def slow_failure(claim):
+        time.sleep(0.1)
+        raise ValueError("failed")
+
+    call = attempts(slow_failure, slow_failure)
+    with pytest.raises(ValueError):
+        hedging.hedged(stage, call)
+
+
+def test_no_hedge_while_every_hedge_worker_is_busy(stage, monkeypatch):
+    monkeypatch.setattr(hedging, '_hedge_slots', threading.BoundedSemaphore(1))
+    hedging._hedge_slots.acquire()
+
+    def slow(claim):
+        time.sleep(0.15)
+        return claim() and "first"
+
+    call = attempts(slow)
+    assert hedging.hedged(stage, call) == "first"
+    assert len(call.calls) == 1
+    assert metrics.get_counter(f"{stage}.hedge_skipped") == 1
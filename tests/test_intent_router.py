@@ -0,0 +1,65 @@
+import random
+from intent_router import IntentRouter, KeywordAutomaton, ordinal_of, pick
+
+
+def scan(labelled_keywords, text):
+    return {label for keyword, label in labelled_keywords if keyword in text}
+
+
+def test_overlapping_keywords():
+    keywords = [('he', 'he'), ('she', 'she'), ('his', 'his'), ('hers', 'hers')]
+    automaton = KeywordAutomaton(keywords)
+    assert automaton.find("ushers") == {'she', 'he', 'hers'}
+    assert automaton.find("this") == {'his'}
+    assert automaton.find("hxe") == set()
+
+
+def test_keywords_sharing_a_label():
+    automaton = KeywordAutomaton([('بیشتر', 'more'), ('دیگه', 'more'), ('نویسنده', 'author')])
+    assert automaton.find("چند تا دیگه از این نویسنده") == {'more', 'author'}
+    assert automaton.find("") == set()
+
+
+def test_same_as_a_scan_per_keyword():
+    rng = random.Random(0)
+    letters = "abcab"
+    for _ in range(200):
+        keywords = [
+            ("".join(rng.choice(letters) for _ in range(rng.randint(1, 4))), i)
+            for i in range(rng.randint(1, 8))
+        ]
+        text = "".join(rng.choice(letters) for _ in range(rng.randint(0, 20)))
+        assert KeywordAutomaton(keywords).find(text) == scan(keywords, text), (keywords, text)
+
+
+def test_route():
+    router = IntentRouter(
+        keywords={'author': ['نویسنده']},
+        patterns={'advisor_named': [r'استاد راهنما(?:ی)?\s+(?P<advisor>.+)']},
+    )
+    route = router.route("نویسنده کتاب دوم کیه")
+    assert route.has('author') and route.ordinal == 1
+
+    route = router.route("پایان نامه های استاد راهنمای احمدی")
+    assert route.has('advisor_named')
+    assert route.entities == {'advisor': 'احمدی'}
+    assert route.ordinal is None
+
+    # The first named position wins over "last"
+    assert router.route("اولی یا آخری").ordinal == 0
+    assert router.route("کتاب ۳").ordinal == 2
+
+
+def test_ordinal_of():
+    assert ordinal_of('دوم') == 1
+    assert ordinal_of('آخری') == -1
+    assert ordinal_of('۲') == 1
+    assert ordinal_of('کتاب') is None
+
+
+def test_pick():
+    items = ['a', 'b', 'c']
+    assert pick(items, None) == 'c'
+    assert pick(items, 0) == 'a'
+    assert pick(items, 5) is None
+    assert pick([], None) is None
@@ -0,0 +1,60 @@
+import faiss
+import numpy as np
+from knn_graph import KnnGraph, build_knn_graph, index_vectors
+
+
+def make_index(ids, points):
+    vectors = np.asarray(points, dtype='float32').reshape(len(ids), -1)
+    index = faiss.IndexIDMap(faiss.IndexFlatL2(vectors.shape[1]))
+    index.add_with_ids(vectors, np.asarray(ids, dtype='int64'))
+    return index
+
+
+def test_csr_layout():
+    # Added out of order: rows follow the sorted ids
+    index = make_index([30, 10, 20, 40], [3, 0, 1, 10])
+    graph = build_knn_graph(index, k=2, batch_size=3)
+
+    assert graph.ids.tolist() == [10, 20, 30, 40]
+    assert graph.indptr.tolist() == [0, 2, 4, 6, 8]
+    assert graph.neighbours.tolist() == [20, 30, 10, 30, 20, 10, 30, 20]
+    assert graph.distances.tolist() == [1, 9, 1, 4, 4, 9, 49, 81]
+
+
+def test_neighbours_of():
+    graph = build_knn_graph(make_index([30, 10, 20, 40], [3, 0, 1, 10]), k=2)
+    # Nearest first, never the item itself
+    assert graph.neighbours_of(20) == [(10, 1.0), (30, 4.0)]
+    assert graph.neighbours_of(20, limit=1) == [(10, 1.0)]
+    assert graph.neighbours_of(25) == []
+    assert graph.neighbours_of(50) == []
+
+
+def test_fewer_items_than_k():
+    graph = build_knn_graph(make_index([1, 2], [0, 1]), k=5)
+    assert graph.indptr.tolist() == [0, 1, 2]
+    assert graph.neighbours_of(1) == [(2, 1.0)]
+
+
+def test_related_table_against_other_index():
+    books = make_index([1, 2], [0, 10])
+    theses = make_index([100, 200, 300], [1, 9, 20])
+    graph = build_knn_graph(books, k=2, target=theses)
+    assert graph.neighbours_of(1) == [(100, 1.0), (200, 81.0)]
+    assert graph.neighbours_of(2) == [(200, 1.0), (100, 81.0)]
+
+
+def test_index_vectors():
+    ids, vectors = index_vectors(make_index([7, 3], [[1, 2], [3, 4]]))
+    assert ids.tolist() == [7, 3]
+    assert vectors.tolist() == [[1, 2], [3, 4]]
+
+
+def test_save_and_load(tmp_path):
+    graph = build_knn_graph(make_index([30, 10, 20], [3, 0, 1]), k=1)
+    path = tmp_path / "graph_knn.npz"
+    graph.save(str(path))
+    loaded = KnnGraph.load(str(path))
+    assert len(loaded) == 3
+    assert loaded.indptr.tolist() == graph.indptr.tolist()
+    assert loaded.neighbours_of(30) == graph.neighbours_of(30) == [(20, 4.0)]
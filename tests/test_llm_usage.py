@@ -0,0 +1,24 @@
+from types import SimpleNamespace
+import metrics
+from llm_client import record_usage
+
+
+def test_record_usage_counts_cached_tokens():
+    before = {name: metrics.get_counter(f"usage_test.{name}") for name in ("prompt_tokens", "cached_tokens", "completion_tokens")}
+    usage = SimpleNamespace(prompt_tokens=2000, completion_tokens=50,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=1536))
+    record_usage("usage_test", usage)
+    # Usage details may also arrive as plain dicts
+    record_usage("usage_test", {"prompt_tokens": 100, "completion_tokens": 10, "prompt_tokens_details": {"cached_tokens": 0}})
+
+    assert metrics.get_counter("usage_test.prompt_tokens") - before["prompt_tokens"] == 2100
+    assert metrics.get_counter("usage_test.cached_tokens") - before["cached_tokens"] == 1536
+    assert metrics.get_counter("usage_test.completion_tokens") - before["completion_tokens"] == 60
+
+
+def test_record_usage_without_details():
+    before = metrics.get_counter("usage_test_plain.cached_tokens")
+    record_usage("usage_test_plain", SimpleNamespace(prompt_tokens=10, completion_tokens=2, prompt_tokens_details=None))
+    record_usage("usage_test_plain", None)
+    assert metrics.get_counter("usage_test_plain.cached_tokens") == before
+    assert metrics.get_counter("usage_test_plain.prompt_tokens") == 10
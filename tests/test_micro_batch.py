@@ -0,0 +1,92 @@
+import threading
+import admission
+import deadline
+from micro_batch import MicroBatcher
+
+
+def call_together(batcher, items):
+    """batcher(item) for every item, each from its own thread; results and errors by item"""
+    results = {}
+
+    def target(item):
+        try:
+            results[item] = batcher(item)
+        except Exception as e:
+            results[item] = e
+
+    threads = [threading.Thread(target=target, args=(item,)) for item in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_calls_go_out_as_one_batch():
+    batches = []
+
+    def square(items):
+        batches.append(list(items))
+        return [item * item for item in items]
+
+    batcher = MicroBatcher("test-batch", square, max_batch=4, max_wait=1.0)
+    results = call_together(batcher, [1, 2, 3, 4])
+
+    assert results == {1: 1, 2: 4, 3: 9, 4: 16}
+    assert len(batches) == 1 and sorted(batches[0]) == [1, 2, 3, 4]
+
+
+def test_batch_is_sent_after_max_wait():
+    batches = []
+
+    def echo(items):
+        batches.append(list(items))
+        return items
+
+    batcher = MicroBatcher("test-wait", echo, max_batch=10, max_wait=0.02)
+    assert batcher('a') == 'a'
+    assert batcher('b') == 'b'
+    assert batches == [['a'], ['b']]
+
+
+def test_every_caller_gets_the_batch_error():
+    def fail(items):
+        raise ValueError("service down")
+
+    batcher = MicroBatcher("test-error", fail, max_batch=3, max_wait=1.0)
+    results = call_together(batcher, [1, 2, 3])
+    assert all(isinstance(result, ValueError) for result in results.values())
+
+
+def test_batch_of_one_is_called_directly():
+    callers = []
+
+    def who(items):
+        callers.append(threading.current_thread())
+        return items
+
+    batcher = MicroBatcher("test-direct", who, max_batch=1, max_wait=1.0)
+    assert batcher('x') == 'x'
+    assert callers == [threading.current_thread()]
+
+
+def test_batch_runs_in_the_context_of_its_most_urgent_caller():
+    seen = []
+
+    def record(items):
+        current = deadline.current()
+        seen.append((admission.current_user.get(), current and current.seconds))
+        return items
+
+    batcher = MicroBatcher("test-context", record, max_batch=3, max_wait=1.0)
+
+    def caller(item):
+        user, seconds = item
+        admission.current_user.set(user)
+        if seconds is not None:
+            deadline._current.set(deadline.Deadline(seconds))
+        return batcher(item)
+
+    results = call_together(caller, [('a', 20), ('b', 5), ('c', None)])
+    assert results == {('a', 20): ('a', 20), ('b', 5): ('b', 5), ('c', None): ('c', None)}
+    assert seen == [('b', 5)]
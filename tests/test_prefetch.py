@@ -0,0 +1,36 @@
+import admission
+import deadline
+from prefetch import Prefetcher
+
+
+def test_prefetch_keeps_the_chat_but_not_the_deadline():
+    prefetcher = Prefetcher("test-prefetch", max_workers=1)
+
+    def context():
+        return admission.current_user.get(), deadline.current()
+
+    admission.current_user.set(42)
+    token = deadline._current.set(deadline.Deadline(0.01))
+    try:
+        prefetcher.submit(42, 'context', context)
+    finally:
+        deadline._current.reset(token)
+        admission.current_user.set(None)
+    assert prefetcher.take(42, 'context') == (42, None)
+
+
+def test_take_hands_a_result_over_once():
+    prefetcher = Prefetcher("test-prefetch-once", max_workers=1)
+    prefetcher.submit(1, 'page', lambda: [1, 2, 3])
+    assert prefetcher.take(1, 'page') == [1, 2, 3]
+    assert prefetcher.take(1, 'page') is None
+
+
+def test_failures_and_cancelled_chats_give_nothing():
+    prefetcher = Prefetcher("test-prefetch-fail", max_workers=1)
+    prefetcher.submit(1, 'page', lambda: 1 / 0)
+    assert prefetcher.take(1, 'page') is None
+
+    prefetcher.submit(2, 'page', lambda: 'late')
+    prefetcher.cancel(2)
+    assert prefetcher.take(2, 'page') is None
@@ -0,0 +1,88 @@
+import asyncio
+from datetime import datetime
+from telegram import Chat, Message, Update
+import config
+import priority_updates
+from priority_updates import PriorityUpdateProcessor
+
+
+def text_update(text, update_id=1):
+    message = Message(message_id=update_id, date=datetime.now(), chat=Chat(1, Chat.PRIVATE), text=text)
+    return Update(update_id, message=message)
+
+
+def test_cheap_updates():
+    processor = PriorityUpdateProcessor(1, cheap_commands=['start', 'help'])
+    assert processor.is_cheap(text_update('/start'))
+    assert processor.is_cheap(text_update('/help@library_bot'))
+    assert processor.is_cheap("not an update")
+    assert not processor.is_cheap(text_update('/search'))
+    assert not processor.is_cheap(text_update('کتاب شعر'))
+
+
+def test_heavy_updates_run_workers_at_a_time():
+    processor = PriorityUpdateProcessor(2)
+    running = []
+    most = []
+
+    async def handle():
+        running.append(1)
+        most.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+
+    async def main():
+        await processor.initialize()
+        for i in range(6):
+            await processor.do_process_update(text_update('سوال', i), handle())
+        await processor.shutdown()
+
+    asyncio.run(main())
+    assert len(most) == 6
+    assert max(most) == 2
+
+
+def test_cheap_update_skips_the_waiting_messages():
+    processor = PriorityUpdateProcessor(1, cheap_commands=['start'])
+    order = []
+
+    async def handle(name, seconds=0.0):
+        await asyncio.sleep(seconds)
+        order.append(name)
+
+    async def main():
+        await processor.initialize()
+        await processor.do_process_update(text_update('سوال', 1), handle('question 1', 0.05))
+        await processor.do_process_update(text_update('سوال', 2), handle('question 2'))
+        await processor.do_process_update(text_update('/start', 3), handle('start'))
+        await processor.shutdown()
+
+    asyncio.run(main())
+    assert order == ['start', 'question 1', 'question 2']
+
+
+def test_busy_reply_past_the_queue_limit(monkeypatch):
+    monkeypatch.setattr(config, 'UPDATE_QUEUE_LIMIT', 2)
+    replies = []
+
+    async def reply_text(self, text, *args, **kwargs):
+        replies.append(text)
+
+    monkeypatch.setattr(Message, 'reply_text', reply_text)
+    processor = PriorityUpdateProcessor(1)
+    handled = []
+
+    async def handle(i):
+        await asyncio.sleep(0.01)
+        handled.append(i)
+
+    async def main():
+        await processor.initialize()
+        for i in range(4):
+            await processor.do_process_update(text_update('سوال', i), handle(i))
+        await processor.shutdown()
+
+    asyncio.run(main())
+    # Two wait for the only worker; the next two are turned away at once
+    assert handled == [0, 1]
+    assert replies == [priority_updates.BUSY_REPLY] * 2
@@ -0,0 +1,71 @@
+import pytest
+from modules.regulations_handler import RegulationsHandler
+from regulations_loader import RegulationsLoader
+
+DONATION = "\n".join([
+    "آیین‌نامه منابع اهدایی",
+    "ماده ۱ - تعاریف",
+    "منابع اهدایی کتاب‌هایی است که به کتابخانه هدیه می‌شود.",
+    "ماده ۲ - شرایط پذیرش",
+    "کتاب باید سالم باشد.",
+    "تبصره ۱ - کتاب‌های تکراری پذیرفته نمی‌شود.",
+    "تبصره ۲ - نسخه‌های غیرقانونی پذیرفته نمی‌شود.",
+])
+
+LOAN = "\n".join([
+    "ماده ۱ - امانت",
+    "هر عضو می‌تواند پنج کتاب امانت بگیرد.",
+    "ماده دوم - تمدید",
+    "امانت دو بار تمدید می‌شود.",
+])
+
+
+@pytest.fixture
+def loader(tmp_path):
+    loader = RegulationsLoader(str(tmp_path / "missing"))
+    loader.documents = [("منابع_اهدایی.docx", DONATION), ("امانت.docx", LOAN)]
+    loader.article_index = loader.build_article_index()
+    return loader
+
+
+@pytest.fixture
+def handler(loader):
+    return RegulationsHandler("", chunks=loader.get_chunks(), article_index=loader.article_index)
+
+
+def test_direct_reference(handler):
+    reference = handler.resolve_reference("ماده ۲ آیین‌نامه اهدا چی میگه؟")
+    assert reference['document'] == 'منابع_اهدایی'
+    assert reference['article_no'] == 2
+    assert reference['direct']
+    assert "کتاب باید سالم باشد." in handler.format_reference_answer(reference)
+
+
+def test_note_reference(handler):
+    reference = handler.resolve_reference("تبصره ۲ ماده ۲ اهدا")
+    assert reference['note_no'] == 2
+    assert "غیرقانونی" in handler.format_reference_answer(reference)
+
+
+def test_ambiguous_reference_asks_for_the_document(handler):
+    reference = handler.resolve_reference("ماده ۱")
+    assert reference['document'] is None
+    assert sorted(reference['candidates']) == ['امانت', 'منابع_اهدایی']
+    assert "چند آیین‌نامه" in handler.format_reference_answer(reference)
+
+
+def test_free_form_question_about_an_article(handler):
+    reference = handler.resolve_reference("طبق ماده ۲ امانت چند بار میشه کتاب رو تمدید کرد")
+    assert reference['document'] == 'امانت'
+    assert not reference['direct']
+    assert handler.reference_chunk(reference)['title'] == 'ماده دوم'
+
+
+def test_no_reference(handler):
+    assert handler.resolve_reference("چطور کتاب اهدا کنم") is None
+    assert handler.resolve_reference("ماده ۹ امانت") is None
+
+
+def test_lexical_search(handler):
+    results = handler.lexical_search("تمدید امانت", k=2)
+    assert results[0]['title'] == 'ماده دوم'
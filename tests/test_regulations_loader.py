@@ -0,0 +1,66 @@
+import pytest
+from regulations_loader import RegulationsLoader, parse_number
+
+DONATION = "\n".join([
+    "آیین‌نامه منابع اهدایی",
+    "ماده ۱ - تعاریف",
+    "منابع اهدایی کتاب‌هایی است که به کتابخانه هدیه می‌شود.",
+    "ماده ۲ - شرایط پذیرش",
+    "کتاب باید سالم باشد.",
+    "تبصره ۱ - کتاب‌های تکراری پذیرفته نمی‌شود.",
+    "تبصره ۲ - نسخه‌های غیرقانونی پذیرفته نمی‌شود.",
+])
+
+LOAN = "\n".join([
+    "ماده ۱ - امانت",
+    "هر عضو می‌تواند پنج کتاب امانت بگیرد.",
+    "ماده دوم - تمدید",
+    "امانت دو بار تمدید می‌شود.",
+])
+
+
+@pytest.fixture
+def loader(tmp_path):
+    loader = RegulationsLoader(str(tmp_path / "missing"))
+    loader.documents = [("منابع_اهدایی.docx", DONATION), ("امانت.docx", LOAN)]
+    loader.article_index = loader.build_article_index()
+    return loader
+
+
+def test_parse_number():
+    assert parse_number('۲') == 2
+    assert parse_number('12') == 12
+    assert parse_number('دوم') == 2
+    assert parse_number('واحده') == 1
+    assert parse_number('فلان') is None
+    assert parse_number(None) is None
+
+
+def test_chunks_follow_the_articles(loader):
+    chunks = loader.get_chunks()
+    assert [(c['document'], c['title']) for c in chunks] == [
+        ('منابع_اهدایی', 'مقدمه'),
+        ('منابع_اهدایی', 'ماده ۱'),
+        ('منابع_اهدایی', 'ماده ۲'),
+        ('امانت', 'ماده ۱'),
+        ('امانت', 'ماده دوم'),
+    ]
+    assert [c['id'] for c in chunks] == list(range(5))
+    assert "تبصره ۲" in chunks[2]['text']
+
+
+def test_long_articles_are_split_at_their_notes(loader):
+    chunks = [c for c in loader.get_chunks(max_chars=70) if c['title'] == 'ماده ۲']
+    assert len(chunks) > 1
+    assert all(len(c['text']) <= 70 + len("(ماده ۲ - ادامه)\n") for c in chunks)
+    # Every continuation names its article
+    assert all(c['text'].startswith("(ماده ۲ - ادامه)") for c in chunks[1:])
+    assert any(c['text'].endswith("تبصره ۲ - نسخه‌های غیرقانونی پذیرفته نمی‌شود.") for c in chunks)
+
+
+def test_article_index(loader):
+    donation = loader.article_index['منابع_اهدایی']
+    assert sorted(donation) == [1, 2]
+    assert sorted(donation[2]['notes']) == [1, 2]
+    assert donation[2]['notes'][1].startswith("تبصره ۱")
+    assert sorted(loader.article_index['امانت']) == [1, 2]
@@ -0,0 +1,103 @@
+import contextvars
+import pytest
+from circuit_breaker import CircuitOpen
+from retrieval_engine import Collection, RetrievalEngine
+
+chat = contextvars.ContextVar("chat", default=None)
+
+
+class FakeClient:
+    def __init__(self, model):
+        self.model = model
+
+
+class FakeEmbedder:
+    def __init__(self, results, model="small", vector=(1.0, 0.0)):
+        self.results = results
+        self.vector = vector
+        self.embedding_client = FakeClient(model)
+        self.embedded = 0
+        self.chats = []
+
+    def embed_query(self, query):
+        self.embedded += 1
+        if isinstance(self.vector, Exception):
+            raise self.vector
+        return self.vector
+
+    def search_vector(self, vector, k):
+        self.chats.append(chat.get())
+        return [dict(r) for r in self.results[:k]]
+
+
+def test_merge_sorts_by_distance():
+    found = {
+        'book': [{'id': 'b1', 'distance': 0.3}, {'id': 'b2', 'distance': 0.6}],
+        'thesis': [{'id': 't1', 'distance': 0.1}, {'id': 't2', 'distance': 0.5}],
+    }
+    assert [r['id'] for r in RetrievalEngine.merge(found)] == ['t1', 'b1', 't2', 'b2']
+    assert [r['id'] for r in RetrievalEngine.merge(found, limit=2)] == ['t1', 'b1']
+    assert RetrievalEngine.merge({}) == []
+
+
+def test_collection_threshold_and_enrich():
+    embedder = FakeEmbedder([{'id': 1, 'distance': 0.2}, {'id': 2, 'distance': 0.9}])
+    collection = Collection("book", embedder, enrich=lambda r: {**r, 'title': f"t{r['id']}"}, threshold=0.5)
+    assert collection.search("q", [1.0], 5) == [{'id': 1, 'distance': 0.2, 'title': 't1', 'collection': 'book'}]
+
+
+def test_collection_lexical_fallback():
+    lexical = lambda query, k: [{'id': query, 'distance': 0.1}]
+    assert Collection("book", FakeEmbedder([]), lexical=lexical).search("شعر", None, 5)[0]['id'] == "شعر"
+    assert Collection("book", FakeEmbedder([])).search("شعر", None, 5) == []
+
+
+def test_search_embeds_once_and_merges():
+    books = FakeEmbedder([{'id': 'b1', 'distance': 0.4}, {'id': 'b2', 'distance': 0.7}])
+    theses = FakeEmbedder([{'id': 't1', 'distance': 0.2}])
+    engine = RetrievalEngine(max_workers=2)
+    engine.register('book', books)
+    engine.register('thesis', theses)
+
+    chat.set(42)
+    found = engine.search("query", k=5)
+    assert books.embedded + theses.embedded == 1
+    assert [r['id'] for r in RetrievalEngine.merge(found)] == ['t1', 'b1', 'b2']
+    assert {r['collection'] for r in found['thesis']} == {'thesis'}
+    # The searches run with the caller's context
+    assert books.chats == theses.chats == [42]
+
+
+def test_search_selected_collections():
+    engine = RetrievalEngine(max_workers=1)
+    engine.register('book', FakeEmbedder([{'id': 'b1', 'distance': 0.4}]))
+    engine.register('thesis', FakeEmbedder([{'id': 't1', 'distance': 0.2}]))
+    assert list(engine.search("query", names=['thesis', 'unknown'])) == ['thesis']
+    assert engine.search("query", names=['unknown']) == {}
+
+
+def test_search_falls_back_to_words_when_circuit_is_open():
+    books = FakeEmbedder([{'id': 'b1', 'distance': 0.4}], vector=CircuitOpen("embedding"))
+    engine = RetrievalEngine(max_workers=1)
+    engine.register('book', books, lexical=lambda query, k: [{'id': 'word', 'distance': 0.0}])
+    assert [r['id'] for r in engine.search("query")['book']] == ['word']
+
+
+def test_failed_collection_gives_no_results():
+    def broken(result):
+        raise RuntimeError("bad row")
+
+    engine = RetrievalEngine(max_workers=2)
+    engine.register('book', FakeEmbedder([{'id': 'b1', 'distance': 0.4}]), enrich=broken)
+    engine.register('thesis', FakeEmbedder([{'id': 't1', 'distance': 0.2}]))
+    found = engine.search("query")
+    assert found['book'] == []
+    assert [r['id'] for r in found['thesis']] == ['t1']
+
+
+def test_register_requires_same_model():
+    engine = RetrievalEngine(max_workers=1)
+    engine.register('book', FakeEmbedder([], model="small"))
+    with pytest.raises(ValueError):
+        engine.register('thesis', FakeEmbedder([], model="large"))
+    assert list(engine.collections) == ['book']
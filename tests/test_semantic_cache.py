@@ -0,0 +1,78 @@
+import numpy as np
+from semantic_cache import SemanticCache
+
+
+def make_cache(tmp_path=None, **kwargs):
+    path = str(tmp_path / "faq.pkl") if tmp_path else None
+    return SemanticCache("test_faq", threshold=0.9, max_size=3, path=path, **kwargs)
+
+
+def test_lookup_uses_threshold():
+    cache = make_cache()
+    assert cache.lookup([1, 0]) is None
+    cache.add("question", [2, 0], "answer")
+    # Vectors are normalized, so only the direction counts
+    assert cache.lookup([5, 0]) == "answer"
+    assert cache.lookup([0.95, 0.2]) == "answer"
+    assert cache.lookup([1, 1]) is None
+    assert cache.lookup([0, 1]) is None
+
+
+def test_lookup_returns_most_similar():
+    cache = make_cache()
+    cache.add("first", [1, 0, 0], "a")
+    cache.add("second", [0, 1, 0], "b")
+    assert cache.lookup([0.1, 1, 0]) == "b"
+    assert cache.lookup([1, 0.1, 0]) == "a"
+
+
+def test_oldest_answers_dropped_beyond_max_size():
+    cache = make_cache()
+    for i in range(4):
+        vector = [0, 0, 0, 0]
+        vector[i] = 1
+        cache.add(f"q{i}", vector, f"a{i}")
+    assert len(cache) == 3
+    assert cache.questions == ["q1", "q2", "q3"]
+    assert cache.lookup([1, 0, 0, 0]) is None
+    assert cache.lookup([0, 0, 0, 1]) == "a3"
+
+
+def test_load_keeps_answers_of_same_fingerprint(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.load("v1")
+    cache.add("question", [1, 0], "answer")
+    cache.save()
+
+    reloaded = make_cache(tmp_path)
+    reloaded.load("v1")
+    assert len(reloaded) == 1
+    assert reloaded.lookup([1, 0]) == "answer"
+
+
+def test_load_drops_answers_of_other_fingerprint(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.load("v1")
+    cache.add("question", [1, 0], "answer")
+    cache.save()
+
+    reloaded = make_cache(tmp_path)
+    reloaded.load("v2")
+    assert len(reloaded) == 0
+    assert reloaded.fingerprint == "v2"
+    assert reloaded.lookup([1, 0]) is None
+
+
+def test_load_ignores_unreadable_file(tmp_path):
+    (tmp_path / "faq.pkl").write_bytes(b"not a pickle")
+    cache = make_cache(tmp_path)
+    cache.load("v1")
+    assert len(cache) == 0
+
+
+def test_reset_empties_cache():
+    cache = make_cache()
+    cache.add("question", [1, 0], "answer")
+    cache.reset("v2")
+    assert len(cache) == 0
+    assert cache.lookup([1, 0]) is None
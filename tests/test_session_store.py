@@ -0,0 +1,146 @@
+import pickle
+import time
+from collections import OrderedDict
+import pytest
+import config
+import session_store
+from session_store import ChatSession, SessionManager, SQLiteSessionStore
+
+
+class CountingStore(SQLiteSessionStore):
+    def __init__(self, path):
+        super().__init__(path)
+        self.loads = 0
+
+    def load(self, namespace, chat_id):
+        self.loads += 1
+        return super().load(namespace, chat_id)
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    """Each test starts with no loaded sessions"""
+    monkeypatch.setattr(session_store, '_active', OrderedDict())
+    monkeypatch.setattr(session_store, '_managers', [])
+    monkeypatch.setattr(session_store, '_sizes', {})
+    monkeypatch.setattr(session_store, '_loaded_bytes', 0)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CountingStore(str(tmp_path / "sessions.db"))
+
+
+def manager(store, name, on_expire=None):
+    return SessionManager(name, ChatSession, store=store, on_expire=on_expire)
+
+
+def test_sessions_are_saved_and_loaded(store):
+    sessions = manager(store, "test-save")
+    session = sessions.get(1)
+    session.query = "شعر نو"
+    session.result_ids.extend([3, 5, 8])
+    session.history.append({"role": "user", "content": "سلام"})
+    sessions.flush()
+
+    loaded = manager(store, "test-save").get(1)
+    assert loaded.query == "شعر نو"
+    assert list(loaded.result_ids) == [3, 5, 8]
+    assert list(loaded.history) == [{"role": "user", "content": "سلام"}]
+    # Namespaces are separate
+    assert manager(store, "test-save-other").get(1).query == ""
+
+
+def test_peek_creates_and_saves_nothing(store):
+    sessions = manager(store, "test-peek")
+    assert sessions.peek(1).query == ""
+    sessions.flush()
+    assert store.load("test-peek", 1) is None
+
+
+def test_peek_reads_the_store_once(store):
+    writer = manager(store, "test-peek-once")
+    writer.get(1).query = "saved"
+    writer.flush()
+
+    sessions = manager(store, "test-peek-once")
+    loads = store.loads
+    for _ in range(5):
+        assert sessions.peek(1).query == "saved"
+        assert sessions.peek(2).query == ""
+    assert store.loads == loads + 2
+
+
+def test_peek_sees_the_changes_of_get(store):
+    sessions = manager(store, "test-peek-get")
+    sessions.get(1).query = "new"
+    assert sessions.peek(1).query == "new"
+
+
+def test_reset_forgets_the_session(store):
+    sessions = manager(store, "test-reset")
+    sessions.get(1).query = "old"
+    sessions.flush()
+    sessions.reset(1)
+    assert store.load("test-reset", 1) is None
+    assert sessions.get(1).query == ""
+
+
+def test_unloaded_sessions_are_written_and_read_back(store, monkeypatch):
+    sessions = manager(store, "test-evict")
+    monkeypatch.setattr(config, 'SESSION_MAX_ACTIVE', 2)
+    for chat_id in range(4):
+        sessions.get(chat_id).query = f"q{chat_id}"
+    assert len(sessions) == 2
+    sessions.flush()
+    assert [sessions.get(chat_id).query for chat_id in range(4)] == ["q0", "q1", "q2", "q3"]
+
+
+def test_sessions_are_unloaded_over_the_memory_budget(store, monkeypatch):
+    sessions = manager(store, "test-budget")
+    small = ChatSession().approx_size()
+    monkeypatch.setattr(config, 'SESSION_MEMORY_BUDGET', 3 * small + 5000)
+
+    big = sessions.get(1)
+    big.history.extend({"role": "user", "content": "پ" * 1000} for _ in range(3))
+    sessions.flush()
+    assert session_store._sizes[(sessions, 1)] > 6000
+    assert len(sessions) == 1
+
+    # Two small sessions fit; the large one, least recently used, is unloaded
+    sessions.get(2)
+    sessions.get(3)
+    assert sorted(sessions._sessions) == [2, 3]
+    assert session_store._loaded_bytes == 2 * small
+    assert len(sessions.get(1).history) == 3
+
+
+def test_idle_sessions_expire(store):
+    expired = []
+    sessions = manager(store, "test-expire", on_expire=expired.append)
+    sessions.get(1).query = "idle"
+    sessions.flush()
+    time.sleep(0.05)
+    sessions.get(2).query = "recent"
+    sessions.flush()
+
+    assert session_store.expire_idle_sessions(max_idle=0.03) == 1
+    assert 1 in expired and 2 not in expired
+    assert store.load("test-expire", 1) is None
+    assert store.load("test-expire", 2).query == "recent"
+
+
+def test_store_is_opened_on_first_use(monkeypatch):
+    opened = []
+    monkeypatch.setattr(session_store, 'get_store', lambda: opened.append(1) or session_store.InMemorySessionStore())
+    sessions = SessionManager("test-lazy", ChatSession)
+    assert opened == []
+    sessions.get(1)
+    assert opened == [1]
+
+
+def test_old_sessions_get_new_slots(store):
+    session = ChatSession()
+    del session.cursor_depth
+    store.save_many("test-slots", {1: pickle.dumps(session)})
+    assert manager(store, "test-slots").get(1).cursor_depth == 0
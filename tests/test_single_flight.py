@@ -0,0 +1,109 @@
+import threading
+import time
+import pytest
+import config
+import deadline
+import metrics
+from single_flight import SingleFlight, shared
+
+
+def wait_until(condition, timeout=2.0):
+    stop = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < stop, "condition not reached"
+        time.sleep(0.005)
+
+
+def run_concurrently(flight, key, fn, followers):
+    """The leader's call of fn, then followers more calls while it runs; their results"""
+    results = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait()
+        return fn()
+
+    def target(call):
+        try:
+            results.append(flight.do(key, call))
+        except Exception as e:
+            results.append(e)
+
+    coalesced = metrics.get_counter(f"{flight.name}.coalesced")
+    threads = [threading.Thread(target=target, args=(blocking,))]
+    threads[0].start()
+    started.wait()
+    for _ in range(followers):
+        threads.append(threading.Thread(target=target, args=(fn,)))
+        threads[-1].start()
+    wait_until(lambda: metrics.get_counter(f"{flight.name}.coalesced") == coalesced + followers)
+    release.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_callers_share_one_call():
+    calls = []
+
+    def fn():
+        calls.append(1)
+        return "answer"
+
+    results = run_concurrently(SingleFlight("test-flight"), "q", fn, followers=4)
+    assert results == ["answer"] * 5
+    assert len(calls) == 1
+
+
+def test_concurrent_callers_share_the_error():
+    def fn():
+        raise ValueError("failed")
+
+    results = run_concurrently(SingleFlight("test-flight-error"), "q", fn, followers=2)
+    assert len(results) == 3
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_nothing_is_kept_after_the_call():
+    flight = SingleFlight("test-flight-again")
+    calls = []
+    assert flight.do("q", lambda: calls.append(1) or len(calls)) == 1
+    assert flight.do("q", lambda: calls.append(1) or len(calls)) == 2
+    with pytest.raises(KeyError):
+        flight.do("q", lambda: {}["missing"])
+    assert flight.do("q", lambda: "fine") == "fine"
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight("test-flight-keys")
+    assert flight.do("a", lambda: 1) == 1
+    assert flight.do("b", lambda: 2) == 2
+
+
+def test_shared():
+    assert shared("test-shared") is shared("test-shared")
+    assert shared("test-shared") is not shared("test-shared-other")
+
+
+def test_waiting_callers_are_bounded_by_their_stage_budget(monkeypatch):
+    monkeypatch.setitem(config.STAGE_BUDGETS, 'probe', 0.1)
+    flight = SingleFlight("test-flight-stage")
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(2)
+        return "late"
+
+    leader = threading.Thread(target=flight.do, args=("q", slow))
+    leader.start()
+    started.wait()
+    began = time.monotonic()
+    with pytest.raises(deadline.DeadlineExceeded):
+        flight.do("q", slow, stage="test.probe")
+    assert time.monotonic() - began < 1.0
+    release.set()
+    leader.join()
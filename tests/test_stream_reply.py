@@ -0,0 +1,80 @@
+import asyncio
+import config
+from stream_reply import StreamingReply, split_message
+
+
+class SentMessage:
+    def __init__(self, text):
+        self.texts = [text]
+
+    async def edit_text(self, text):
+        self.texts.append(text)
+
+
+class UserMessage:
+    """Replies are held until release is set"""
+
+    def __init__(self):
+        self.replies = []
+        self.release = None
+
+    async def reply_text(self, text):
+        if self.release is not None:
+            await self.release.wait()
+        sent = SentMessage(text)
+        self.replies.append(sent)
+        return sent
+
+
+def test_split_message():
+    assert split_message("a" * 5, limit=10) == ["a" * 5]
+    assert split_message("aaaa\nbbbb\ncc", limit=10) == ["aaaa\nbbbb", "cc"]
+    assert split_message("a" * 25, limit=10) == ["a" * 10, "a" * 10, "a" * 5]
+
+
+def test_finish_edits_the_streamed_message():
+    message = UserMessage()
+
+    async def main():
+        reply = StreamingReply(message, interval=0.01, min_chars=1)
+        reply.start()
+        reply.push("سلام")
+        await asyncio.sleep(0.05)
+        await reply.finish("سلام، پاسخ کامل")
+
+    asyncio.run(main())
+    assert len(message.replies) == 1
+    assert message.replies[0].texts == ["سلام ▌", "سلام، پاسخ کامل"]
+
+
+def test_stop_waits_for_a_pending_send():
+    message = UserMessage()
+
+    async def main():
+        message.release = asyncio.Event()
+        reply = StreamingReply(message, interval=0.01, min_chars=1)
+        reply.start()
+        reply.push("بخشی از پاسخ")
+        await asyncio.sleep(0.05)
+        # The first reply_text is still pending when the answer is ready
+        finishing = asyncio.create_task(reply.finish("پاسخ کامل"))
+        await asyncio.sleep(0.05)
+        message.release.set()
+        await finishing
+
+    asyncio.run(main())
+    # The partial message is edited into the answer, not left behind
+    assert len(message.replies) == 1
+    assert message.replies[0].texts == ["بخشی از پاسخ ▌", "پاسخ کامل"]
+
+
+def test_answer_without_streamed_text_is_sent():
+    message = UserMessage()
+
+    async def main():
+        reply = StreamingReply(message, interval=0.01, min_chars=1)
+        reply.start()
+        await reply.finish("a" * (config.STREAM_MIN_CHARS + 1))
+
+    asyncio.run(main())
+    assert [sent.texts for sent in message.replies] == [["a" * (config.STREAM_MIN_CHARS + 1)]]
@@ -1,30 +1,33 @@
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from openai import OpenAI
 import config
 from book_embedder import BookEmbedder
 from thesis_details import ThesisDetailsLoader
-from collections import defaultdict
+from llm_client import create_chat_completion, get_openai_client
+from answer_cache import AnswerCache, normalize_query, prompt_version
+from single_flight import SingleFlight
+from deadline import DeadlineExceeded, bounded
+from circuit_breaker import CircuitOpen
+from modules.thesis_handler import ThesisHandler
+from context_builder import ContextBuilder
+from stream_reply import StreamingReply
+from session_store import ChatSession, SessionManager, row_ids, schedule_expiry
+from intent_router import IntentRouter, ordinal_of, pick
+from fast_answers import FastAnswers
+from prefetch import Prefetcher
+from explanation_store import get_explanation_store
 from datetime import datetime, timedelta
+import asyncio
 import re
 
 print("🔄 Loading modules...")
 
-last_shown_results = defaultdict(list)
-openai_client = OpenAI(api_key=config.OPENAI_API_KEY)
+openai_client = get_openai_client()
 embedder = None
 thesis_details_loader = None
-conversation_memory = defaultdict(list)
-search_results_memory = defaultdict(list)
-last_message_time = defaultdict(lambda: datetime.now())
-last_query_memory = defaultdict(str)
-
-# ✅ Filter system
-filter_state = defaultdict(lambda: {
-    'active': False,
-    'stage': None,
-    'last_offer': None
-})
+handler = None  # formatting and word search while the OpenAI services are down
+answer_cache = AnswerCache("thesis")
+searches = SingleFlight("thesis.search")  # the same query searched at once runs once
 
 ORIGINAL_EXCEL_PATH = "output/theses/theses_normalized.xlsx"
 FAISS_INDEX_PATH = "output/theses/faiss_index.bin"
@@ -49,6 +52,32 @@ SYSTEM_PROMPT = """
    - پایان‌نامه تکراری معرفی نکن
 """
 
+# Fixed output instructions belong to the system prompt, ahead of the
+# per-question results, so they stay in the provider's cached prefix
+ANSWER_SYSTEM_PROMPT = SYSTEM_PROMPT + (
+    "\n**فرمت خروجی:**\n📄 «عنوان»\n   پژوهشگر: ...\n   استاد راهنما: ...\n   مقطع: ...\n   رشته: ...\n   سال: ...\n\n"
+    "**مهم:** اگر سال '...' بود، از 'نامشخص' استفاده کن.\n"
+)
+ANSWER_TEMPLATE = "پایان‌نامه‌ها:\n{context}\n\nسوال: {query}"
+ANSWER_PROMPT_VERSION = prompt_version(ANSWER_SYSTEM_PROMPT, ANSWER_TEMPLATE)
+
+FILTER_INSTRUCTIONS = """
+از لیست پایان‌نامه‌ها فقط موارد مرتبط با سوال را انتخاب کن.
+خروجی: شماره‌ها با کاما (مثل '1,3') یا 'هیچکدام'.
+"""
+
+# Thesis answers are built without conversation history
+context_builder = ContextBuilder("thesis", ANSWER_SYSTEM_PROMPT, history_limit=0)
+
+# Question used for the explanation prefetched after a search
+PREFETCH_EXPLAIN_QUESTION = "این پایان‌نامه درباره چیست؟"
+
+# Reply when a message runs past config.REQUEST_DEADLINE before results are found
+TIMEOUT_REPLY = "⏳ پاسخ‌گویی بیش از حد طول کشید. لطفاً چند لحظه دیگر دوباره بپرسید."
+
+prefetcher = Prefetcher("thesis")
+explanations = get_explanation_store()
+
 
 def format_field(field_raw):
     if not field_raw or str(field_raw).lower() in ['nan', 'none', '']:
@@ -85,66 +114,191 @@ def enrich_search_result(result):
 
 
 # Memory functions
-def clean_old_conversations():
-    current_time = datetime.now()
-    expired_chats = []
-    for chat_id, last_time in last_message_time.items():
-        if current_time - last_time > timedelta(days=7):
-            expired_chats.append(chat_id)
-    for chat_id in expired_chats:
-        conversation_memory.pop(chat_id, None)
-        search_results_memory.pop(chat_id, None)
-        last_message_time.pop(chat_id, None)
-        last_query_memory.pop(chat_id, None)
-        last_shown_results.pop(chat_id, None)
-        filter_state.pop(chat_id, None)
+def new_filter_state():
+    return {
+        'active': False,
+        'stage': None,
+        'last_offer': None
+    }
+
+
+def load_results(ids):
+    """Search results for stored row ids (index metadata plus thesis details)"""
+    results = []
+    for row_id in ids:
+        metadata = embedder.metadata_map.get(row_id) if embedder is not None else None
+        results.append(enrich_search_result(dict(metadata) if metadata else {'رديف': row_id}))
+    return results
+
+
+def new_session():
+    # ✅ Filter system state lives in the session too
+    return ChatSession(history_size=config.SESSION_HISTORY_SIZE, filter_state=new_filter_state())
+
+
+# Per-chat state, kept in the session store so it survives restarts
+# (idle sessions are expired by session_store.expire_idle_sessions)
+sessions = SessionManager("thesis", new_session)
+
+
+def reset_conversation(chat_id):
+    sessions.reset(chat_id)
+    prefetcher.cancel(chat_id)
+
+
+def drop_expired_messages(history):
+    # Messages are kept in time order, so expired ones are at the front
+    three_days_ago = datetime.now() - timedelta(days=3)
+    while history and history[0]["timestamp"] <= three_days_ago:
+        history.popleft()
 
 
 def add_to_conversation(chat_id, role, content):
-    conversation_memory[chat_id].append({
+    history = sessions.get(chat_id).history
+    history.append({
         "role": role,
         "content": content,
         "timestamp": datetime.now()
     })
-    current_time = datetime.now()
-    three_days_ago = current_time - timedelta(days=3)
-    conversation_memory[chat_id] = [
-        msg for msg in conversation_memory[chat_id]
-        if msg["timestamp"] > three_days_ago
-    ]
-    if len(conversation_memory[chat_id]) > 100:
-        conversation_memory[chat_id] = conversation_memory[chat_id][-100:]
-    last_message_time[chat_id] = datetime.now()
+    drop_expired_messages(history)
 
 
 def save_search_results(chat_id, results, query=""):
-    search_results_memory[chat_id] = results
+    session = sessions.get(chat_id)
+    session.result_ids = row_ids(results)
     if query:
-        last_query_memory[chat_id] = query
-    last_message_time[chat_id] = datetime.now()
+        session.query = query
 
 
 def get_last_search_results(chat_id):
-    return search_results_memory.get(chat_id, [])
+    return load_results(sessions.peek(chat_id).result_ids)
 
 
 def get_last_query(chat_id):
-    return last_query_memory.get(chat_id, "")
+    return sessions.peek(chat_id).query
+
+
+def get_shown_results(chat_id):
+    return load_results(sessions.peek(chat_id).shown_ids)
+
+
+def set_shown_results(chat_id, results):
+    sessions.get(chat_id).shown_ids = row_ids(results)
+
+
+def save_cursor(chat_id, candidates, depth=None, offered=0):
+    """
+    Keep the ranked candidates of a search, best first, for "more" requests;
+    the first `offered` were already considered for the answer.
+    """
+    ranked = sorted(candidates, key=lambda r: r.get('distance', 0.0))
+    session = sessions.get(chat_id)
+    session.set_cursor(ranked, depth or config.SEARCH_DEPTH)
+    session.cursor_pos = min(offered, len(session.cursor))
+
+
+def next_depth(session):
+    # Searches go twice as deep each time the cursor runs out, up to a bound
+    return min(session.cursor_depth * 2 or config.SEARCH_DEPTH, config.SEARCH_DEPTH * 16)
+
+
+def search_deeper(query, depth, exclude_rows):
+    """Candidates among the first depth neighbours of query, best first (not filtered yet)"""
+    candidates = search_theses(query, k=depth, distance_threshold=1.0, exclude_rows=exclude_rows)
+    return query, depth, sorted(candidates, key=lambda r: r.get('distance', 0.0))
+
+
+def extend_cursor(chat_id, session):
+    # Search the last query deeper; candidates already in the cursor are skipped
+    depth = next_depth(session)
+    if depth <= session.cursor_depth:
+        return
+    prefetched = prefetcher.take(chat_id, 'extension')
+    if prefetched and prefetched[:2] == (session.query, depth):
+        found = prefetched[2]
+    else:
+        _, _, found = search_deeper(session.query, depth, set(session.cursor))
+    session.extend_cursor(found, depth)
+    print(f"🔎 Cursor extended to {depth} neighbours (+{len(found)})")
+
+
+def next_results(chat_id):
+    """Next page of the last search for a "more" request (see book_bot.next_results)"""
+    session = sessions.get(chat_id)
+    skip = set(session.shown_ids)
+    page = session.next_page(config.MORE_PAGE_SIZE, skip)
+    if len(page) < config.MORE_PAGE_SIZE and session.query:
+        extend_cursor(chat_id, session)
+        page += session.next_page(config.MORE_PAGE_SIZE - len(page), skip)
+
+    results = load_results([row_id for row_id, _ in page])
+    for result, (_, distance) in zip(results, page):
+        result['distance'] = distance
+    return filter_results_with_gpt(session.query, results, session.query) if results else []
+
+
+def similar_results(row_id, exclude_rows=()):
+    """Theses nearest to a thesis in the precomputed graph (no embedding or search)"""
+    pairs = [(i, d) for i, d in embedder.similar.neighbours_of(int(row_id)) if i not in exclude_rows]
+    results = load_results([i for i, _ in pairs])
+    for result, (_, distance) in zip(results, pairs):
+        result['distance'] = distance
+    return results
+
+
+def explain_thesis(item, question, on_delta=None):
+    """Short explanation of one thesis for a question about it"""
+    title = item.get('عنوان') or item.get('عنوان پایان‌نامه', '')
+    return create_chat_completion(
+        openai_client,
+        [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"عنوان: «{title}»\nپژوهشگر: {item.get('نویسنده', 'نامشخص')}\n\nسوال: {question}"}
+        ],
+        model="gpt-4o-mini",
+        max_tokens=500,
+        temperature=0.7,
+        on_delta=on_delta,
+        stage="thesis.explain"
+    )
+
+
+def prefetch_explanation(item):
+    return item['رديف'], explain_thesis(item, PREFETCH_EXPLAIN_QUESTION)
+
+
+def prefetch_next_turn(chat_id):
+    """Start what the next message will probably need (see book_bot.prefetch_next_turn)"""
+    session = sessions.peek(chat_id)
+    shown_ids = list(session.shown_ids)
+    upcoming = list(session.cursor[session.cursor_pos:session.cursor_pos + 2 * config.MORE_PAGE_SIZE])
+    prefetcher.warm(load_results, shown_ids + upcoming)
+
+    if session.query and session.remaining(set(shown_ids)) < config.MORE_PAGE_SIZE:
+        if (depth := next_depth(session)) > session.cursor_depth:
+            prefetcher.submit(chat_id, 'extension', search_deeper, session.query, depth, set(session.cursor))
+
+    if config.PREFETCH_EXPLANATION and shown_ids and stored_explanation(shown_ids[0]) is None:
+        prefetcher.submit(chat_id, 'explanation', prefetch_explanation, load_results(shown_ids[:1])[0])
+
+
+def stored_explanation(row_id):
+    return explanations.get("thesis", row_id) if explanations else None
 
 
 # Filter system
+def get_filter_state(chat_id):
+    return sessions.get(chat_id).filter
+
+
 def reset_filter_state(chat_id):
-    filter_state[chat_id] = {
-        'active': False,
-        'stage': None,
-        'last_offer': None
-    }
+    sessions.get(chat_id).filter = new_filter_state()
 
 
 def should_offer_filter(chat_id, search_results, is_new_search=False):
     if not is_new_search or not search_results or len(search_results) <= 1:
         return False
-    last_offer = filter_state[chat_id].get('last_offer')
+    last_offer = sessions.peek(chat_id).filter.get('last_offer')
     if last_offer:
         time_diff = (datetime.now() - last_offer).total_seconds()
         if time_diff < 30:
@@ -152,10 +306,53 @@ def should_offer_filter(chat_id, search_results, is_new_search=False):
     return True
 
 
-def is_filter_command(message):
-    filter_keywords = ['📅', '🎓', '👨‍🏫', '📚', '❌', '🔙', 'فیلتر', 'بله', 'آره', 'خیر', 'نه']
-    message_lower = message.lower()
-    return any(kw in message_lower or kw in message for kw in filter_keywords)
+# Follow-ups answered from the metadata of the shown theses
+FAST_ANSWERS = FastAnswers(
+    "thesis", "پایان‌نامه",
+    fields={
+        'year': ('سال دفاع', ['سال', 'سال دفاع', 'تاریخ دفاع'], ['سال', 'تاریخ دفاع', 'چه سالی']),
+        'advisor': ('استاد راهنما', ['استاد راهنما'], ['استاد راهنما']),
+        'consultant': ('استاد مشاور', ['استاد مشاور'], ['استاد مشاور', 'مشاور']),
+        'degree': ('مقطع', ['مقطع'], ['مقطع']),
+        'field': ('رشته', ['رشته', 'رشته تحصیلی'], ['رشته']),
+        'call_number': ('شماره راهنما', ['شماره راهنما'], ['شماره راهنما', 'شماره بازیابی']),
+        'keywords': ('کلیدواژه', ['کلیدواژه'], ['کلیدواژه', 'کلید واژه']),
+    },
+    year_keys=['سال', 'سال دفاع', 'تاریخ دفاع']
+)
+
+# Message classification, compiled once (see intent_router)
+ROUTER = IntentRouter(
+    keywords={
+        **FAST_ANSWERS.keywords,
+        'greeting': ['سلام', 'درود', 'hello', 'hi'],
+        'filter_command': ['📅', '🎓', '👨‍🏫', '📚', '❌', '🔙', 'فیلتر', 'بله', 'آره', 'خیر', 'نه'],
+        'followup': ['بله', 'آره', 'اوکی', 'باشه', 'بیشتر', 'جدیدتر', 'بهترین', 'کدوم', 'اولی', 'دومی', 'اون', 'این', 'همون', 'باز', 'دوباره', 'معرفی کن', 'شرح بده', 'استاد راهنما', 'پژوهشگر', 'شبیه', 'مشابه'],
+        'person_search': ['از این استاد', 'از استاد', 'پایان نامه های این استاد', 'پایان نامه دیگه از', 'از این پژوهشگر'],
+        'explain': ['شرح', 'توضیح', 'درباره', 'جزئیات'],
+        'more': ['بیشتر', 'باز', 'دوباره'],
+        'introduce': ['معرفی'],
+        'filter_word': ['فیلتر'],
+        'advisor': ['استاد راهنما'],
+        'professor': ['استاد'],
+        'similar': ['شبیه', 'مشابه', 'مثل این', 'مثل اون'],
+    },
+    patterns={
+        **FAST_ANSWERS.patterns,
+        # The thesis asked about is the 'position' entity (the last one if none is named)
+        'ask_author': [
+            r'(پژوهشگر|نویسنده|استاد راهنما)\s+(پایان.?نامه\s+)?(?P<position>اول|دوم|سوم|آخر|۱|۲|۳|1|2|3)ی?\s*(کیه|چیه|چیست|کدومه)?',
+            r'(?P<position>اول|دوم|سوم|آخر|۱|۲|۳|1|2|3)ی?\s+(پژوهشگر|نویسنده|استاد راهنما)\s*اش?\s*(کیه|چیه|چیست|کدومه)?',
+            r'استاد راهنما\s*اش?\s+(کیه|چیه|چیست)',
+            r'(پژوهشگر|نویسنده)\s*اش?\s+(کیه|چیه|چیست)',
+        ],
+        # Advisor named in a query ("استاد راهنما دکتر ..."), the 'advisor' entity
+        'advisor_named': [r'استاد راهنما[یش]*\s+(?P<advisor>.+)', r'استاد\s+(?P<advisor>.+)', r'راهنما[یش]*\s+(?P<advisor>.+)'],
+    }
+)
+
+# Filler words around an advisor's name
+ADVISOR_FILLER = re.compile(r'(آن|که|باشه|باشد|بده|هست|است)', re.IGNORECASE)
 
 
 def apply_filters(results, filter_type, filter_value):
@@ -192,7 +389,7 @@ def apply_filters(results, filter_type, filter_value):
 def get_available_filters(results, chat_id=None):
     # 1) Priority: Results actually displayed
     if chat_id:
-        shown_results = last_shown_results.get(chat_id, [])
+        shown_results = get_shown_results(chat_id)
     else:
         shown_results = []
 
@@ -245,11 +442,11 @@ def create_filter_menu_keyboard():
 
 def handle_filter_interaction(user_message, chat_id):
     query_lower = user_message.lower()
-    current_stage = filter_state[chat_id].get('stage')
+    current_stage = get_filter_state(chat_id).get('stage')
 
     if current_stage == 'ask':
         if query_lower.startswith('ب') or query_lower.startswith('y') or query_lower.startswith('Y') or 'آره' in query_lower:
-            filter_state[chat_id].update({'active': True, 'stage': 'menu'})
+            get_filter_state(chat_id).update({'active': True, 'stage': 'menu'})
             return ("لطفاً نوع فیلتر را انتخاب کنید:", create_filter_menu_keyboard(), False)
         elif query_lower.startswith('ن') or query_lower.startswith('خ') or query_lower.startswith('n') or query_lower.startswith('N') or user_message == "❌ انصراف":
             reset_filter_state(chat_id)
@@ -259,7 +456,7 @@ def handle_filter_interaction(user_message, chat_id):
             return (None, None, False)
 
     elif current_stage == 'menu':
-        shown_results = last_shown_results.get(chat_id, [])
+        shown_results = get_shown_results(chat_id)
         if not shown_results:
             reset_filter_state(chat_id)
             return ("متأسفم، نتایج قبلی پیدا نشد.", ReplyKeyboardRemove(), False)
@@ -269,22 +466,22 @@ def handle_filter_interaction(user_message, chat_id):
         if user_message == "📅 فیلتر بر اساس سال" and available_filters['years']:
             keyboard = [available_filters['years'][i:i+3] for i in range(0, len(available_filters['years']), 3)]
             keyboard.append(["🔙 بازگشت", "❌ انصراف"])
-            filter_state[chat_id]['stage'] = 'year'
+            get_filter_state(chat_id)['stage'] = 'year'
             return ("لطفاً سال را انتخاب کنید:", ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True), False)
 
         elif user_message == "🎓 فیلتر بر اساس مقطع" and available_filters['degrees']:
             keyboard = [[d] for d in available_filters['degrees']] + [["🔙 بازگشت", "❌ انصراف"]]
-            filter_state[chat_id]['stage'] = 'degree'
+            get_filter_state(chat_id)['stage'] = 'degree'
             return ("لطفاً مقطع را انتخاب کنید:", ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True), False)
 
         elif user_message == "👨‍🏫 فیلتر بر اساس استاد راهنما" and available_filters['advisors']:
             keyboard = [[adv] for adv in available_filters['advisors']] + [["🔙 بازگشت", "❌ انصراف"]]
-            filter_state[chat_id]['stage'] = 'advisor'
+            get_filter_state(chat_id)['stage'] = 'advisor'
             return ("لطفاً استاد راهنما را انتخاب کنید:", ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True), False)
 
         elif user_message == "📚 فیلتر بر اساس رشته" and available_filters['fields']:
             keyboard = [[f] for f in available_filters['fields']] + [["🔙 بازگشت", "❌ انصراف"]]
-            filter_state[chat_id]['stage'] = 'field'
+            get_filter_state(chat_id)['stage'] = 'field'
             return ("لطفاً رشته را انتخاب کنید:", ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True), False)
 
         elif user_message == "❌ انصراف":
@@ -296,7 +493,7 @@ def handle_filter_interaction(user_message, chat_id):
 
     elif current_stage in ['year', 'degree', 'advisor', 'field']:
         if user_message == "🔙 بازگشت":
-            filter_state[chat_id]['stage'] = 'menu'
+            get_filter_state(chat_id)['stage'] = 'menu'
             return ("لطفاً نوع فیلتر را انتخاب کنید:", create_filter_menu_keyboard(), False)
         elif user_message == "❌ انصراف":
             reset_filter_state(chat_id)
@@ -309,7 +506,7 @@ def handle_filter_interaction(user_message, chat_id):
 
             if filtered:
                 save_search_results(chat_id, filtered, f"فیلتر {filter_type} {user_message}")
-                last_shown_results[chat_id] = filtered[:6]
+                set_shown_results(chat_id, filtered[:6])
                 reset_filter_state(chat_id)
                 filter_name_map = {
                     'سال': f"سال {user_message}",
@@ -328,7 +525,7 @@ def handle_filter_interaction(user_message, chat_id):
 
 # RAG
 def initialize_embedder():
-    global embedder, thesis_details_loader
+    global embedder, thesis_details_loader, handler
     print("🔄 Loading FAISS index...")
     try:
         embedder = BookEmbedder(api_key=config.OPENAI_API_KEY)
@@ -344,15 +541,14 @@ def initialize_embedder():
     except Exception as e:
         print(f"❌ Error loading details: {e}")
         return False
+    handler = ThesisHandler(embedder, thesis_details_loader)
     return True
 
 
-def is_followup_question(query, chat_id):
-    followup_keywords = ['بله', 'آره', 'اوکی', 'باشه', 'بیشتر', 'جدیدتر', 'بهترین', 'کدوم', 'اولی', 'دومی', 'اون', 'این', 'همون', 'باز', 'دوباره', 'معرفی کن', 'شرح بده', 'استاد راهنما', 'پژوهشگر']
-    query_lower = query.lower()
-    if is_filter_command(query):
+def is_followup_question(route, chat_id):
+    if route.has('filter_command'):
         return False
-    return any(kw in query_lower for kw in followup_keywords) and len(get_last_search_results(chat_id)) > 0 and len(query.split()) <= 10
+    return route.has('followup', 'reference') and len(sessions.peek(chat_id).result_ids) > 0 and route.word_count <= 10
 
 
 def filter_results_with_gpt(user_query, search_results, original_query=""):
@@ -360,13 +556,17 @@ def filter_results_with_gpt(user_query, search_results, original_query=""):
         return []
     items_text = "\n".join([f"{i}. «{r.get('عنوان') or r.get('عنوان پایان‌نامه', '')}» - پژوهشگر: {r.get('نویسنده', '')}" for i, r in enumerate(search_results, 1)])
     try:
-        response = openai_client.chat.completions.create(
+        answer = create_chat_completion(
+            openai_client,
+            [
+                {"role": "system", "content": FILTER_INSTRUCTIONS},
+                {"role": "user", "content": f"سوال: \"{user_query}\"\nموضوع اصلی: \"{original_query}\"\n\nلیست پایان‌نامه‌ها:\n{items_text}"}
+            ],
             model="gpt-4o-mini",
-            messages=[{"role": "user", "content": f"سوال: \"{user_query}\"\nموضوع اصلی: \"{original_query}\"\n\nلیست پایان‌نامه‌ها:\n{items_text}\n\nفقط مرتبط‌ها را انتخاب کن.\nخروجی: شماره‌ها با کاما (مثل '1,3') یا 'هیچکدام'."}],
             max_tokens=100,
-            temperature=0.1
-        )
-        answer = response.choices[0].message.content.strip()
+            temperature=0.1,
+            stage="thesis.filter"
+        ).strip()
         if "هیچکدام" in answer.lower():
             return []
         numbers = [int(n) for n in re.findall(r'\b\d+\b', answer) if 1 <= int(n) <= len(search_results)]
@@ -397,9 +597,11 @@ def search_by_advisor_direct(advisor_name, exclude_rows=None):
                 if advisor_normalized in co_advisor_clean or co_advisor_clean in advisor_normalized:
                     match = True
             if match:
-                row_id = row.get('رديف')
+                # رديف is the index of the details table
+                row_id = idx
                 if exclude_rows is None or row_id not in exclude_rows:
                     result = row.to_dict()
+                    result['رديف'] = row_id
                     result['distance'] = 0.1
                     results.append(result)
         print(f"🔍 Direct advisor search: {advisor_name} → {len(results)} result")
@@ -409,72 +611,89 @@ def search_by_advisor_direct(advisor_name, exclude_rows=None):
         return []
 
 
+def find_candidates(query, depth):
+    """Ranked index rows for a query, found by words when it cannot be embedded"""
+    try:
+        query_vector = embedder.embed_query(query)
+    except CircuitOpen:
+        query_vector = None
+    if query_vector is None:
+        # Circuit open, or this embedding call failed before the breaker tripped
+        print("🔤 Embeddings unavailable, searching by words")
+        return handler.lexical_search(query, depth)
+    return embedder.search_vector(query_vector, depth)
+
+
 def search_theses(query, k=None, distance_threshold=0.8, exclude_rows=None):
     if embedder is None:
         return []
-    for pattern in [r'استاد راهنما[یش]*\s+(.+)', r'استاد\s+(.+)', r'راهنما[یش]*\s+(.+)']:
-        if match := re.search(pattern, query, re.IGNORECASE):
-            advisor_name = re.sub(r'(آن|که|باشه|باشد|بده|هست|است)', '', match.group(1).strip(), flags=re.IGNORECASE).strip()
-            if advisor_name and len(advisor_name) > 3:
-                print(f"   📌 Extracted Advisor: {advisor_name}")
-                if direct_results := search_by_advisor_direct(advisor_name, exclude_rows):
-                    return direct_results
+    if advisor := ROUTER.route(query).entities.get('advisor'):
+        advisor_name = ADVISOR_FILLER.sub('', advisor.strip()).strip()
+        if advisor_name and len(advisor_name) > 3:
+            print(f"   📌 Extracted Advisor: {advisor_name}")
+            if direct_results := search_by_advisor_direct(advisor_name, exclude_rows):
+                return direct_results
     try:
-        results = embedder.search(query, k=k or 30)
-        enriched_results = [enriched for r in results if (enriched := enrich_search_result(r))['distance'] < distance_threshold and (exclude_rows is None or enriched['رديف'] not in exclude_rows)]
+        depth = k or config.SEARCH_DEPTH
+        results = searches.do((normalize_query(query), depth), find_candidates, query, depth)
+        enriched_results = [enriched for r in results if (enriched := enrich_search_result(dict(r)))['distance'] < distance_threshold and (exclude_rows is None or enriched['رديف'] not in exclude_rows)]
         print(f"📊 Search: '{query[:50]}...' → {len(enriched_results)} result")
         return enriched_results[:k] if k else enriched_results[:10]
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         print(f"❌ Error in search: {e}")
         return []
 
 
-def generate_rag_response(user_query, chat_id):
-    clean_old_conversations()
-
-    if any(g in user_query.lower() for g in ['سلام', 'درود', 'hello', 'hi']) and len(user_query.split()) <= 3:
+@bounded(config.REQUEST_DEADLINE, lambda: (TIMEOUT_REPLY, False))
+def generate_rag_response(user_query, chat_id, on_delta=None):
+    route = ROUTER.route(user_query)
+    if route.has('greeting') and route.word_count <= 3:
         return ("سلام! 👋\n\nمثال: پایان نامه یادگیری ماشین", False)
 
-    is_followup = is_followup_question(user_query, chat_id)
-    query_lower = user_query.lower()
+    is_followup = is_followup_question(route, chat_id)
+    # Only fresh searches are cached; follow-ups depend on the conversation
+    cache_ids = None
 
-    asking_author_patterns = [
-        r'(پژوهشگر|نویسنده|استاد راهنما)\s+(پایان.?نامه\s+)?(اول|دوم|سوم|آخر|۱|۲|۳|1|2|3)ی?\s*(کیه|چیه|چیست|کدومه)?',
-        r'(اول|دوم|سوم|آخر|۱|۲|۳|1|2|3)ی?\s+(پژوهشگر|نویسنده|استاد راهنما)\s*اش?\s*(کیه|چیه|چیست|کدومه)?',
-        r'استاد راهنما\s*اش?\s+(کیه|چیه|چیست)',
-        r'(پژوهشگر|نویسنده)\s*اش?\s+(کیه|چیه|چیست)',
-    ]
-
-    if any(re.search(p, query_lower) for p in asking_author_patterns) and 'معرفی' not in query_lower and 'بیشتر' not in query_lower and 'فیلتر' not in query_lower and len(user_query.split()) <= 10:
+    if route.has('ask_author') and not route.has('introduce', 'more', 'filter_word') and route.word_count <= 10:
         print("📝 Researcher/Advisor Question")
-        if not (shown_results := last_shown_results.get(chat_id, [])):
+        if not (shown_results := get_shown_results(chat_id)):
             return ("متأسفم، هنوز پایان‌نامه‌ای معرفی نکردم.", False)
 
-        position = 0 if any(x in query_lower for x in ['اول', '۱', '1']) else (1 if any(x in query_lower for x in ['دوم', '۲', '2']) else (2 if any(x in query_lower for x in ['سوم', '۳', '3']) else -1))
-        if position >= len(shown_results):
+        position = route.entities.get('position')
+        if (target_item := pick(shown_results, ordinal_of(position) if position else None)) is None:
             return (f"متأسفم، من فقط {len(shown_results)} پایان‌نامه معرفی کردم.", False)
 
-        target_item = shown_results[position]
         title = target_item.get('عنوان') or target_item.get('عنوان پایان‌نامه', '')
-        person_type = "استاد راهنما" if 'استاد راهنما' in query_lower else "پژوهشگر"
+        person_type = "استاد راهنما" if route.has('advisor') else "پژوهشگر"
         person = target_item.get('استاد راهنما' if person_type == "استاد راهنما" else 'نویسنده', '').strip()
 
         if not person or person.lower() in ['nan', 'none', '']:
             return (f"متأسفم، {person_type} پایان‌نامه «{title}» در سیستم ثبت نشده است.", False)
         return (f"{person_type} پایان‌نامه «{title}»، «{person}» است.", False)
 
+    # Advisor, year, degree... of a shown thesis: no search, no model call
+    if is_followup and not route.has('person_search', 'explain', 'introduce', 'more', 'filter_word'):
+        if fast_answer := FAST_ANSWERS.answer(route, get_shown_results(chat_id)):
+            add_to_conversation(chat_id, "user", user_query)
+            add_to_conversation(chat_id, "assistant", fast_answer)
+            return (fast_answer, False)
+
     author_search_done = False
-    if is_followup and any(kw in query_lower for kw in ['از این استاد', 'از استاد', 'پایان نامه های این استاد', 'پایان نامه دیگه از', 'از این پژوهشگر']):
+    if is_followup and route.has('person_search'):
         print("📚 Researcher/Advisor Search")
-        if prev_results := last_shown_results.get(chat_id, get_last_search_results(chat_id)):
-            target_item = prev_results[0] if 'اول' in query_lower else prev_results[-1]
-            search_name = target_item.get('استاد راهنما' if 'استاد' in query_lower else 'نویسنده', '').strip()
+        if prev_results := get_shown_results(chat_id) or get_last_search_results(chat_id):
+            target_item = pick(prev_results, route.ordinal) or prev_results[-1]
+            search_name = target_item.get('استاد راهنما' if route.has('professor') else 'نویسنده', '').strip()
             if search_name:
-                previous_row_ids = [r['رديف'] for r in last_shown_results.get(chat_id, [])]
+                previous_row_ids = sessions.peek(chat_id).offered()
                 search_results_raw = search_theses(search_name, k=None, distance_threshold=1.2, exclude_rows=previous_row_ids)
                 search_results = filter_results_with_gpt(f"پایان‌نامه‌های {search_name}", search_results_raw)
                 if search_results:
+                    prefetcher.cancel(chat_id)
                     save_search_results(chat_id, search_results, search_name)
+                    save_cursor(chat_id, search_results)
                     author_search_done = True
                     is_followup = False
                 else:
@@ -484,70 +703,88 @@ def generate_rag_response(user_query, chat_id):
         if not (prev_results := get_last_search_results(chat_id)):
             return ("متأسفم، نتایج قبلی پیدا نشد.", False)
 
-        if any(kw in query_lower for kw in ['شرح', 'توضیح', 'درباره', 'جزئیات']):
-            if not (shown_results := last_shown_results.get(chat_id, [])):
+        if route.has('explain') and not route.has('similar'):
+            if not (shown_results := get_shown_results(chat_id)):
                 return ("متأسفم، هنوز پایان‌نامه‌ای معرفی نکردم.", False)
-            selected_item = shown_results[-1]
-            title = selected_item.get('عنوان') or selected_item.get('عنوان پایان‌نامه', '')
-            author = selected_item.get('نویسنده', 'نامشخص')
+            selected_item = pick(shown_results, route.ordinal) or shown_results[-1]
+            # Short, generic questions use the precomputed or prefetched explanation
+            if route.word_count <= 6:
+                if stored := stored_explanation(selected_item['رديف']):
+                    return (stored, False)
+                prefetched = prefetcher.take(chat_id, 'explanation')
+                if prefetched and prefetched[0] == selected_item['رديف']:
+                    return (prefetched[1], False)
             try:
-                response = openai_client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": SYSTEM_PROMPT},
-                        {"role": "user", "content": f"عنوان: «{title}»\nپژوهشگر: {author}\n\nسوال: {user_query}"}
-                    ],
-                    max_tokens=500,
-                    temperature=0.7
-                )
-                return (response.choices[0].message.content, False)
+                return (explain_thesis(selected_item, user_query, on_delta), False)
+            except CircuitOpen:
+                return (handler.format_result(selected_item), False)
             except:
                 return ("متأسفم، نتوانستم توضیح دهم.", False)
 
-        if any(word in query_lower for word in ['بیشتر', 'باز', 'دوباره']):
-            previous_row_ids = [r['رديف'] for r in last_shown_results.get(chat_id, [])]
-            last_query = get_last_query(chat_id)
-            search_results_raw = search_theses(last_query, k=None, distance_threshold=1.0, exclude_rows=previous_row_ids)
-            search_results = [r for r in filter_results_with_gpt(user_query, search_results_raw, last_query) if r['رديف'] not in previous_row_ids]
-            if not search_results:
+        if route.has('more'):
+            if not (search_results := next_results(chat_id)):
                 return ("متأسفم، پایان‌نامه جدیدی پیدا نکردم.", False)
-            save_search_results(chat_id, search_results, last_query)
+            save_search_results(chat_id, search_results)
+            is_followup = False
+        elif route.has('similar') and embedder.similar is not None:
+            # Neighbours from the similar-items graph; "more" pages through the rest
+            shown_results = get_shown_results(chat_id) or prev_results
+            target_item = pick(shown_results, route.ordinal) or shown_results[-1]
+            title = target_item.get('عنوان') or target_item.get('عنوان پایان‌نامه', '')
+            if not (similar := similar_results(target_item['رديف'], {r['رديف'] for r in shown_results})):
+                return (f"متأسفم، پایان‌نامه مشابهی برای «{title}» پیدا نکردم.", False)
+            prefetcher.cancel(chat_id)
+            save_cursor(chat_id, similar)
+            search_results = similar[:config.MORE_PAGE_SIZE]
+            save_search_results(chat_id, search_results, title)
+            set_shown_results(chat_id, search_results)
             is_followup = False
         else:
             search_results = filter_results_with_gpt(user_query, prev_results) or prev_results[:5]
 
     elif not author_search_done:
         print(f"🔍 Search: {user_query}")
-        search_results_raw = search_theses(user_query, k=None, distance_threshold=0.85)
+        # All ranked candidates go to the cursor; the best 10 are filtered for this answer
+        search_results_raw = search_theses(user_query, k=config.SEARCH_DEPTH, distance_threshold=0.85)
         if len(search_results_raw) < 3:
             print(f"   ⚠️ Low results, threshold increased")
-            search_results_raw = search_theses(user_query, k=None, distance_threshold=1.2)
+            search_results_raw = search_theses(user_query, k=config.SEARCH_DEPTH, distance_threshold=1.2)
         if not search_results_raw:
             return ("متأسفم، پایان‌نامه مرتبطی پیدا نکردم.", False)
-        search_results = filter_results_with_gpt(user_query, search_results_raw, user_query) or search_results_raw[:6]
+        search_results = filter_results_with_gpt(user_query, search_results_raw[:10], user_query) or search_results_raw[:6]
+        prefetcher.cancel(chat_id)
+        save_cursor(chat_id, search_results_raw, offered=10)
         search_results = search_results[:10]
         save_search_results(chat_id, search_results, user_query)
-        last_shown_results[chat_id] = search_results[:6]
+        set_shown_results(chat_id, search_results[:6])
+        cache_ids = [r['رديف'] for r in search_results]
 
-    context = "\n".join([
+    context_parts = [
         f"«{r.get('عنوان') or r.get('عنوان پایان‌نامه', '')}» — پژوهشگر: {clean_text_for_display(r.get('نویسنده', ''))}, "
         f"استاد راهنما: {clean_text_for_display(r.get('استاد راهنما', ''))}, مقطع: {clean_text_for_display(format_field(r.get('مقطع')))}, "
         f"رشته: {clean_text_for_display(format_field(r.get('رشته')) or format_field(r.get('رشته تحصیلی')))}, "
         f"سال: {clean_text_for_display(format_field(r.get('سال')) or format_field(r.get('سال دفاع')))}"
         for r in search_results
-    ])
+    ]
+    messages = context_builder.build(chat_id, None, ANSWER_TEMPLATE, context_parts, query=user_query)
+    # The summary sent with the question is part of the key
+    cache_key = AnswerCache.make_key(user_query, cache_ids, ANSWER_PROMPT_VERSION, messages[1:-1]) if cache_ids else None
 
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"پایان‌نامه‌ها:\n{context}\n\nسوال: {user_query}\n\n**فرمت خروجی:**\n📄 «عنوان»\n   پژوهشگر: ...\n   استاد راهنما: ...\n   مقطع: ...\n   رشته: ...\n   سال: ...\n\n**مهم:** اگر سال '...' بود، از 'نامشخص' استفاده کن."}
-            ],
-            max_tokens=1500,
-            temperature=0.1
-        )
-        assistant_response = response.choices[0].message.content
+        assistant_response = answer_cache.get(cache_key) if cache_key else None
+
+        if assistant_response is None:
+            assistant_response = create_chat_completion(
+                openai_client,
+                messages,
+                model="gpt-4o-mini",
+                max_tokens=1500,
+                temperature=0.1,
+                on_delta=on_delta,
+                stage="thesis.answer"
+            )
+            if cache_key:
+                answer_cache.put(cache_key, assistant_response)
 
         if mentioned_titles := re.findall(r'📄 «([^»]+)»', assistant_response):
             shown_items = []
@@ -557,11 +794,22 @@ def generate_rag_response(user_query, chat_id):
                         shown_items.append(item)
                         break
             if shown_items:
-                last_shown_results[chat_id] = shown_items
+                set_shown_results(chat_id, shown_items)
 
         add_to_conversation(chat_id, "user", user_query)
         add_to_conversation(chat_id, "assistant", assistant_response)
+        prefetch_next_turn(chat_id)
 
+        return (assistant_response, not is_followup)
+    except (DeadlineExceeded, CircuitOpen) as e:
+        # The theses are found; only the model's answer is missing
+        if isinstance(e, CircuitOpen):
+            header = "⚠️ دستیار هوشمند موقتاً در دسترس نیست؛ پایان‌نامه‌های پیدا شده:"
+        else:
+            header = "⏳ پاسخ کامل آماده نشد؛ این پایان‌نامه‌ها پیدا شد:"
+        assistant_response = header + "\n\n" + "\n\n".join(handler.format_result(r) for r in search_results[:6])
+        add_to_conversation(chat_id, "user", user_query)
+        add_to_conversation(chat_id, "assistant", assistant_response)
         return (assistant_response, not is_followup)
     except Exception as e:
         print(f"❌ Error: {e}")
@@ -587,9 +835,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def new_conversation_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    for d in [conversation_memory, search_results_memory, last_query_memory, last_shown_results]:
-        d.pop(chat_id, None)
-    reset_filter_state(chat_id)
+    reset_conversation(chat_id)
     await update.message.reply_text(
         "✅ مکالمه جدید شروع شد!\n\nحالا می‌توانید سوال جدیدی بپرسید. 😊",
         reply_markup=ReplyKeyboardRemove()
@@ -628,7 +874,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.chat.send_action(action="typing")
 
     # Filter management
-    if filter_state[chat_id].get('active', False):
+    if sessions.peek(chat_id).filter.get('active', False):
         if filter_result := handle_filter_interaction(user_message, chat_id):
             message, keyboard, should_show = filter_result
 
@@ -681,14 +927,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
     # Normal Search
-    result = generate_rag_response(user_message, chat_id)
-    response, is_new_search = result if isinstance(result, tuple) else (result, False)
-    await update.message.reply_text(response)
+    reply = StreamingReply(update.message)
+    reply.start()
+    try:
+        result = await asyncio.to_thread(generate_rag_response, user_message, chat_id, reply.push)
+        response, is_new_search = result if isinstance(result, tuple) else (result, False)
+        await reply.finish(response)
+    finally:
+        await reply.stop()
 
     # Filter suggestion
     if should_offer_filter(chat_id, get_last_search_results(chat_id), is_new_search):
         await update.message.reply_text("💡 آیا مایلید نتایج را فیلتر کنید؟ (بله/خیر)")
-        filter_state[chat_id].update({'active': True, 'stage': 'ask', 'last_offer': datetime.now()})
+        get_filter_state(chat_id).update({'active': True, 'stage': 'ask', 'last_offer': datetime.now()})
 
 
 def main():
@@ -702,6 +953,7 @@ def main():
 
     TELEGRAM_BOT_TOKEN = "YOUR_TELEGRAM_BOT_TOKEN_HERE"
     app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    schedule_expiry(app)
 
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("new", new_conversation_command))
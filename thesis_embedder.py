@@ -4,8 +4,8 @@ import faiss
 import pickle
 import time
 from pathlib import Path
-from langchain_openai import OpenAIEmbeddings
 import config
+from llm_client import get_embeddings
 
 # Paths
 THESES_EXCEL = "output/theses/theses_normalized.xlsx"
@@ -16,10 +16,7 @@ EMBEDDING_MODEL = "text-embedding-3-small"
 class ThesisEmbedder:
     def __init__(self, api_key):
         print("🔧 Initializing embedder...")
-        self.embedding_client = OpenAIEmbeddings(
-            model=EMBEDDING_MODEL,
-            openai_api_key=api_key
-        )
+        self.embedding_client = get_embeddings(EMBEDDING_MODEL, api_key)
         self.index = None
         self.metadata_map = {}
         print("✅ Embedder ready.")